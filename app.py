@@ -1,12 +1,37 @@
-from typing import Union, List
-
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+import asyncio
+import base64
+import csv
+import hashlib
+import io
+import json
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Iterator, Literal, Optional, Union, List, Sequence
+
+import orjson
+from fastapi import FastAPI, Header, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, \
+    StreamingResponse
 from pydantic import BaseModel
 import uuid
 
-from domain import ApiError, WeatherApi, WeatherState, WeatherRepository, \
+from domain import AggregateValue, ApiError, AsyncWeatherApi, \
+    BackgroundService, CircuitOpenError, HistoryCursor, RateLimitError, \
+    WeatherApi, WeatherHistory, WeatherState, WeatherRepository, \
     UserRepository, UserLoginRepository, User
+from domain_metrics import MetricsRegistry
+from domain_trace import Tracer
+
+MAX_HISTORY_LIMIT = 1000
+MAX_BATCH_CITIES = 50
+AGGREGATE_BUCKETS = {
+    "5m": 5 * 60,
+    "1h": 60 * 60,
+    "1d": 24 * 60 * 60,
+}
 
 
 # Responses
@@ -19,6 +44,21 @@ class WeatherResponse(BaseModel):
     humidity: int
 
 
+class CityWeatherEntity(BaseModel):
+    city: str
+    success: bool
+    temperature: Optional[float] = None
+    feels_like: Optional[float] = None
+    pressure: Optional[int] = None
+    humidity: Optional[int] = None
+    error: Optional[str] = None
+
+
+class BatchWeatherResponse(BaseModel):
+    success: bool
+    weather: List[CityWeatherEntity]
+
+
 class WeatherEntity(BaseModel):
     time: float
     temperature: float
@@ -30,6 +70,29 @@ class WeatherEntity(BaseModel):
 class HistoryResponse(BaseModel):
     success: bool
     history: List[WeatherEntity]
+    next_cursor: Optional[str] = None
+
+
+class AggregateValueEntity(BaseModel):
+    min: float
+    max: float
+    mean: float
+    last: float
+
+
+class WeatherAggregateEntity(BaseModel):
+    time: float
+    count: int
+    temperature: AggregateValueEntity
+    feels_like: AggregateValueEntity
+    pressure: AggregateValueEntity
+    humidity: AggregateValueEntity
+
+
+class AggregatesResponse(BaseModel):
+    success: bool
+    bucket_seconds: int
+    aggregates: List[WeatherAggregateEntity]
 
 
 class UserResponse(BaseModel):
@@ -42,6 +105,7 @@ class SuccessfulLoginResponse(BaseModel):
     callback_url: str
     auth_token: str
 
+
 class EmptyResponse(BaseModel):
     success: bool
 
@@ -51,6 +115,10 @@ class ErrorResponse(BaseModel):
     error: str
 
 
+bad_request_response = {
+    "model": ErrorResponse,
+    "description": "Bad Request"
+}
 forbidden_response = {
     "model": ErrorResponse,
     "description": "Forbidden"
@@ -63,21 +131,52 @@ error_response = {
     "model": ErrorResponse,
     "description": "Internal Server Error"
 }
+unavailable_response = {
+    "model": ErrorResponse,
+    "description": "Service Unavailable"
+}
 
 
 def create_app(
-    weather_api: WeatherApi,
+    weather_api: Union[WeatherApi, AsyncWeatherApi],
     weather_repository: WeatherRepository,
     user_repository: UserRepository,
     user_login_repository: UserLoginRepository,
-    telegram_service_authorization_token: str
+    telegram_service_authorization_token: str,
+    background_services: Sequence[BackgroundService] = (),
+    metrics: Optional[MetricsRegistry] = None,
+    tracer: Optional[Tracer] = None,
 ):
-    app = FastAPI()
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        for service in background_services:
+            await service.start()
+        yield
+        for service in reversed(background_services):
+            await service.stop()
+        if isinstance(weather_api, AsyncWeatherApi):
+            await weather_api.aclose()
+
+    app = FastAPI(lifespan=lifespan)
+
+    if metrics is not None:
+        app.add_middleware(MetricsMiddleware, metrics=metrics)
+        add_metrics_route(app, metrics)
+    if tracer is not None:
+        app.add_middleware(TracingMiddleware, tracer=tracer)
+        add_debug_traces_route(
+            app, tracer, telegram_service_authorization_token
+        )
 
     # Weather
 
     add_get_weather_route(app, weather_api, user_repository)
+    add_get_weather_batch_route(app, weather_api, user_repository)
     add_get_weather_history_route(app, weather_repository, user_repository)
+    add_get_weather_export_route(app, weather_repository, user_repository)
+    add_get_weather_aggregates_route(
+        app, weather_repository, user_repository
+    )
 
     # User
 
@@ -98,6 +197,74 @@ def create_app(
 
 # Utils
 
+class MetricsMiddleware:
+
+    def __init__(self, app, metrics: MetricsRegistry):
+        self.app = app
+        self.requests = metrics.counter(
+            "http_requests_total",
+            "HTTP requests per route and status",
+            ("method", "route", "status"),
+        )
+        self.latency = metrics.histogram(
+            "http_request_duration_seconds",
+            "HTTP request latency per route and status",
+            ("method", "route", "status"),
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            labels = (
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                str(status),
+            )
+            self.requests.inc(*labels)
+            self.latency.observe(time.perf_counter() - started, *labels)
+
+
+class TracingMiddleware:
+
+    def __init__(self, app, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace, token = self.tracer.begin(scope["method"], scope["path"])
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.tracer.end(trace, token, status)
+
+
 def find_user(user_repository, token) -> Union[User, JSONResponse]:
     try:
         user = user_repository.get_user(token)
@@ -122,94 +289,526 @@ def find_user(user_repository, token) -> Union[User, JSONResponse]:
     return user
 
 
+def weather_response(weather) -> Union[dict, JSONResponse]:
+    if isinstance(weather, WeatherState):
+        return {
+            "success": True,
+            "temperature": weather.temperature,
+            "feels_like": weather.feels_like,
+            "pressure": weather.pressure,
+            "humidity": weather.humidity,
+        }
+
+    msg = "Bad response from WeatherAPI"
+    if isinstance(weather, ApiError):
+        msg += ": " + weather.message
+    status_code = 500
+    if isinstance(weather, (CircuitOpenError, RateLimitError)):
+        status_code = 503
+    return JSONResponse(
+        status_code=status_code, content={"success": False, "error": msg}
+    )
+
+
+def entity_tag(time: datetime) -> str:
+    return f'"{round(time.timestamp() * 1000):x}"'
+
+
+def content_tag(body: bytes) -> str:
+    return f'W/"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+
+
+def validator_headers(time: datetime, cache_control: str) -> dict:
+    return {
+        "ETag": entity_tag(time),
+        "Last-Modified": format_datetime(
+            time.astimezone(timezone.utc), usegmt=True
+        ),
+        "Cache-Control": cache_control,
+    }
+
+
+def max_age(ttl: Optional[float]) -> str:
+    if ttl is None:
+        return "no-cache"
+    return f"max-age={max(0, int(ttl))}"
+
+
+def not_modified(headers: dict, last_modified: datetime,
+                 if_none_match: Optional[str],
+                 if_modified_since: Optional[str]) -> bool:
+    if if_none_match is not None:
+        return etag_matches(headers["ETag"], if_none_match)
+
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return int(last_modified.timestamp()) <= since.timestamp()
+
+    return False
+
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    etag = etag.removeprefix("W/")
+    return any(
+        tag == "*" or tag.removeprefix("W/") == etag
+        for tag in map(str.strip, if_none_match.split(","))
+    )
+
+
+def conditional_weather_response(
+    weather, ttl: Optional[float], if_none_match: Optional[str],
+    if_modified_since: Optional[str]
+) -> Union[Response, JSONResponse]:
+    if not isinstance(weather, WeatherState):
+        return weather_response(weather)
+
+    headers = validator_headers(weather.time, max_age(ttl))
+    if not_modified(headers, weather.time, if_none_match, if_modified_since):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(weather_response(weather), headers=headers)
+
+
+class FastJSONResponse(JSONResponse):
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+def weather_api_exception_response(e: Exception) -> JSONResponse:
+    return JSONResponse(
+        status_code=500,
+        content={
+            "success": False,
+            "error": f"Bad response from WeatherApi: {e}"
+        }
+    )
+
+
+def from_timestamp(timestamp: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(timestamp) if timestamp is not None \
+        else None
+
+
+def history_filters(after: Optional[float], before: Optional[float],
+                    from_time: Optional[float],
+                    to_time: Optional[float]) -> Union[dict, JSONResponse]:
+    try:
+        return {
+            "after": from_timestamp(after),
+            "before": from_timestamp(before),
+            "from_time": from_timestamp(from_time),
+            "to_time": from_timestamp(to_time),
+        }
+    except (OverflowError, OSError, ValueError):
+        return JSONResponse(
+            status_code=400,
+            content={"success": False, "error": "Bad timestamp"}
+        )
+
+
+def encode_history_cursor(timestamp: float, city: str) -> str:
+    payload = json.dumps([round(timestamp * 1000), city])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_history_cursor(cursor: Optional[str]) -> Optional[HistoryCursor]:
+    if cursor is None:
+        return None
+
+    try:
+        time, city = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return HistoryCursor(datetime.fromtimestamp(time / 1000), str(city))
+    except (TypeError, ValueError, OverflowError, OSError) as e:
+        raise ValueError(f"Bad cursor: {cursor}") from e
+
+
 # Routes
 # - Weather
 
 def add_get_weather_route(
     app: FastAPI,
-    weather_api: WeatherApi,
+    weather_api: Union[WeatherApi, AsyncWeatherApi],
     user_repository: UserRepository
 ):
-    @app.get(
+    route = app.get(
         "/weather",
         response_model=WeatherResponse,
         responses={
+            304: {"description": "Not Modified"},
             403: forbidden_response,
+            500: error_response,
+            503: unavailable_response
+        },
+    )
+
+    if isinstance(weather_api, AsyncWeatherApi):
+        @route
+        async def get_weather(
+            city: str,
+            user_token: str,
+            if_none_match: Optional[str] = Header(None),
+            if_modified_since: Optional[str] = Header(None),
+        ) -> Union[WeatherResponse, ErrorResponse]:
+            user = await run_in_threadpool(
+                find_user, user_repository, user_token
+            )
+            if isinstance(user, JSONResponse):
+                return user
+
+            try:
+                weather = await weather_api.get_weather(city, user)
+            except Exception as e:
+                return weather_api_exception_response(e)
+            return conditional_weather_response(
+                weather, weather_api.get_cached_weather_ttl(city),
+                if_none_match, if_modified_since,
+            )
+    else:
+        @route
+        def get_weather(
+            city: str,
+            user_token: str,
+            if_none_match: Optional[str] = Header(None),
+            if_modified_since: Optional[str] = Header(None),
+        ) -> Union[WeatherResponse, ErrorResponse]:
+            user = find_user(user_repository, user_token)
+            if isinstance(user, JSONResponse):
+                return user
+
+            try:
+                weather = weather_api.get_weather(city, user)
+            except Exception as e:
+                return weather_api_exception_response(e)
+            return conditional_weather_response(
+                weather, weather_api.get_cached_weather_ttl(city),
+                if_none_match, if_modified_since,
+            )
+
+
+def city_weather_entity(
+    city: str,
+    weather: Union[WeatherState, ApiError, Exception, None]
+) -> dict:
+    if isinstance(weather, WeatherState):
+        return {
+            "city": city,
+            "success": True,
+            "temperature": weather.temperature,
+            "feels_like": weather.feels_like,
+            "pressure": weather.pressure,
+            "humidity": weather.humidity,
+        }
+
+    error = "Bad response from WeatherAPI"
+    if isinstance(weather, ApiError):
+        error += ": " + weather.message
+    elif isinstance(weather, Exception):
+        error = f"Bad response from WeatherApi: {weather}"
+    return {"city": city, "success": False, "error": error}
+
+
+def add_get_weather_batch_route(
+    app: FastAPI,
+    weather_api: Union[WeatherApi, AsyncWeatherApi],
+    user_repository: UserRepository,
+    max_concurrency: int = 10
+):
+    # The concurrency cap is per request, so boards never queue behind
+    # each other's misses
+    async def fetch(city: str, user: User, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            if isinstance(weather_api, AsyncWeatherApi):
+                return await weather_api.get_weather(city, user)
+            return await run_in_threadpool(weather_api.get_weather, city, user)
+
+    @app.get(
+        "/weather/batch",
+        response_model=BatchWeatherResponse,
+        responses={
+            400: bad_request_response,
+            403: forbidden_response,
+            500: error_response
+        },
+    )
+    async def get_weather_batch(
+        user_token: str,
+        cities: List[str] = Query(...),
+    ) -> Union[BatchWeatherResponse, ErrorResponse]:
+        cities = list(dict.fromkeys(cities))
+        if len(cities) > MAX_BATCH_CITIES:
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "success": False,
+                    "error": f"At most {MAX_BATCH_CITIES} cities per request"
+                }
+            )
+
+        user = await run_in_threadpool(find_user, user_repository, user_token)
+        if isinstance(user, JSONResponse):
+            return user
+
+        results = {
+            city: weather_api.get_cached_weather(city) for city in cities
+        }
+        misses = [city for city, weather in results.items() if weather is None]
+        semaphore = asyncio.Semaphore(max_concurrency)
+        fetched = await asyncio.gather(
+            *(fetch(city, user, semaphore) for city in misses),
+            return_exceptions=True,
+        )
+        results.update(zip(misses, fetched))
+
+        return {
+            "success": True,
+            "weather": [
+                city_weather_entity(city, weather)
+                for city, weather in results.items()
+            ]
+        }
+
+
+def history_content(history: WeatherHistory, limit: int) -> dict:
+    # History holds one more row than the limit to tell whether there is a
+    # next page, and its columns are encoded without WeatherState or Pydantic
+    next_cursor = None
+    if len(history) > limit > 0:
+        next_cursor = encode_history_cursor(
+            history.times[limit - 1] / 1000, history.cities[limit - 1]
+        )
+
+    history = history[:limit]
+    return {
+        "success": True,
+        "history": [
+            {
+                "time": time,
+                "temperature": temperature,
+                "feels_like": feels_like,
+                "pressure": pressure,
+                "humidity": humidity,
+            }
+            for time, temperature, feels_like, pressure, humidity in zip(
+                history.timestamps(),
+                history.temperatures,
+                history.feels_likes,
+                history.pressures,
+                history.humidities,
+            )
+        ],
+        "next_cursor": next_cursor,
+    }
+
+
+def add_get_weather_history_route(
+    app: FastAPI,
+    weather_repository: WeatherRepository,
+    user_repository: UserRepository
+):
+    @app.get(
+        "/weather/history",
+        response_model=HistoryResponse,
+        responses={
+            304: {"description": "Not Modified"},
+            400: bad_request_response,
             500: error_response
         },
     )
-    def get_weather(city: str, user_token: str) -> \
-            Union[WeatherResponse, ErrorResponse]:
+    def get_weather_history(
+        city: str | None,
+        limit: int,
+        user_token: str,
+        before: Optional[float] = None,
+        after: Optional[float] = None,
+        from_time: Optional[float] = Query(None, alias="from"),
+        to_time: Optional[float] = Query(None, alias="to"),
+        cursor: Optional[str] = None,
+        if_none_match: Optional[str] = Header(None),
+    ) -> Union[HistoryResponse, ErrorResponse]:
         user = find_user(user_repository, user_token)
         if isinstance(user, JSONResponse):
             return user
 
         try:
-            weather = weather_api.get_weather(city, user)
-            if isinstance(weather, WeatherState):
-                return {
-                    "success": True,
-                    "temperature": weather.temperature,
-                    "feels_like": weather.feels_like,
-                    "pressure": weather.pressure,
-                    "humidity": weather.humidity,
-                }
-            else:
-                msg = "Bad response from WeatherAPI"
-                if isinstance(weather, ApiError):
-                    msg += ": " + weather.message
-                return JSONResponse(
-                    status_code=500, content={"success": False, "error": msg}
-                )
+            history_cursor = decode_history_cursor(cursor)
+        except ValueError:
+            return JSONResponse(
+                status_code=400,
+                content={"success": False, "error": "Bad cursor"}
+            )
+
+        filters = history_filters(after, before, from_time, to_time)
+        if isinstance(filters, JSONResponse):
+            return filters
+
+        limit = max(0, min(limit, MAX_HISTORY_LIMIT))
+        city_or_user = city if city is not None and len(city) > 0 else user
+        try:
+            history = weather_repository.get_weather_history(
+                limit + 1,
+                city_or_user,
+                cursor=history_cursor,
+                **filters
+            )
+            response = FastJSONResponse(
+                history_content(WeatherHistory.of(history), limit)
+            )
         except Exception as e:
             return JSONResponse(
                 status_code=500,
                 content={
                     "success": False,
-                    "error": f"Bad response from WeatherApi: {e}"
+                    "error": f"Bad response from WeatherRepository: {e}"
                 }
             )
 
+        # Rows can be written out of time order, so neither the newest row
+        # nor its time tells whether a page changed and the page validates
+        # itself instead
+        headers = {
+            "ETag": content_tag(response.body),
+            "Cache-Control": "no-cache",
+        }
+        if if_none_match is not None and \
+                etag_matches(headers["ETag"], if_none_match):
+            return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+        return response
 
-def add_get_weather_history_route(
+
+EXPORT_COLUMNS = [
+    "time", "city", "temperature", "feels_like", "pressure", "humidity"
+]
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def export_ndjson(chunks: Iterator[WeatherHistory]) -> Iterator[str]:
+    for chunk in chunks:
+        yield "".join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n"
+            for row in WeatherHistory.of(chunk).rows()
+        )
+
+
+def export_csv(chunks: Iterator[WeatherHistory]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()
+    for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(WeatherHistory.of(chunk).rows())
+        yield buffer.getvalue()
+
+
+def add_get_weather_export_route(
     app: FastAPI,
     weather_repository: WeatherRepository,
     user_repository: UserRepository
 ):
     @app.get(
-        "/weather/history",
-        response_model=HistoryResponse,
+        "/weather/export",
+        response_class=StreamingResponse,
+        responses={
+            200: {
+                "content": {
+                    media_type: {}
+                    for media_type in EXPORT_MEDIA_TYPES.values()
+                },
+                "description": "Weather history as NDJSON or CSV",
+            },
+            400: bad_request_response,
+            403: forbidden_response,
+        },
+    )
+    def get_weather_export(
+        user_token: str,
+        city: Optional[str] = None,
+        format: Literal["ndjson", "csv"] = "ndjson",
+        before: Optional[float] = None,
+        after: Optional[float] = None,
+        from_time: Optional[float] = Query(None, alias="from"),
+        to_time: Optional[float] = Query(None, alias="to"),
+    ):
+        user = find_user(user_repository, user_token)
+        if isinstance(user, JSONResponse):
+            return user
+
+        filters = history_filters(after, before, from_time, to_time)
+        if isinstance(filters, JSONResponse):
+            return filters
+
+        chunks = weather_repository.iter_weather_history(
+            city if city is not None and len(city) > 0 else user, **filters
+        )
+        content = export_csv(chunks) if format == "csv" \
+            else export_ndjson(chunks)
+        return StreamingResponse(
+            content,
+            media_type=EXPORT_MEDIA_TYPES[format],
+            headers={
+                "Content-Disposition":
+                    f"attachment; filename=weather.{format}"
+            },
+        )
+
+
+def aggregate_value_entity(value: AggregateValue) -> dict:
+    return {
+        "min": value.min,
+        "max": value.max,
+        "mean": value.mean,
+        "last": value.last,
+    }
+
+
+def add_get_weather_aggregates_route(
+    app: FastAPI,
+    weather_repository: WeatherRepository,
+    user_repository: UserRepository
+):
+    @app.get(
+        "/weather/aggregates",
+        response_model=AggregatesResponse,
         responses={
+            400: bad_request_response,
+            403: forbidden_response,
             500: error_response
         },
     )
-    def get_weather_history(city: str | None, limit: int, user_token: str) -> \
-            Union[HistoryResponse, ErrorResponse]:
+    def get_weather_aggregates(
+        user_token: str,
+        city: Optional[str] = None,
+        bucket: Literal["5m", "1h", "1d"] = "1h",
+        limit: int = 500,
+        before: Optional[float] = None,
+        after: Optional[float] = None,
+        from_time: Optional[float] = Query(None, alias="from"),
+        to_time: Optional[float] = Query(None, alias="to"),
+    ) -> Union[AggregatesResponse, ErrorResponse]:
         user = find_user(user_repository, user_token)
         if isinstance(user, JSONResponse):
             return user
 
+        filters = history_filters(after, before, from_time, to_time)
+        if isinstance(filters, JSONResponse):
+            return filters
+
+        bucket_seconds = AGGREGATE_BUCKETS[bucket]
         try:
-            history = weather_repository.get_weather_history(
-                limit,
-                city if city is not None and len(city) > 0 else user
-            )
-            entities = list(
-                map(
-                    lambda weather: {
-                        "time": weather.time.timestamp(),
-                        "temperature": weather.temperature,
-                        "feels_like": weather.feels_like,
-                        "pressure": weather.pressure,
-                        "humidity": weather.humidity
-                    },
-                    history
-                )
+            aggregates = weather_repository.get_weather_aggregates(
+                city if city is not None and len(city) > 0 else user,
+                bucket_seconds,
+                max(0, min(limit, MAX_HISTORY_LIMIT)),
+                **filters
             )
-            return {
-                "success": True,
-                "history": entities
-            }
         except Exception as e:
             return JSONResponse(
                 status_code=500,
@@ -219,6 +818,24 @@ def add_get_weather_history_route(
                 }
             )
 
+        return {
+            "success": True,
+            "bucket_seconds": bucket_seconds,
+            "aggregates": [
+                {
+                    "time": aggregate.time.timestamp(),
+                    "count": aggregate.count,
+                    "temperature":
+                        aggregate_value_entity(aggregate.temperature),
+                    "feels_like":
+                        aggregate_value_entity(aggregate.feels_like),
+                    "pressure": aggregate_value_entity(aggregate.pressure),
+                    "humidity": aggregate_value_entity(aggregate.humidity),
+                }
+                for aggregate in aggregates
+            ]
+        }
+
 
 # - User
 
@@ -341,3 +958,47 @@ def add_user_telegram_id_route(
         }
 
     return app
+
+
+# - Debug
+
+def add_metrics_route(app: FastAPI, metrics: MetricsRegistry):
+
+    @app.get(
+        "/metrics",
+        response_class=PlainTextResponse,
+        include_in_schema=False,
+    )
+    def get_metrics():
+        return PlainTextResponse(
+            metrics.render(), media_type="text/plain; version=0.0.4"
+        )
+
+    return app
+
+
+def add_debug_traces_route(
+    app: FastAPI,
+    tracer: Tracer,
+    telegram_service_authorization_token: str,
+):
+
+    @app.get("/debug/traces", include_in_schema=False)
+    def get_debug_traces(authorization_token: str):
+        if authorization_token != telegram_service_authorization_token:
+            return JSONResponse(
+                status_code=403,
+                content={
+                    "success": False,
+                    "error": "Forbidden"
+                }
+            )
+
+        return {
+            "success": True,
+            "traced": tracer.traced,
+            "kept": tracer.kept,
+            "traces": tracer.recent(),
+        }
+
+    return app
@@ -0,0 +1,49 @@
+import argparse
+
+from benchmarks import bench_cache, bench_history, bench_routes, \
+    bench_sqlite, bench_users
+from benchmarks.common import environment, write_results
+
+BENCHMARKS = {
+    "sqlite_weather": lambda args: bench_sqlite.run(
+        args.sizes, repeat=args.repeat
+    ),
+    "sqlite_users": lambda args: bench_users.run(),
+    "cached_weather_api": lambda args: bench_cache.run(),
+    "history_serialization": lambda args: bench_history.run(
+        repeat=args.repeat
+    ),
+    "routes": lambda args: bench_routes.run(repeat=args.repeat),
+}
+
+
+def sizes(value: str):
+    return [int(size) for size in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Run the offline benchmarks and write JSON results",
+    )
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument(
+        "--sizes", type=sizes, default=[10000, 100000],
+        help="comma separated row counts for the SQLite weather dataset",
+    )
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument(
+        "--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS),
+    )
+    args = parser.parse_args()
+
+    results = {"environment": environment(), "benchmarks": {}}
+    for name in args.only:
+        print(f"Running {name}...")
+        results["benchmarks"][name] = BENCHMARKS[name](args)
+        write_results(args.output, results)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
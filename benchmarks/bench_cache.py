@@ -0,0 +1,60 @@
+import itertools
+from datetime import datetime
+from typing import List
+
+from benchmarks.common import measure
+from domain import User, WeatherApi, WeatherState
+from domain_wrapper import CachedWeatherApi
+
+
+class StubWeatherApi(WeatherApi):
+
+    def get_weather(self, city: str, user: User) -> WeatherState:
+        return WeatherState(datetime.now(), city, 20.5, 19.0, 1015, 65)
+
+
+def run(repeat: int = 100000) -> List[dict]:
+    user = User(1, "")
+
+    hits = CachedWeatherApi(StubWeatherApi(), 60 * 60)
+    hits.get_weather("London", user)
+
+    misses = CachedWeatherApi(StubWeatherApi(), 60 * 60, max_size=1000)
+    cities = (f"City {i}" for i in itertools.count())
+
+    stale = CachedWeatherApi(StubWeatherApi(), 0, stale_seconds=60 * 60)
+    stale.get_weather("London", user)
+
+    uncached = StubWeatherApi()
+
+    results = [
+        {
+            "path": "uncached",
+            "latency": measure(
+                lambda: uncached.get_weather("London", user), repeat
+            ),
+        },
+        {
+            "path": "hit",
+            "latency": measure(
+                lambda: hits.get_weather("London", user), repeat
+            ),
+            "cache": hits.cache.stats(),
+        },
+        {
+            "path": "miss",
+            "latency": measure(
+                lambda: misses.get_weather(next(cities), user), repeat
+            ),
+            "cache": misses.cache.stats(),
+        },
+        {
+            "path": "stale",
+            "latency": measure(
+                lambda: stale.get_weather("London", user), repeat // 10
+            ),
+            "cache": stale.cache.stats(),
+        },
+    ]
+    stale.refresh_executor.shutdown()
+    return results
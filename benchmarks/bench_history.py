@@ -0,0 +1,114 @@
+import os
+import tempfile
+import tracemalloc
+from datetime import datetime
+from typing import Callable, List
+
+from fastapi.responses import JSONResponse
+
+from app import FastJSONResponse, HistoryResponse, history_content
+from benchmarks.common import chunks, measure, synthetic_weather
+from domain import WeatherHistory, WeatherState
+from domain_sqlite import SqliteWeatherRepository, history_query
+
+HISTORY_ROWS = 100000
+CITY = "City 7"
+ALL_ROWS = """
+    SELECT time, city, temperature, feels_like, pressure, humidity
+    FROM weather
+"""
+
+
+def weather_states(rows) -> List[WeatherState]:
+    return [
+        WeatherState(datetime.fromtimestamp(row[0] / 1000), *row[1:])
+        for row in rows
+    ]
+
+
+def objects_response(repository: SqliteWeatherRepository,
+                     limit: int) -> bytes:
+    # The pipeline /weather/history used before history was columnar: a
+    # WeatherState per row, a dict per row, then FastAPI's model validation
+    sql, args = history_query(limit + 1, CITY)
+    with repository.pool.read() as connection:
+        history = weather_states(connection.execute(sql, args))[:limit]
+
+    entities = list(
+        map(
+            lambda weather: {
+                "time": weather.time.timestamp(),
+                "temperature": weather.temperature,
+                "feels_like": weather.feels_like,
+                "pressure": weather.pressure,
+                "humidity": weather.humidity
+            },
+            history
+        )
+    )
+    content = {"success": True, "history": entities, "next_cursor": None}
+    return JSONResponse(
+        HistoryResponse.model_validate(content).model_dump(mode="json")
+    ).body
+
+
+def columnar_response(repository: SqliteWeatherRepository,
+                      limit: int) -> bytes:
+    history = repository.get_weather_history(limit + 1, CITY)
+    return FastJSONResponse(history_content(history, limit)).body
+
+
+def allocated_bytes(load: Callable[[], object]) -> int:
+    tracemalloc.start()
+    try:
+        result = load()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def memory(repository: SqliteWeatherRepository, sql: str,
+           args: tuple = ()) -> dict:
+    def load(build):
+        with repository.pool.read() as connection:
+            return build(connection.execute(sql, args))
+
+    objects = allocated_bytes(lambda: load(weather_states))
+    columnar = allocated_bytes(lambda: load(WeatherHistory.from_rows))
+    return {
+        "objects_bytes": objects,
+        "columnar_bytes": columnar,
+        "ratio": objects / columnar,
+    }
+
+
+def run(limits: List[int] = (50, 1000), repeat: int = 200) -> List[dict]:
+    with tempfile.TemporaryDirectory() as directory:
+        repository = SqliteWeatherRepository(
+            os.path.join(directory, "weather.db")
+        )
+        for batch in chunks(synthetic_weather(HISTORY_ROWS), 10000):
+            repository.save_weathers(batch)
+
+        results = []
+        for limit in limits:
+            objects = measure(lambda: objects_response(repository, limit),
+                              repeat)
+            columnar = measure(
+                lambda: columnar_response(repository, limit), repeat
+            )
+            results.append({
+                "rows": limit,
+                "objects": objects,
+                "columnar": columnar,
+                "speedup": objects["mean_ms"] / columnar["mean_ms"],
+                "memory": memory(repository, *history_query(limit, CITY)),
+            })
+
+        results.append({
+            "rows": HISTORY_ROWS,
+            "memory": memory(repository, ALL_ROWS),
+        })
+        return results
@@ -0,0 +1,106 @@
+import itertools
+import os
+import tempfile
+import uuid
+from typing import List
+
+import httpx
+from fastapi.testclient import TestClient
+
+from app import create_app
+from benchmarks.common import chunks, measure, synthetic_weather
+from domain_memory import InMemoryUserLoginRepository
+from domain_open_weather_map import AsyncOpenWeatherMapApi
+from domain_sqlite import SqliteUserRepository, SqliteWeatherRepository
+from domain_wrapper import AsyncCachedWeatherApi, \
+    AsyncWeatherApiWithRepository, CachedUserRepository, \
+    WriteBehindWeatherRepository
+
+HISTORY_ROWS = 100000
+
+
+def upstream(request: httpx.Request) -> httpx.Response:
+    if request.url.path.startswith("/geo"):
+        return httpx.Response(200, json=[{"lat": 55.79, "lon": 49.12}])
+    return httpx.Response(200, json={
+        "main": {
+            "temp": 20.5,
+            "feels_like": 19.0,
+            "pressure": 1015,
+            "humidity": 65,
+        }
+    })
+
+
+def run(repeat: int = 1000) -> List[dict]:
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite_repository = SqliteWeatherRepository(
+            os.path.join(directory, "weather.db")
+        )
+        for batch in chunks(synthetic_weather(HISTORY_ROWS), 10000):
+            sqlite_repository.save_weathers(batch)
+        weather_repository = WriteBehindWeatherRepository(sqlite_repository)
+
+        user_repository = SqliteUserRepository(
+            os.path.join(directory, "users.db")
+        )
+        token = str(uuid.uuid4())
+        user_repository.save_user(1, token)
+
+        weather_api = AsyncCachedWeatherApi(
+            AsyncWeatherApiWithRepository(
+                AsyncOpenWeatherMapApi(
+                    "",
+                    client=httpx.AsyncClient(
+                        transport=httpx.MockTransport(upstream)
+                    ),
+                ),
+                weather_repository,
+            ),
+            30 * 60,
+        )
+        app = create_app(
+            weather_api,
+            weather_repository,
+            CachedUserRepository(user_repository),
+            InMemoryUserLoginRepository(),
+            "",
+            background_services=[weather_repository],
+        )
+
+        cities = (f"City {i}" for i in itertools.count())
+        routes = {
+            "/weather hit": lambda client: client.get(
+                "/weather", params={"city": "Kazan", "user_token": token}
+            ),
+            "/weather miss": lambda client: client.get(
+                "/weather",
+                params={"city": next(cities), "user_token": token},
+            ),
+            "/weather/history": lambda client: client.get(
+                "/weather/history",
+                params={"city": "City 7", "limit": 50, "user_token": token},
+            ),
+            "/weather/aggregates": lambda client: client.get(
+                "/weather/aggregates",
+                params={"city": "City 7", "bucket": "1h", "limit": 24,
+                        "user_token": token},
+            ),
+            "/user/telegram_id": lambda client: client.get(
+                "/user/telegram_id", params={"user_token": token}
+            ),
+        }
+
+        with TestClient(app) as client:
+            for name, request in routes.items():
+                response = request(client)
+                if response.status_code != 200:
+                    raise RuntimeError(f"{name}: {response.text}")
+
+            return [
+                {
+                    "route": name,
+                    "latency": measure(lambda: request(client), repeat),
+                }
+                for name, request in routes.items()
+            ]
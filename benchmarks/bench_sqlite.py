@@ -0,0 +1,64 @@
+import os
+import random
+import tempfile
+import time
+from typing import List, Sequence
+
+from benchmarks.common import SEED, chunks, city_names, measure, \
+    synthetic_weather
+from domain import HistoryCursor, User
+from domain_sqlite import SqliteWeatherRepository
+
+CITIES = 100
+USERS = 1000
+
+
+def bench_size(directory: str, rows: int, batch_size: int,
+               repeat: int) -> dict:
+    repository = SqliteWeatherRepository(
+        os.path.join(directory, f"weather-{rows}.db")
+    )
+
+    started = time.perf_counter()
+    for batch in chunks(synthetic_weather(rows, CITIES, USERS), batch_size):
+        repository.save_weathers(batch)
+    insert_seconds = time.perf_counter() - started
+
+    generator = random.Random(SEED)  # nosec B311
+    cities = city_names(CITIES)
+
+    def history_by_city():
+        repository.get_weather_history(50, generator.choice(cities))
+
+    def history_by_user():
+        user = User(generator.randrange(USERS), "")
+        repository.get_weather_history(50, user)
+
+    def history_second_page():
+        city = generator.choice(cities)
+        page = repository.get_weather_history(50, city)
+        repository.get_weather_history(
+            50, city, cursor=HistoryCursor(page[-1].time, page[-1].city)
+        )
+
+    def aggregates_by_hour():
+        repository.get_weather_aggregates(generator.choice(cities), 3600, 24)
+
+    return {
+        "rows": rows,
+        "insert_seconds": insert_seconds,
+        "insert_rows_per_second": rows / insert_seconds,
+        "history_by_city": measure(history_by_city, repeat),
+        "history_by_user": measure(history_by_user, repeat),
+        "history_second_page": measure(history_second_page, repeat),
+        "aggregates_by_hour": measure(aggregates_by_hour, repeat),
+        "lock_waits": repository.stats(),
+    }
+
+
+def run(sizes: Sequence[int], repeat: int = 200,
+        batch_size: int = 10000) -> List[dict]:
+    with tempfile.TemporaryDirectory() as directory:
+        return [
+            bench_size(directory, rows, batch_size, repeat) for rows in sizes
+        ]
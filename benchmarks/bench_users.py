@@ -0,0 +1,59 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence
+
+from benchmarks.common import summarize
+from domain import UserRepository
+from domain_sqlite import SqliteUserRepository
+from domain_wrapper import CachedUserRepository
+
+USERS = 1000
+
+
+def bench_threads(repository: UserRepository, threads: int,
+                  calls_per_thread: int) -> dict:
+    def worker(offset: int) -> List[float]:
+        samples = []
+        for i in range(calls_per_thread):
+            token = f"token-{(offset + i) % USERS}"
+            started = time.perf_counter()
+            repository.get_user(token)
+            samples.append(time.perf_counter() - started)
+        return samples
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(worker, range(0, threads * 97, 97)))
+    elapsed = time.perf_counter() - started
+
+    samples = [sample for result in results for sample in result]
+    return {
+        "threads": threads,
+        "calls_per_second": len(samples) / elapsed,
+        "latency": summarize(samples),
+    }
+
+
+def run(thread_counts: Sequence[int] = (1, 4, 16),
+        calls_per_thread: int = 2000) -> List[dict]:
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite_repository = SqliteUserRepository(
+            os.path.join(directory, "users.db")
+        )
+        for telegram_id in range(USERS):
+            sqlite_repository.save_user(telegram_id, f"token-{telegram_id}")
+
+        repositories = {
+            "SqliteUserRepository": sqlite_repository,
+            "CachedUserRepository": CachedUserRepository(sqlite_repository),
+        }
+
+        results = []
+        for name, repository in repositories.items():
+            for threads in thread_counts:
+                result = bench_threads(repository, threads, calls_per_thread)
+                results.append({"repository": name, **result})
+        results.append({"lock_waits": sqlite_repository.stats()})
+        return results
@@ -0,0 +1,103 @@
+import json
+import platform
+import random
+import subprocess  # nosec B404
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from domain import User, WeatherState
+
+SEED = 20240101
+START = datetime(2024, 1, 1)
+
+
+def percentile(samples: List[float], q: float) -> float:
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def summarize(samples: List[float]) -> dict:
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+def measure(function: Callable[[], object], repeat: int,
+            warmup: int = 10) -> dict:
+    for _ in range(warmup):
+        function()
+
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def city_names(count: int) -> List[str]:
+    return [f"City {i}" for i in range(count)]
+
+
+def synthetic_weather(count: int, cities: int = 100, users: int = 1000,
+                      step_seconds: int = 60) -> \
+        Iterator[Tuple[WeatherState, User]]:
+    generator = random.Random(SEED)  # nosec B311
+    names = city_names(cities)
+    for i in range(count):
+        time_ = START + timedelta(seconds=(i // cities) * step_seconds)
+        yield (
+            WeatherState(
+                time_,
+                names[i % cities],
+                round(generator.uniform(-30, 35), 1),
+                round(generator.uniform(-35, 35), 1),
+                generator.randint(980, 1040),
+                generator.randint(10, 100),
+            ),
+            User(generator.randrange(users), ""),
+        )
+
+
+def chunks(iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(  # nosec B603 B607
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True, text=True, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def environment() -> dict:
+    return {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "started_at": datetime.now().isoformat(),
+    }
+
+
+def write_results(file_name: str, results: dict):
+    with open(file_name, "w") as file:
+        json.dump(results, file, indent=2)
+        file.write("\n")
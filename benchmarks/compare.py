@@ -0,0 +1,50 @@
+import argparse
+import json
+from typing import Dict, Iterator, Tuple
+
+
+def flatten(value, prefix: str = "") -> Iterator[Tuple[str, float]]:
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, f"{prefix}.{key}" if prefix else key)
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            label = next(
+                (f"{item[key]}" for key in ("rows", "path", "route")
+                 if isinstance(item, dict) and key in item),
+                str(i),
+            )
+            if isinstance(item, dict) and "threads" in item:
+                label = f"{item['repository']}[{item['threads']}]"
+            yield from flatten(item, f"{prefix}[{label}]")
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, float(value)
+
+
+def load(file_name: str) -> Dict[str, float]:
+    with open(file_name) as file:
+        return dict(flatten(json.load(file)["benchmarks"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.compare",
+        description="Compare two benchmark result files",
+    )
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--metric", default="p50_ms")
+    args = parser.parse_args()
+
+    baseline = load(args.baseline)
+    candidate = load(args.candidate)
+    for key in sorted(baseline.keys() & candidate.keys()):
+        if not key.endswith(args.metric) or baseline[key] == 0:
+            continue
+        change = candidate[key] / baseline[key] - 1
+        print(f"{change:+8.1%}  {baseline[key]:12.4f} "
+              f"{candidate[key]:12.4f}  {key}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import os
+import random
+from collections import Counter
+from typing import Optional
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+from domain_open_weather_map import GEO_PATH, WEATHER_PATH
+
+UNKNOWN_CITY_PREFIX = "Nowhere"
+
+
+def coordinates(city: str) -> tuple:
+    digest = hashlib.sha256(city.casefold().encode()).digest()
+    lat = int.from_bytes(digest[:4], "big") / 2 ** 32 * 180 - 90
+    lon = int.from_bytes(digest[4:8], "big") / 2 ** 32 * 360 - 180
+    return round(lat, 4), round(lon, 4)
+
+
+class UpstreamSimulator:
+
+    def __init__(
+        self,
+        latency_ms: float = 50,
+        latency_sigma: float = 0.5,
+        error_rate: float = 0,
+        rate_limit_rate: float = 0,
+        seed: Optional[int] = None,
+    ):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.generator = random.Random(seed)  # nosec B311
+        self.requests = Counter()
+
+    async def failure(self, endpoint: str) -> Optional[JSONResponse]:
+        self.requests[endpoint] += 1
+        if self.latency_ms > 0:
+            await asyncio.sleep(
+                self.latency_ms / 1000 *
+                self.generator.lognormvariate(0, self.latency_sigma)
+            )
+
+        roll = self.generator.random()
+        if roll < self.error_rate:
+            self.requests["errors"] += 1
+            return JSONResponse(
+                status_code=500, content={"cod": 500, "message": "Internal"}
+            )
+        if roll < self.error_rate + self.rate_limit_rate:
+            self.requests["rate_limited"] += 1
+            return JSONResponse(
+                status_code=429,
+                content={"cod": 429, "message": "Too many requests"},
+            )
+        return None
+
+    def weather(self, lat: float, lon: float) -> dict:
+        temperature = round(self.generator.gauss(12, 8), 2)
+        return {
+            "coord": {"lat": lat, "lon": lon},
+            "main": {
+                "temp": temperature,
+                "feels_like": round(
+                    temperature - self.generator.random() * 3, 2
+                ),
+                "pressure": self.generator.randint(990, 1030),
+                "humidity": self.generator.randint(20, 100),
+            },
+        }
+
+
+def create_mock_app(simulator: UpstreamSimulator) -> FastAPI:
+    app = FastAPI()
+
+    @app.get(GEO_PATH)
+    async def geo(q: str, appid: str, limit: int = 1):
+        failure = await simulator.failure("geo")
+        if failure is not None:
+            return failure
+        if q.startswith(UNKNOWN_CITY_PREFIX):
+            return []
+
+        lat, lon = coordinates(q)
+        return [{"name": q, "lat": lat, "lon": lon, "country": "ZZ"}]
+
+    @app.get(WEATHER_PATH)
+    async def weather(lat: float, lon: float, appid: str,
+                      units: str = "standard"):
+        failure = await simulator.failure("weather")
+        if failure is not None:
+            return failure
+        return simulator.weather(lat, lon)
+
+    @app.get("/mock/stats")
+    def stats():
+        return dict(simulator.requests)
+
+    return app
+
+
+app = create_mock_app(UpstreamSimulator(
+    latency_ms=float(os.getenv("MOCK_LATENCY_MS", "50")),
+    latency_sigma=float(os.getenv("MOCK_LATENCY_SIGMA", "0.5")),
+    error_rate=float(os.getenv("MOCK_ERROR_RATE", "0")),
+    rate_limit_rate=float(os.getenv("MOCK_RATE_LIMIT_RATE", "0")),
+))
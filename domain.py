@@ -1,11 +1,17 @@
 from abc import ABC, abstractmethod
+from array import array
 from datetime import datetime
-from typing import Optional, Union, List
+from itertools import islice
+from typing import Iterable, Iterator, Optional, Union, List, Sequence, \
+    Tuple
 
 # Entities
 
 
 class WeatherState:
+    __slots__ = (
+        "time", "city", "temperature", "feels_like", "pressure", "humidity"
+    )
 
     def __init__(
         self,
@@ -24,12 +30,151 @@ class WeatherState:
         self.humidity = humidity
 
 
+class WeatherHistory:
+    # Columnar rows: epoch milliseconds, floats and ints in contiguous arrays
+    # and repeated city names shared, instead of a WeatherState per row
+    __slots__ = (
+        "times", "cities", "temperatures", "feels_likes", "pressures",
+        "humidities",
+    )
+
+    def __init__(self):
+        self.times = array("q")
+        self.cities = []
+        self.temperatures = array("d")
+        self.feels_likes = array("d")
+        self.pressures = array("q")
+        self.humidities = array("q")
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple],
+                  chunk_size: int = 1024) -> "WeatherHistory":
+        history = cls()
+        cities = {}
+        rows = iter(rows)
+        while chunk := list(islice(rows, chunk_size)):
+            times, names, temperatures, feels_likes, pressures, \
+                humidities = zip(*chunk)
+            history.times.extend(times)
+            history.cities.extend(
+                cities.setdefault(name, name) for name in names
+            )
+            history.temperatures.extend(temperatures)
+            history.feels_likes.extend(feels_likes)
+            history.pressures.extend(pressures)
+            history.humidities.extend(humidities)
+        return history
+
+    @classmethod
+    def from_states(cls, states: Iterable[WeatherState]) -> "WeatherHistory":
+        return cls.from_rows(
+            (
+                round(weather.time.timestamp() * 1000),
+                weather.city,
+                weather.temperature,
+                weather.feels_like,
+                weather.pressure,
+                weather.humidity,
+            )
+            for weather in states
+        )
+
+    @classmethod
+    def of(cls, history: Sequence[WeatherState]) -> "WeatherHistory":
+        if isinstance(history, cls):
+            return history
+        return cls.from_states(history)
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            history = WeatherHistory()
+            for name in self.__slots__:
+                setattr(history, name, getattr(self, name)[index])
+            return history
+
+        return WeatherState(
+            datetime.fromtimestamp(self.times[index] / 1000),
+            self.cities[index],
+            self.temperatures[index],
+            self.feels_likes[index],
+            self.pressures[index],
+            self.humidities[index],
+        )
+
+    def __iter__(self) -> Iterator[WeatherState]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def timestamps(self) -> Iterator[float]:
+        return (time / 1000 for time in self.times)
+
+    def rows(self) -> Iterator[tuple]:
+        return zip(
+            self.timestamps(),
+            self.cities,
+            self.temperatures,
+            self.feels_likes,
+            self.pressures,
+            self.humidities,
+        )
+
+
+class AggregateValue:
+
+    def __init__(self, min: float, max: float, mean: float, last: float):
+        self.min = min
+        self.max = max
+        self.mean = mean
+        self.last = last
+
+
+class WeatherAggregate:
+
+    def __init__(
+        self,
+        time: datetime,
+        count: int,
+        temperature: AggregateValue,
+        feels_like: AggregateValue,
+        pressure: AggregateValue,
+        humidity: AggregateValue,
+    ):
+        self.time = time
+        self.count = count
+        self.temperature = temperature
+        self.feels_like = feels_like
+        self.pressure = pressure
+        self.humidity = humidity
+
+
+class HistoryCursor:
+
+    def __init__(self, time: datetime, city: str):
+        self.time = time
+        self.city = city
+
+
 class ApiError:
 
     def __init__(self, message: str):
         self.message = message
 
 
+class NotFoundError(ApiError):
+    pass
+
+
+class RateLimitError(ApiError):
+    pass
+
+
+class CircuitOpenError(ApiError):
+    pass
+
+
 class User:
 
     def __init__(
@@ -40,21 +185,69 @@ class User:
         self.telegram_id = telegram_id
         self.token = token
 
+
+def normalize_city(city: str) -> str:
+    return " ".join(city.split()).casefold()
+
+
+def city_not_found(city: str) -> ApiError:
+    return NotFoundError(f"City {city} Not Found")
+
+
 # Services
 
 
 class WeatherRepository(ABC):
 
     @abstractmethod
-    def get_weather_history(self, limit: int,
-                            city_or_user: Union[str, User]) -> \
-            List[WeatherState]:
+    def get_weather_history(
+        self,
+        limit: int,
+        city_or_user: Union[str, User],
+        after: Optional[datetime] = None,
+        before: Optional[datetime] = None,
+        from_time: Optional[datetime] = None,
+        to_time: Optional[datetime] = None,
+        cursor: Optional[HistoryCursor] = None,
+    ) -> WeatherHistory:
         pass
 
     @abstractmethod
-    def save_weather(self, weather_state: WeatherState, user: User):
+    def get_weather_aggregates(
+        self,
+        city_or_user: Union[str, User],
+        bucket_seconds: int,
+        limit: int,
+        **filters,
+    ) -> List[WeatherAggregate]:
         pass
 
+    def iter_weather_history(
+        self,
+        city_or_user: Union[str, User],
+        chunk_size: int = 1000,
+        **filters,
+    ) -> Iterator[WeatherHistory]:
+        cursor = filters.pop("cursor", None)
+        while True:
+            chunk = self.get_weather_history(
+                chunk_size, city_or_user, cursor=cursor, **filters
+            )
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            cursor = HistoryCursor(chunk[-1].time, chunk[-1].city)
+
+    @abstractmethod
+    def save_weather(self, weather_state: WeatherState,
+                     user: Optional[User]):
+        pass
+
+    def save_weathers(self, entries: List[Tuple[WeatherState, User]]):
+        for weather_state, user in entries:
+            self.save_weather(weather_state, user)
+
 
 class WeatherApi(ABC):
 
@@ -63,6 +256,75 @@ class WeatherApi(ABC):
             Union[WeatherState, ApiError]:
         pass
 
+    def get_cached_weather(self, city: str) -> Optional[WeatherState]:
+        return None
+
+    def get_cached_weather_ttl(self, city: str) -> Optional[float]:
+        return None
+
+
+class AsyncWeatherApi(ABC):
+
+    @abstractmethod
+    async def get_weather(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        pass
+
+    def get_cached_weather(self, city: str) -> Optional[WeatherState]:
+        return None
+
+    def get_cached_weather_ttl(self, city: str) -> Optional[float]:
+        return None
+
+    async def aclose(self):
+        pass
+
+
+class GeocodeRepository(ABC):
+
+    @abstractmethod
+    def get_lat_lon(self, city: str) -> \
+            Union[Tuple[float, float], ApiError, None]:
+        pass
+
+    @abstractmethod
+    def save_lat_lon(self, city: str,
+                     lat_lon: Optional[Tuple[float, float]]):
+        pass
+
+
+class WeatherCache(ABC):
+
+    @abstractmethod
+    def get_weather(self, city: str) -> \
+            Tuple[Optional[WeatherState], Optional[float]]:
+        pass
+
+    @abstractmethod
+    def save_weather(self, city: str, weather_state: WeatherState,
+                     ttl_seconds: float):
+        pass
+
+    @abstractmethod
+    def acquire_lease(self, city: str, owner: str,
+                      lease_seconds: float) -> bool:
+        pass
+
+    @abstractmethod
+    def release_lease(self, city: str, owner: str):
+        pass
+
+
+class BackgroundService(ABC):
+
+    @abstractmethod
+    async def start(self):
+        pass
+
+    @abstractmethod
+    async def stop(self):
+        pass
+
 
 class UserRepository(ABC):
 
@@ -82,5 +344,5 @@ class UserLoginRepository(ABC):
         pass
 
     @abstractmethod
-    def delete_user_login(self, token: str) -> bool:
+    def delete_user_login(self, token: str) -> Optional[str]:
         pass
@@ -0,0 +1,265 @@
+import asyncio
+import heapq
+import sys
+import time
+from collections import OrderedDict
+from threading import Event, Lock
+from typing import Any, Awaitable, Callable, Hashable, List, Optional, \
+    Tuple, TypeVar
+
+T = TypeVar("T")
+
+MISSING = object()
+
+
+class _Entry:
+    __slots__ = ("value", "expire_at", "size")
+
+    def __init__(self, value, expire_at: Optional[float], size: int):
+        self.value = value
+        self.expire_at = expire_at
+        self.size = size
+
+
+class TtlLruCache:
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl_seconds: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[Any], int] = sys.getsizeof,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.clock = clock
+
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable, default=None):
+        return self.get_with_ttl(key, default)[0]
+
+    def get_with_ttl(self, key: Hashable, default=None) -> \
+            Tuple[Any, Optional[float]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default, None
+
+            ttl = None
+            if entry.expire_at is not None:
+                ttl = entry.expire_at - self.clock()
+                if ttl <= 0:
+                    self.__remove(key)
+                    self.expirations += 1
+                    self.misses += 1
+                    return default, None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry.value, ttl
+
+    def set(self, key: Hashable, value,
+            ttl_seconds: Optional[float] = None):
+        if ttl_seconds is None:
+            ttl_seconds = self.ttl_seconds
+        now = self.clock()
+        expire_at = now + ttl_seconds if ttl_seconds is not None else None
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+
+        with self.lock:
+            if key in self.entries:
+                self.__remove(key)
+            self.entries[key] = _Entry(value, expire_at, size)
+            self.bytes += size
+            self.__evict(now)
+
+    def ttl(self, key: Hashable) -> Optional[float]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.expire_at is None:
+                return None
+            return entry.expire_at - self.clock()
+
+    def delete(self, key: Hashable) -> bool:
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.__remove(key)
+            return True
+
+    def delete_where(self, predicate: Callable[[Hashable, Any], bool]) -> \
+            int:
+        with self.lock:
+            keys = [
+                key for key, entry in self.entries.items()
+                if predicate(key, entry.value)
+            ]
+            for key in keys:
+                self.__remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def __remove(self, key: Hashable):
+        entry = self.entries.pop(key)
+        self.bytes -= entry.size
+
+    def __evict(self, now: float):
+        # The least recently used entry is the most likely to be expired
+        # already, so drop it first if it is, to keep eviction counts honest
+        if self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if entry.expire_at is not None and now >= entry.expire_at:
+                self.__remove(key)
+                self.expirations += 1
+
+        while len(self.entries) > self.max_size or (
+            self.max_bytes is not None and self.bytes > self.max_bytes
+        ):
+            key = next(iter(self.entries))
+            self.__remove(key)
+            self.evictions += 1
+
+
+class CityPopularity:
+
+    def __init__(
+        self,
+        half_life_seconds: float = 60 * 60,
+        max_cities: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.half_life_seconds = half_life_seconds
+        self.max_cities = max_cities
+        self.clock = clock
+
+        self.lock = Lock()
+        self.scores = {}
+
+    def record(self, city: str, user):
+        now = self.clock()
+        with self.lock:
+            score = self.scores.get(city)
+            value = 1.0 if score is None else self.__decay(score, now) + 1
+            self.scores[city] = (value, now, user)
+
+            if len(self.scores) > 2 * self.max_cities:
+                self.__prune(now)
+
+    def top(self, n: int) -> List[Tuple[str, Any]]:
+        now = self.clock()
+        with self.lock:
+            ranked = heapq.nlargest(
+                n,
+                self.scores.items(),
+                key=lambda item: self.__decay(item[1], now),
+            )
+        return [(city, score[2]) for city, score in ranked]
+
+    def __decay(self, score: Tuple[float, float, Any], now: float) -> float:
+        value, updated_at, _ = score
+        return value * 0.5 ** ((now - updated_at) / self.half_life_seconds)
+
+    def __prune(self, now: float):
+        kept = heapq.nlargest(
+            self.max_cities,
+            self.scores.items(),
+            key=lambda item: self.__decay(item[1], now),
+        )
+        self.scores = dict(kept)
+
+
+class _Call:
+
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def do(self, key: Hashable, function: Callable[[], T]) -> T:
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+        return call.result
+
+
+class AsyncSingleFlight:
+
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+
+    async def do(self, key: Hashable,
+                 function: Callable[[], Awaitable[T]]) -> T:
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(function())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.__forget(key, task))
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(task)
+
+    def __forget(self, key: Hashable, task: asyncio.Future):
+        if self.calls.get(key) is task:
+            del self.calls[key]
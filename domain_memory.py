@@ -1,18 +1,86 @@
-from typing import Optional
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Optional, Tuple, Union
 
-from domain import UserLoginRepository
+from domain import ApiError, GeocodeRepository, UserLoginRepository, \
+    normalize_city, city_not_found
+from domain_cache import MISSING, TtlLruCache
 
 
 class InMemoryUserLoginRepository(UserLoginRepository):
 
-    def __init__(self):
-        self.storage = {}
+    def __init__(self, ttl_seconds: float = 10 * 60,
+                 max_logins: int = 100000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.max_logins = max_logins
+        self.clock = clock
+
+        self.lock = Lock()
+        # Every login lives for the same TTL, so insertion order is also
+        # expiry order and purging only ever looks at the front
+        self.storage = OrderedDict()
+        self.expired = 0
+        self.evicted = 0
 
     def add_user_login(self, token: str, callback_url: str):
-        self.storage[token] = callback_url
+        now = self.clock()
+        with self.lock:
+            self.__purge(now)
+            self.storage.pop(token, None)
+            self.storage[token] = (callback_url, now + self.ttl_seconds)
+            while len(self.storage) > self.max_logins:
+                self.storage.popitem(last=False)
+                self.evicted += 1
 
     def delete_user_login(self, token: str) -> Optional[str]:
-        callback_url = self.storage.get(token)
-        if callback_url is not None:
-            del self.storage[token]
-        return callback_url
+        with self.lock:
+            login = self.storage.pop(token, None)
+        if login is None or login[1] <= self.clock():
+            return None
+        return login[0]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.storage),
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+    def __purge(self, now: float):
+        while self.storage:
+            _, expire_at = next(iter(self.storage.values()))
+            if expire_at > now:
+                return
+            self.storage.popitem(last=False)
+            self.expired += 1
+
+
+class InMemoryGeocodeRepository(GeocodeRepository):
+
+    def __init__(self, max_size: int = 10000,
+                 negative_cache_seconds: float = 24 * 60 * 60,
+                 clock: Callable[[], float] = time.monotonic):
+        self.negative_cache_seconds = negative_cache_seconds
+        self.cache = TtlLruCache(max_size=max_size, clock=clock)
+
+    def get_lat_lon(self, city: str) -> \
+            Union[Tuple[float, float], ApiError, None]:
+        lat_lon = self.cache.get(normalize_city(city), MISSING)
+        if lat_lon is MISSING:
+            return None
+        if lat_lon is None:
+            return city_not_found(city)
+        return lat_lon
+
+    def save_lat_lon(self, city: str,
+                     lat_lon: Optional[Tuple[float, float]]):
+        # Like the SQLite store, a city that was not found is looked up
+        # again once its negative entry expires
+        ttl_seconds = self.negative_cache_seconds if lat_lon is None else None
+        self.cache.set(normalize_city(city), lat_lon, ttl_seconds)
+
+    def stats(self) -> dict:
+        return self.cache.stats()
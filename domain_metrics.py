@@ -0,0 +1,264 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple, Union
+
+from domain import WeatherState
+from domain_trace import span
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10,
+)
+
+LabelValues = Tuple[str, ...]
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"),
+        )
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def hit_ratio(stats: dict) -> float:
+    total = stats["hits"] + stats["misses"]
+    return stats["hits"] / total if total else 0.0
+
+
+class _Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str]):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self._samples()
+
+    @abstractmethod
+    def _samples(self) -> Iterator[str]:
+        pass
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str]):
+        super().__init__(name, help, label_names)
+        self.lock = Lock()
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = \
+                self.values.get(label_values, 0) + amount
+
+    def _samples(self) -> Iterator[str]:
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            labels = format_labels(self.label_names, label_values)
+            yield f"{self.name}{labels} {format_value(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str],
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(buckets)
+        self.lock = Lock()
+        self.values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, seconds: float, *label_values: str):
+        index = bisect_left(self.buckets, seconds)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 2)
+                self.values[label_values] = counts
+            counts[index] += 1
+            counts[-1] += seconds
+
+    def _samples(self) -> Iterator[str]:
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in
+                      self.values.items()]
+        names = self.label_names + ("le",)
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = format_labels(
+                    names, label_values + (format_value(bound),)
+                )
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.label_names, label_values)
+            yield f"{self.name}_sum{labels} {format_value(counts[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str],
+        function: Callable[[], Union[float, Dict[LabelValues, float]]],
+    ):
+        super().__init__(name, help, label_names)
+        self.function = function
+
+    def _samples(self) -> Iterator[str]:
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            labels = format_labels(self.label_names, label_values)
+            yield f"{self.name}{labels} {format_value(value)}"
+
+
+class StatsGauges:
+
+    def __init__(self, prefix: str, help: str,
+                 function: Callable[[], dict]):
+        self.prefix = prefix
+        self.help = help
+        self.function = function
+        self.keys = [
+            key for key, value in function().items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        ]
+
+    def collect(self) -> Iterator[str]:
+        # One call per scrape, so every gauge comes from the same snapshot
+        stats = self.function()
+        for key in self.keys:
+            name = f"{self.prefix}_{key}"
+            yield f"# HELP {name} {self.help} ({key})"
+            yield f"# TYPE {name} gauge"
+            yield f"{name} {format_value(stats[key])}"
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics: Dict[str, Union[_Metric, StatsGauges]] = {}
+
+    def counter(self, name: str, help: str,
+                label_names: Sequence[str] = ()) -> Counter:
+        return self.__register(name, lambda: Counter(name, help, label_names))
+
+    def histogram(self, name: str, help: str,
+                  label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.__register(
+            name, lambda: Histogram(name, help, label_names, buckets)
+        )
+
+    def gauge(self, name: str, help: str,
+              function: Callable[[], Union[float, Dict[LabelValues, float]]],
+              label_names: Sequence[str] = ()) -> Gauge:
+        return self.__register(
+            name, lambda: Gauge(name, help, label_names, function)
+        )
+
+    def stats(self, prefix: str, help: str,
+              function: Callable[[], dict]) -> StatsGauges:
+        return self.__register(
+            prefix, lambda: StatsGauges(prefix, help, function)
+        )
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+    def __register(self, name: str,
+                   factory: Callable[[], Union[_Metric, StatsGauges]]):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = factory()
+                self.metrics[name] = metric
+            return metric
+
+
+def weather_results(metrics: MetricsRegistry) -> Counter:
+    return metrics.counter(
+        "weather_api_results_total",
+        "Weather API results per layer and outcome",
+        ("layer", "result"),
+    )
+
+
+def weather_result(weather) -> str:
+    if isinstance(weather, WeatherState):
+        return "ok"
+    if weather is None:
+        return "invalid"
+    return type(weather).__name__
+
+
+class LayerTimer:
+
+    def __init__(self, metrics: MetricsRegistry, layer: str):
+        self.layer = layer
+        self.latency = metrics.histogram(
+            "layer_duration_seconds",
+            "Time spent inside each wrapped layer",
+            ("layer", "method"),
+        )
+        self.exceptions = metrics.counter(
+            "layer_exceptions_total",
+            "Exceptions raised by each wrapped layer",
+            ("layer", "method"),
+        )
+
+    def call(self, method: str, function: Callable, *args, **kwargs):
+        started = perf_counter()
+        try:
+            with span(f"{self.layer}.{method}"):
+                return function(*args, **kwargs)
+        except Exception:
+            self.exceptions.inc(self.layer, method)
+            raise
+        finally:
+            self.latency.observe(perf_counter() - started, self.layer, method)
+
+    async def call_async(self, method: str, function: Callable,
+                         *args, **kwargs):
+        started = perf_counter()
+        try:
+            with span(f"{self.layer}.{method}"):
+                return await function(*args, **kwargs)
+        except Exception:
+            self.exceptions.inc(self.layer, method)
+            raise
+        finally:
+            self.latency.observe(perf_counter() - started, self.layer, method)
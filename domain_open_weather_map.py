@@ -1,16 +1,80 @@
+import asyncio
 from datetime import datetime
-from typing import Tuple, Union
+from typing import Any, Callable, Optional, Tuple, Union
 
+import httpx
 import requests
 
-from domain import ApiError, WeatherApi, WeatherState, User
+from domain import ApiError, AsyncWeatherApi, GeocodeRepository, \
+    RateLimitError, WeatherApi, WeatherState, User, city_not_found
+from domain_memory import InMemoryGeocodeRepository
+from domain_rate_limit import AsyncRateLimiter, RateLimiter
+
+BASE_URL = "https://api.openweathermap.org"
+GEO_PATH = "/geo/1.0/direct"
+WEATHER_PATH = "/data/2.5/weather"
+TIMEOUT = 3
+
+
+def geo_params(token: str, city: str) -> dict:
+    return {"q": city, "limit": 1, "appid": token}
+
+
+def weather_params(token: str, lat_lon: Tuple[float, float]) -> dict:
+    return {
+        "lat": lat_lon[0],
+        "lon": lat_lon[1],
+        "appid": token,
+        "units": "metric",
+    }
+
+
+def parse_lat_lon(json) -> Optional[Tuple[float, float]]:
+    if len(json) == 0:
+        return None
+    data = json[0]
+    return (data["lat"], data["lon"])
+
+
+def parse_weather(city: str, json) -> WeatherState:
+    data = json["main"]
+    return WeatherState(
+        datetime.now(),
+        city,
+        data["temp"],
+        data["feels_like"],
+        data["pressure"],
+        data["humidity"],
+    )
+
+
+def parse_response(response, parse: Callable[[Any], Any]):
+    if response.status_code == 429:
+        return RateLimitError("Upstream rate limit exceeded")
+    if response.status_code != 200:
+        return ApiError(f"Upstream returned {response.status_code}")
+    try:
+        return parse(response.json())
+    except (KeyError, IndexError, TypeError, ValueError):
+        return ApiError("Malformed upstream response")
+
+
+def budget_exhausted() -> RateLimitError:
+    return RateLimitError("Upstream request budget exhausted")
 
 
 class OpenWeatherMapApi(WeatherApi):
 
-    def __init__(self, token: str):
+    def __init__(self, token: str,
+                 geocode_repository: Optional[GeocodeRepository] = None,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 base_url: str = BASE_URL):
         self.token = token
-        self.city_to_lat_lon = {}
+        self.base_url = base_url
+        if geocode_repository is None:
+            geocode_repository = InMemoryGeocodeRepository()
+        self.geocode_repository = geocode_repository
+        self.rate_limiter = rate_limiter
 
     def get_weather(self, city: str, user: User) -> \
             Union[WeatherState, ApiError]:
@@ -18,43 +82,111 @@ class OpenWeatherMapApi(WeatherApi):
         if isinstance(lat_lon, ApiError):
             return lat_lon
 
+        response = self.__get(
+            WEATHER_PATH, weather_params(self.token, lat_lon)
+        )
+        if isinstance(response, ApiError):
+            return response
+
+        return parse_response(response, lambda json: parse_weather(city, json))
+
+    def __get(self, path: str, params: dict):
+        if self.rate_limiter is not None and not self.rate_limiter.acquire():
+            return budget_exhausted()
         try:
-            response = requests.get(
-                "https://api.openweathermap.org/data/2.5/weather",
-                params={
-                    "lat": lat_lon[0],
-                    "lon": lat_lon[1],
-                    "appid": self.token,
-                    "units": "metric",
-                },
-                timeout=3,
+            return requests.get(
+                self.base_url + path, params=params, timeout=TIMEOUT
             )
         except requests.exceptions.RequestException as e:
             return ApiError(str(e))
 
-        data = response.json()["main"]
-        return WeatherState(
-            datetime.now(),
-            city,
-            data["temp"],
-            data["feels_like"],
-            data["pressure"],
-            data["humidity"],
-        )
-
-    def __get_lat_lon(self, city: str) -> Tuple[int, int]:
-        lat_lon = self.city_to_lat_lon.get(city)
+    def __get_lat_lon(self, city: str) -> \
+            Union[Tuple[float, float], ApiError]:
+        lat_lon = self.geocode_repository.get_lat_lon(city)
         if lat_lon is not None:
             return lat_lon
 
-        try:
-            response = requests.get(
-                "http://api.openweathermap.org/geo/1.0/direct",
-                params={"q": city, "limit": 1, "appid": self.token},
-                timeout=3,
+        response = self.__get(GEO_PATH, geo_params(self.token, city))
+        if isinstance(response, ApiError):
+            return response
+
+        lat_lon = parse_response(response, parse_lat_lon)
+        if isinstance(lat_lon, ApiError):
+            return lat_lon
+        self.geocode_repository.save_lat_lon(city, lat_lon)
+        return lat_lon if lat_lon is not None else city_not_found(city)
+
+
+class AsyncOpenWeatherMapApi(AsyncWeatherApi):
+
+    def __init__(
+        self,
+        token: str,
+        client: Optional[httpx.AsyncClient] = None,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        geocode_repository: Optional[GeocodeRepository] = None,
+        rate_limiter: Optional[AsyncRateLimiter] = None,
+        base_url: str = BASE_URL,
+    ):
+        self.token = token
+        self.base_url = base_url
+        if geocode_repository is None:
+            geocode_repository = InMemoryGeocodeRepository()
+        self.geocode_repository = geocode_repository
+        self.rate_limiter = rate_limiter
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive_connections,
+                ),
             )
-        except requests.exceptions.RequestException as e:
+        self.client = client
+
+    async def get_weather(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        lat_lon = await self.__get_lat_lon(city)
+        if isinstance(lat_lon, ApiError):
+            return lat_lon
+
+        response = await self.__get(
+            WEATHER_PATH, weather_params(self.token, lat_lon)
+        )
+        if isinstance(response, ApiError):
+            return response
+
+        return parse_response(response, lambda json: parse_weather(city, json))
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def __get(self, path: str, params: dict):
+        if self.rate_limiter is not None and \
+                not await self.rate_limiter.acquire():
+            return budget_exhausted()
+        try:
+            return await self.client.get(self.base_url + path, params=params)
+        except httpx.HTTPError as e:
             return ApiError(str(e))
 
-        data = response.json()[0]
-        return (data["lat"], data["lon"])
+    async def __get_lat_lon(self, city: str) -> \
+            Union[Tuple[float, float], ApiError]:
+        lat_lon = await asyncio.to_thread(
+            self.geocode_repository.get_lat_lon, city
+        )
+        if lat_lon is not None:
+            return lat_lon
+
+        response = await self.__get(GEO_PATH, geo_params(self.token, city))
+        if isinstance(response, ApiError):
+            return response
+
+        lat_lon = parse_response(response, parse_lat_lon)
+        if isinstance(lat_lon, ApiError):
+            return lat_lon
+        await asyncio.to_thread(
+            self.geocode_repository.save_lat_lon, city, lat_lon
+        )
+        return lat_lon if lat_lon is not None else city_not_found(city)
@@ -0,0 +1,106 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Callable, Optional, Union
+
+from domain import BackgroundService, User, WeatherState
+from domain_wrapper import AsyncCachedWeatherApi, CachedWeatherApi
+
+
+class PrefetchScheduler(BackgroundService):
+
+    def __init__(
+        self,
+        cached_api: Union[CachedWeatherApi, AsyncCachedWeatherApi],
+        top_n: int = 50,
+        refresh_ahead_seconds: float = 60,
+        jitter_seconds: float = 30,
+        budget_per_minute: int = 30,
+        interval_seconds: float = 5,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if cached_api.popularity is None:
+            raise ValueError("cached_api must be created with popularity")
+
+        self.cached_api = cached_api
+        self.top_n = top_n
+        self.refresh_ahead_seconds = refresh_ahead_seconds
+        self.jitter_seconds = jitter_seconds
+        self.budget_per_minute = budget_per_minute
+        self.interval_seconds = interval_seconds
+        self.clock = clock
+
+        self.spent = deque()
+        self.task: Optional[asyncio.Task] = None
+
+        self.prefetched = 0
+        self.failed = 0
+        self.skipped_over_budget = 0
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def run(self):
+        while True:
+            await self.tick()
+            await asyncio.sleep(self.interval_seconds)
+
+    async def tick(self):
+        due = []
+        for city, user in self.cached_api.popularity.top(self.top_n):
+            if not self.__is_due(city):
+                continue
+            if not self.__take_budget():
+                self.skipped_over_budget += 1
+                break
+            due.append(self.__refresh(city, user))
+
+        await asyncio.gather(*due)
+
+    def __is_due(self, city: str) -> bool:
+        # Only live entries are refreshed ahead of expiry. A city without
+        # one never resolved or keeps failing, and retrying it every tick
+        # would spend the budget the hot cities need
+        ttl = self.cached_api.cache.ttl(city)
+        if ttl is None or ttl <= 0:
+            return False
+        fresh_seconds = ttl - self.cached_api.stale_seconds
+        jitter = random.uniform(0, self.jitter_seconds)  # nosec B311
+        return fresh_seconds <= self.refresh_ahead_seconds + jitter
+
+    def __take_budget(self) -> bool:
+        now = self.clock()
+        while self.spent and now - self.spent[0] >= 60:
+            self.spent.popleft()
+        if len(self.spent) >= self.budget_per_minute:
+            return False
+        self.spent.append(now)
+        return True
+
+    async def __refresh(self, city: str, user: User):
+        try:
+            if isinstance(self.cached_api, AsyncCachedWeatherApi):
+                weather = await self.cached_api.refresh(city, user)
+            else:
+                weather = await asyncio.to_thread(
+                    self.cached_api.refresh, city, user
+                )
+        except Exception:
+            weather = None
+
+        if isinstance(weather, WeatherState):
+            self.prefetched += 1
+        else:
+            self.failed += 1
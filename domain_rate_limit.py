@@ -0,0 +1,182 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Condition
+from typing import Callable, Iterator, Optional, Tuple
+
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 1
+
+_priority = ContextVar("upstream_priority", default=PRIORITY_USER)
+
+
+@contextmanager
+def upstream_priority(priority: int) -> Iterator[None]:
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+class _PriorityTokenBucket:
+
+    def __init__(
+        self,
+        rate_per_second: float,
+        burst: int,
+        max_wait_seconds: float,
+        clock: Callable[[], float],
+    ):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.max_wait_seconds = max_wait_seconds
+        self.clock = clock
+
+        self.available = float(burst)
+        self.updated_at = clock()
+        self.waiters = []
+        self.sequence = itertools.count()
+
+        self.acquired = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.max_wait_observed = 0.0
+
+    @property
+    def tokens(self) -> float:
+        # Read-only, so a stats scrape from another thread cannot race the
+        # refill and take of an acquire
+        elapsed = self.clock() - self.updated_at
+        return min(self.burst,
+                   self.available + elapsed * self.rate_per_second)
+
+    def stats(self) -> dict:
+        return {
+            "tokens": self.tokens,
+            "queue_depth": len(self.waiters),
+            "acquired": self.acquired,
+            "rejected": self.rejected,
+            "wait_seconds": self.wait_seconds,
+            "max_wait_seconds": self.max_wait_observed,
+        }
+
+    def _refill(self):
+        now = self.clock()
+        self.available = min(
+            self.burst,
+            self.available + (now - self.updated_at) * self.rate_per_second
+        )
+        self.updated_at = now
+
+    def _enqueue(self) -> Optional[Tuple[int, int, float]]:
+        self._refill()
+        priority = current_priority()
+        ahead = sum(1 for waiter in self.waiters if waiter[0] <= priority)
+        expected_wait = (ahead + 1 - self.available) / self.rate_per_second
+        if expected_wait > self.max_wait_seconds:
+            self.rejected += 1
+            return None
+
+        entry = (priority, next(self.sequence), self.clock())
+        heapq.heappush(self.waiters, entry)
+        return entry
+
+    def _try_take(self, entry: Tuple[int, int, float]) -> bool:
+        self._refill()
+        if self.waiters[0] is not entry or self.available < 1:
+            return False
+
+        heapq.heappop(self.waiters)
+        self.available -= 1
+        waited = self.clock() - entry[2]
+        self.acquired += 1
+        self.wait_seconds += waited
+        self.max_wait_observed = max(self.max_wait_observed, waited)
+        return True
+
+    def _next_wait(self, entry: Tuple[int, int, float]) -> float:
+        remaining = entry[2] + self.max_wait_seconds - self.clock()
+        if remaining <= 0:
+            return 0
+        until_token = (1 - self.available) / self.rate_per_second
+        return min(remaining, max(until_token, 0.001))
+
+    def _abandon(self, entry: Tuple[int, int, float]):
+        if entry in self.waiters:
+            self.waiters.remove(entry)
+            heapq.heapify(self.waiters)
+        self.rejected += 1
+
+
+class RateLimiter(_PriorityTokenBucket):
+
+    def __init__(
+        self,
+        rate_per_second: float,
+        burst: int,
+        max_wait_seconds: float = 1,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        super().__init__(rate_per_second, burst, max_wait_seconds, clock)
+        self.condition = Condition()
+
+    def acquire(self) -> bool:
+        with self.condition:
+            entry = self._enqueue()
+            if entry is None:
+                return False
+
+            try:
+                while not self._try_take(entry):
+                    wait = self._next_wait(entry)
+                    if wait <= 0:
+                        self._abandon(entry)
+                        return False
+                    self.condition.wait(wait)
+                return True
+            finally:
+                self.condition.notify_all()
+
+
+class AsyncRateLimiter(_PriorityTokenBucket):
+
+    def __init__(
+        self,
+        rate_per_second: float,
+        burst: int,
+        max_wait_seconds: float = 1,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        super().__init__(rate_per_second, burst, max_wait_seconds, clock)
+        self.changed = asyncio.Event()
+
+    async def acquire(self) -> bool:
+        entry = self._enqueue()
+        if entry is None:
+            return False
+
+        try:
+            while not self._try_take(entry):
+                wait = self._next_wait(entry)
+                if wait <= 0:
+                    self._abandon(entry)
+                    return False
+                self.changed.clear()
+                try:
+                    await asyncio.wait_for(self.changed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            return True
+        except asyncio.CancelledError:
+            self._abandon(entry)
+            raise
+        finally:
+            self.changed.set()
@@ -0,0 +1,126 @@
+import time
+from collections import deque
+from threading import Lock
+from typing import Callable, Optional
+
+from domain import NotFoundError, RateLimitError, WeatherState
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def is_upstream_failure(weather) -> bool:
+    return not isinstance(
+        weather, (WeatherState, NotFoundError, RateLimitError)
+    )
+
+
+class CircuitBreaker:
+
+    def __init__(
+        self,
+        window_size: int = 20,
+        min_calls: int = 10,
+        failure_rate: float = 0.5,
+        slow_call_seconds: float = 2,
+        slow_call_rate: float = 0.5,
+        open_seconds: float = 30,
+        half_open_calls: int = 1,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.clock = clock
+
+        self.lock = Lock()
+        self.outcomes = deque(maxlen=window_size)
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probes = 0
+
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == OPEN:
+                if self.clock() - self.opened_at < self.open_seconds:
+                    self.rejected += 1
+                    return False
+                self.state = HALF_OPEN
+                self.probes = 0
+
+            if self.state == HALF_OPEN:
+                if self.probes >= self.half_open_calls:
+                    self.rejected += 1
+                    return False
+                self.probes += 1
+            return True
+
+    def record(self, failed: bool, seconds: float):
+        slow = seconds >= self.slow_call_seconds
+        with self.lock:
+            if self.state == HALF_OPEN:
+                if failed or slow:
+                    self.__open()
+                else:
+                    self.state = CLOSED
+                    self.outcomes.clear()
+                return
+
+            if self.state == OPEN:
+                return
+
+            self.outcomes.append((failed, slow))
+            if len(self.outcomes) < self.min_calls:
+                return
+            failures = sum(1 for failed, _ in self.outcomes if failed)
+            slow_calls = sum(1 for _, slow in self.outcomes if slow)
+            if failures >= self.failure_rate * len(self.outcomes) or \
+                    slow_calls >= self.slow_call_rate * len(self.outcomes):
+                self.__open()
+
+    def release(self):
+        with self.lock:
+            if self.state == HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "state": self.state,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+    def __open(self):
+        self.state = OPEN
+        self.opened_at = self.clock()
+        self.opened += 1
+        self.outcomes.clear()
+
+
+class LatencyWindow:
+
+    def __init__(self, size: int = 100):
+        self.lock = Lock()
+        self.samples = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def record(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
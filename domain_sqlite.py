@@ -1,119 +1,458 @@
 import sqlite3
+import time
+from contextlib import contextmanager
 from datetime import datetime
-from threading import RLock
-from typing import Optional, List, Union
+from queue import Queue
+from threading import Lock
+from typing import Callable, Iterator, Optional, List, Tuple, Union
 
-from domain import WeatherRepository, WeatherState, User, UserRepository
+from domain import AggregateValue, ApiError, GeocodeRepository, \
+    HistoryCursor, WeatherAggregate, WeatherCache, WeatherHistory, \
+    WeatherRepository, WeatherState, User, UserLoginRepository, \
+    UserRepository, normalize_city, city_not_found
+from domain_trace import record_statement, span
 
 
-class SqliteWeatherRepository(WeatherRepository):
+# Migrations
+# Each migration is a list of statements applied in one transaction. The
+# number of applied migrations is kept in PRAGMA user_version, so append
+# new migrations and never edit the ones that have shipped.
 
-    def __init__(self, file_name: str):
-        self.lock = RLock()
-
-        self.connection = sqlite3.connect(file_name, check_same_thread=False)
-        self.cursor = self.connection.cursor()
-        self.cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS weather(
-                time INTEGER,
-                city TEXT,
-                temperature REAL,
-                feels_like REAL,
-                pressure INT,
-                humidity INT,
-                telegram_id INT,
-                PRIMARY KEY (time, city)
-            )
-            """
+WEATHER_MIGRATIONS = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS weather(
+            time INTEGER,
+            city TEXT,
+            temperature REAL,
+            feels_like REAL,
+            pressure INT,
+            humidity INT,
+            telegram_id INT,
+            PRIMARY KEY (time, city)
         )
-        self.connection.commit()
+        """,
+    ],
+    [
+        """
+        CREATE INDEX IF NOT EXISTS weather_telegram_id_time
+        ON weather(telegram_id, time DESC)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS weather_city_time
+        ON weather(city, time DESC)
+        """,
+    ],
+    [
+        """
+        CREATE TABLE weather_new(
+            time INTEGER,
+            city TEXT,
+            temperature REAL,
+            feels_like REAL,
+            pressure INT,
+            humidity INT,
+            telegram_id INT,
+            PRIMARY KEY (city, time)
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT INTO weather_new(time, city, temperature, feels_like,
+                                pressure, humidity, telegram_id)
+        SELECT time, city, temperature, feels_like, pressure, humidity,
+               telegram_id
+        FROM weather
+        """,
+        "DROP TABLE weather",
+        "ALTER TABLE weather_new RENAME TO weather",
+        """
+        CREATE INDEX weather_telegram_id_time
+        ON weather(telegram_id, time DESC)
+        """,
+    ],
+]
 
-    def get_weather_history(self, limit: int,
-                            city_or_user: Union[str, User]) -> \
-            List[WeatherState]:
-        with self.lock:
-            if isinstance(city_or_user, User):
-                sql = """
-                    SELECT time, city, temperature, feels_like, pressure,
-                           humidity
-                    FROM weather
-                    WHERE telegram_id = ?
-                    ORDER BY time DESC
-                    LIMIT ?
-                """
-                args = (city_or_user.telegram_id, limit)
+USER_MIGRATIONS = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS users(
+            telegram_id INTEGER,
+            token TEXT UNIQUE,
+            PRIMARY KEY (telegram_id)
+        )
+        """,
+    ],
+]
+
+USER_LOGIN_MIGRATIONS = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS user_logins(
+            token TEXT,
+            callback_url TEXT,
+            expire_at REAL,
+            PRIMARY KEY (token)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS user_logins_expire_at
+        ON user_logins(expire_at)
+        """,
+    ],
+]
+
+GEOCODE_MIGRATIONS = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS geocode(
+            city TEXT,
+            lat REAL,
+            lon REAL,
+            updated_at INTEGER,
+            PRIMARY KEY (city)
+        )
+        """,
+    ],
+]
+
+WEATHER_CACHE_MIGRATIONS = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS weather_cache(
+            city TEXT,
+            time INTEGER,
+            temperature REAL,
+            feels_like REAL,
+            pressure INT,
+            humidity INT,
+            expire_at REAL,
+            PRIMARY KEY (city)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS weather_cache_leases(
+            city TEXT,
+            owner TEXT,
+            expire_at REAL,
+            PRIMARY KEY (city)
+        ) WITHOUT ROWID
+        """,
+    ],
+]
+
+
+def migrate(connection: sqlite3.Connection, migrations: List[List[str]]):
+    while True:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(migrations):
+                connection.rollback()
+                return
+
+            for statement in migrations[version]:
+                connection.execute(statement)
+            connection.execute(f"PRAGMA user_version = {version + 1}")
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+
+def to_millis(time: datetime) -> int:
+    return round(time.timestamp() * 1000)
+
+
+def history_conditions(
+    city_or_user: Union[str, User],
+    after: Optional[datetime] = None,
+    before: Optional[datetime] = None,
+    from_time: Optional[datetime] = None,
+    to_time: Optional[datetime] = None,
+) -> Tuple[List[str], list]:
+    if isinstance(city_or_user, User):
+        clauses = ["telegram_id = ?"]
+        args = [city_or_user.telegram_id]
+    else:
+        clauses = ["city = ?"]
+        args = [city_or_user]
+
+    for operator, bound in ((">", after), ("<", before),
+                            (">=", from_time), ("<=", to_time)):
+        if bound is not None:
+            clauses.append(f"time {operator} ?")
+            args.append(to_millis(bound))
+
+    return clauses, args
+
+
+def history_query(
+    limit: int,
+    city_or_user: Union[str, User],
+    after: Optional[datetime] = None,
+    before: Optional[datetime] = None,
+    from_time: Optional[datetime] = None,
+    to_time: Optional[datetime] = None,
+    cursor: Optional[HistoryCursor] = None,
+) -> Tuple[str, tuple]:
+    clauses, args = history_conditions(
+        city_or_user, after, before, from_time, to_time
+    )
+
+    # Rows are ordered by (time DESC, city ASC), so the page after a cursor
+    # holds older rows and rows of the same millisecond with a later city
+    if cursor is not None:
+        cursor_time = to_millis(cursor.time)
+        clauses.append("time <= ?")
+        clauses.append("(time < ? OR (time = ? AND city > ?))")
+        args.extend([cursor_time, cursor_time, cursor_time, cursor.city])
+
+    sql = f"""
+        SELECT time, city, temperature, feels_like, pressure,
+               humidity
+        FROM weather
+        WHERE {" AND ".join(clauses)}
+        ORDER BY time DESC, city ASC
+        LIMIT ?
+    """  # nosec B608
+    args.append(limit)
+    return sql, tuple(args)
+
+
+AGGREGATED_COLUMNS = ["temperature", "feels_like", "pressure", "humidity"]
+
+
+def aggregates_query(
+    city_or_user: Union[str, User],
+    bucket_seconds: int,
+    limit: int,
+    **filters,
+) -> Tuple[str, tuple]:
+    clauses, args = history_conditions(city_or_user, **filters)
+    bucket_millis = bucket_seconds * 1000
+
+    last_values = ", ".join(
+        f"FIRST_VALUE({column}) OVER bucket AS last_{column}"
+        for column in AGGREGATED_COLUMNS
+    )
+    aggregates = ", ".join(
+        f"MIN({column}), MAX({column}), AVG({column}), MAX(last_{column})"
+        for column in AGGREGATED_COLUMNS
+    )
+    sql = f"""
+        SELECT bucket, COUNT(*), {aggregates}
+        FROM (
+            SELECT time / ? AS bucket, {", ".join(AGGREGATED_COLUMNS)},
+                   {last_values}
+            FROM weather
+            WHERE {" AND ".join(clauses)}
+            WINDOW bucket AS (PARTITION BY time / ? ORDER BY time DESC)
+        )
+        GROUP BY bucket
+        ORDER BY bucket DESC
+        LIMIT ?
+    """  # nosec B608
+    return sql, (bucket_millis, *args, bucket_millis, limit)
+
+
+class SqliteConnectionPool:
+
+    def __init__(self, file_name: str, readers: int = 4,
+                 busy_timeout_ms: int = 5000):
+        self.file_name = file_name
+        self.busy_timeout_ms = busy_timeout_ms
+
+        self.write_lock = Lock()
+        self.writer = self.__connect()
+        self.writer.execute("PRAGMA journal_mode=WAL")
+
+        # Every connection to ":memory:" is a separate database, so reads
+        # have to share the writer there
+        if file_name == ":memory:":
+            readers = 0
+        self.reader_count = readers
+        self.readers = Queue()
+        for _ in range(readers):
+            self.readers.put(self.__connect())
+
+        self.stats_lock = Lock()
+        self.write_waits = 0
+        self.write_wait_seconds = 0.0
+        self.read_waits = 0
+        self.read_wait_seconds = 0.0
+
+    @contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        with span("sqlite.write") as attributes:
+            start = time.perf_counter()
+            with self.write_lock:
+                wait = time.perf_counter() - start
+                self.__record_wait(True, wait)
+                attributes["wait_ms"] = round(wait * 1000, 3)
+                yield self.writer
+
+    @contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        if self.reader_count == 0:
+            with self.write() as connection:
+                yield connection
+            return
+
+        with span("sqlite.read") as attributes:
+            start = time.perf_counter()
+            connection = self.readers.get()
+            wait = time.perf_counter() - start
+            self.__record_wait(False, wait)
+            attributes["wait_ms"] = round(wait * 1000, 3)
+            try:
+                yield connection
+            finally:
+                self.readers.put(connection)
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            return {
+                "write_waits": self.write_waits,
+                "write_wait_seconds": self.write_wait_seconds,
+                "read_waits": self.read_waits,
+                "read_wait_seconds": self.read_wait_seconds,
+            }
+
+    def __connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.file_name,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+        )
+        connection.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA temp_store=MEMORY")
+        connection.execute("PRAGMA cache_size=-8000")
+        connection.set_trace_callback(record_statement)
+        return connection
+
+    def __record_wait(self, write: bool, seconds: float):
+        with self.stats_lock:
+            if write:
+                self.write_waits += 1
+                self.write_wait_seconds += seconds
             else:
-                sql = """
-                    SELECT time, city, temperature, feels_like, pressure,
-                           humidity
-                    FROM weather
-                    WHERE city = ?
-                    ORDER BY time DESC
-                    LIMIT ?
-                """
-                args = (city_or_user, limit)
-
-            result = self.cursor.execute(sql, args)
-
-            states = []
-            for row in result:
-                states.append(
-                    WeatherState(
-                        datetime.fromtimestamp(row[0] / 1000),
-                        row[1],
-                        row[2],
-                        row[3],
-                        row[4],
-                        row[5],
-                    )
+                self.read_waits += 1
+                self.read_wait_seconds += seconds
+
+
+class SqliteWeatherRepository(WeatherRepository):
+
+    def __init__(self, file_name: str, readers: int = 4,
+                 busy_timeout_ms: int = 5000):
+        self.pool = SqliteConnectionPool(file_name, readers, busy_timeout_ms)
+
+        with self.pool.write() as connection:
+            migrate(connection, WEATHER_MIGRATIONS)
+
+    def get_weather_history(
+        self,
+        limit: int,
+        city_or_user: Union[str, User],
+        after: Optional[datetime] = None,
+        before: Optional[datetime] = None,
+        from_time: Optional[datetime] = None,
+        to_time: Optional[datetime] = None,
+        cursor: Optional[HistoryCursor] = None,
+    ) -> WeatherHistory:
+        sql, args = history_query(
+            limit, city_or_user, after, before, from_time, to_time, cursor
+        )
+
+        with self.pool.read() as connection:
+            return WeatherHistory.from_rows(connection.execute(sql, args))
+
+    def get_weather_aggregates(
+        self,
+        city_or_user: Union[str, User],
+        bucket_seconds: int,
+        limit: int,
+        **filters,
+    ) -> List[WeatherAggregate]:
+        sql, args = aggregates_query(
+            city_or_user, bucket_seconds, limit, **filters
+        )
+
+        with self.pool.read() as connection:
+            rows = connection.execute(sql, args).fetchall()
+
+        aggregates = []
+        for row in reversed(rows):
+            values = [
+                AggregateValue(*row[index:index + 4])
+                for index in range(2, 2 + 4 * len(AGGREGATED_COLUMNS), 4)
+            ]
+            aggregates.append(
+                WeatherAggregate(
+                    datetime.fromtimestamp(row[0] * bucket_seconds),
+                    row[1],
+                    *values,
                 )
+            )
 
-            return states
+        return aggregates
 
-    def save_weather(self, weather_state: WeatherState, user: User):
-        with self.lock:
-            self.cursor.execute(
+    def save_weather(self, weather_state: WeatherState,
+                     user: Optional[User]):
+        with self.pool.write() as connection:
+            connection.execute(
                 """
                     INSERT INTO weather(time, city, temperature,
                                         feels_like, pressure, humidity,
                                         telegram_id)
                     VALUES (?, ?, ?, ?, ?, ?, ?)
                 """,
-                (
-                    round(weather_state.time.timestamp() * 1000),
-                    weather_state.city,
-                    weather_state.temperature,
-                    weather_state.feels_like,
-                    weather_state.pressure,
-                    weather_state.humidity,
-                    user.telegram_id
-                ),
+                weather_row(weather_state, user),
+            )
+            connection.commit()
+
+    def save_weathers(self, entries: List[Tuple[WeatherState, User]]):
+        with self.pool.write() as connection:
+            connection.executemany(
+                """
+                    INSERT OR IGNORE INTO weather(time, city, temperature,
+                                                  feels_like, pressure,
+                                                  humidity, telegram_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                [weather_row(weather, user) for weather, user in entries],
             )
-            self.connection.commit()
+            connection.commit()
+
+    def stats(self) -> dict:
+        return self.pool.stats()
+
+
+def weather_row(weather_state: WeatherState,
+                user: Optional[User]) -> tuple:
+    return (
+        to_millis(weather_state.time),
+        weather_state.city,
+        weather_state.temperature,
+        weather_state.feels_like,
+        weather_state.pressure,
+        weather_state.humidity,
+        user.telegram_id if user is not None else None
+    )
 
 
 class SqliteUserRepository(UserRepository):
 
-    def __init__(self, file_name: str):
-        self.lock = RLock()
-
-        self.connection = sqlite3.connect(file_name, check_same_thread=False)
-        self.cursor = self.connection.cursor()
-        self.cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users(
-                telegram_id INTEGER,
-                token TEXT UNIQUE,
-                PRIMARY KEY (telegram_id)
-            )
-        """
-        )
-        self.connection.commit()
+    def __init__(self, file_name: str, readers: int = 4,
+                 busy_timeout_ms: int = 5000):
+        self.pool = SqliteConnectionPool(file_name, readers, busy_timeout_ms)
+
+        with self.pool.write() as connection:
+            migrate(connection, USER_MIGRATIONS)
 
     def get_user(self, token: str) -> Optional[User]:
-        with self.lock:
-            result = self.cursor.execute(
+        with self.pool.read() as connection:
+            result = connection.execute(
                 """
                     SELECT telegram_id
                     FROM users
@@ -122,21 +461,290 @@ class SqliteUserRepository(UserRepository):
                 (token,),
             ).fetchone()
 
-            if result is not None:
-                return User(
-                    result[0],
-                    token,
-                )
+        if result is not None:
+            return User(
+                result[0],
+                token,
+            )
 
-            return None
+        return None
 
     def save_user(self, telegram_id: int, token: str):
-        with self.lock:
-            self.cursor.execute(
+        with self.pool.write() as connection:
+            connection.execute(
                 """
                     INSERT OR REPLACE INTO users(telegram_id, token)
                     VALUES(?, ?)
                 """,
                 (telegram_id, token),
             )
-            self.connection.commit()
+            connection.commit()
+
+    def stats(self) -> dict:
+        return self.pool.stats()
+
+
+class SqliteUserLoginRepository(UserLoginRepository):
+
+    def __init__(self, file_name: str, ttl_seconds: float = 10 * 60,
+                 max_logins: int = 100000, purge_every: int = 100,
+                 readers: int = 1, busy_timeout_ms: int = 5000,
+                 clock: Callable[[], float] = time.time):
+        self.ttl_seconds = ttl_seconds
+        self.max_logins = max_logins
+        self.purge_every = purge_every
+        self.clock = clock
+        self.pool = SqliteConnectionPool(file_name, readers, busy_timeout_ms)
+
+        self.lock = Lock()
+        self.added = 0
+        self.expired = 0
+        self.evicted = 0
+
+        with self.pool.write() as connection:
+            migrate(connection, USER_LOGIN_MIGRATIONS)
+
+    def add_user_login(self, token: str, callback_url: str):
+        with self.pool.write() as connection:
+            connection.execute(
+                """
+                    INSERT OR REPLACE INTO user_logins(
+                        token, callback_url, expire_at
+                    )
+                    VALUES (?, ?, ?)
+                """,
+                (token, callback_url, self.clock() + self.ttl_seconds),
+            )
+            connection.commit()
+
+        with self.lock:
+            self.added += 1
+            due = self.added % self.purge_every == 0
+        if due:
+            self.purge()
+
+    def delete_user_login(self, token: str) -> Optional[str]:
+        with self.pool.write() as connection:
+            row = connection.execute(
+                """
+                    DELETE FROM user_logins
+                    WHERE token = ?
+                    RETURNING callback_url, expire_at
+                """,
+                (token,),
+            ).fetchone()
+            connection.commit()
+
+        if row is None or row[1] <= self.clock():
+            return None
+        return row[0]
+
+    def purge(self) -> int:
+        with self.pool.write() as connection:
+            expired = connection.execute(
+                "DELETE FROM user_logins WHERE expire_at <= ?",
+                (self.clock(),),
+            ).rowcount
+            evicted = connection.execute(
+                """
+                    DELETE FROM user_logins
+                    WHERE expire_at < (
+                        SELECT expire_at
+                        FROM user_logins
+                        ORDER BY expire_at DESC
+                        LIMIT 1 OFFSET ?
+                    )
+                """,
+                (self.max_logins - 1,),
+            ).rowcount
+            connection.commit()
+
+        with self.lock:
+            self.expired += expired
+            self.evicted += evicted
+        return expired + evicted
+
+    def stats(self) -> dict:
+        with self.pool.read() as connection:
+            size = connection.execute(
+                "SELECT COUNT(*) FROM user_logins"
+            ).fetchone()[0]
+        with self.lock:
+            return {
+                "size": size,
+                "added": self.added,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                **self.pool.stats(),
+            }
+
+
+class SqliteGeocodeRepository(GeocodeRepository):
+
+    def __init__(self, file_name: str,
+                 negative_cache_seconds: int = 24 * 60 * 60,
+                 readers: int = 2, busy_timeout_ms: int = 5000):
+        self.negative_cache_seconds = negative_cache_seconds
+        self.pool = SqliteConnectionPool(file_name, readers, busy_timeout_ms)
+
+        with self.pool.write() as connection:
+            migrate(connection, GEOCODE_MIGRATIONS)
+
+    def get_lat_lon(self, city: str) -> \
+            Union[Tuple[float, float], ApiError, None]:
+        with self.pool.read() as connection:
+            result = connection.execute(
+                """
+                    SELECT lat, lon, updated_at
+                    FROM geocode
+                    WHERE city = ?
+                """,
+                (normalize_city(city),),
+            ).fetchone()
+
+        if result is None:
+            return None
+
+        lat, lon, updated_at = result
+        if lat is not None and lon is not None:
+            return (lat, lon)
+
+        current_time = round(datetime.now().timestamp())
+        if current_time > updated_at + self.negative_cache_seconds:
+            return None
+        return city_not_found(city)
+
+    def save_lat_lon(self, city: str,
+                     lat_lon: Optional[Tuple[float, float]]):
+        lat, lon = lat_lon if lat_lon is not None else (None, None)
+        with self.pool.write() as connection:
+            connection.execute(
+                """
+                    INSERT OR REPLACE INTO geocode(city, lat, lon,
+                                                   updated_at)
+                    VALUES(?, ?, ?, ?)
+                """,
+                (
+                    normalize_city(city),
+                    lat,
+                    lon,
+                    round(datetime.now().timestamp()),
+                ),
+            )
+            connection.commit()
+
+
+class SqliteWeatherCache(WeatherCache):
+
+    def __init__(self, file_name: str, readers: int = 2,
+                 busy_timeout_ms: int = 5000, purge_every: int = 100,
+                 clock: Callable[[], float] = time.time):
+        self.purge_every = purge_every
+        self.clock = clock
+        self.pool = SqliteConnectionPool(file_name, readers, busy_timeout_ms)
+
+        self.lock = Lock()
+        self.saved = 0
+
+        with self.pool.write() as connection:
+            migrate(connection, WEATHER_CACHE_MIGRATIONS)
+
+    def get_weather(self, city: str) -> \
+            Tuple[Optional[WeatherState], Optional[float]]:
+        with self.pool.read() as connection:
+            row = connection.execute(
+                """
+                    SELECT time, temperature, feels_like, pressure,
+                           humidity, expire_at
+                    FROM weather_cache
+                    WHERE city = ?
+                """,
+                (city,),
+            ).fetchone()
+
+        if row is None:
+            return None, None
+        ttl = row[5] - self.clock()
+        if ttl <= 0:
+            return None, None
+
+        weather_state = WeatherState(
+            datetime.fromtimestamp(row[0] / 1000), city, *row[1:5]
+        )
+        return weather_state, ttl
+
+    def save_weather(self, city: str, weather_state: WeatherState,
+                     ttl_seconds: float):
+        with self.pool.write() as connection:
+            connection.execute(
+                """
+                    INSERT OR REPLACE INTO weather_cache(
+                        city, time, temperature, feels_like, pressure,
+                        humidity, expire_at
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    city,
+                    to_millis(weather_state.time),
+                    weather_state.temperature,
+                    weather_state.feels_like,
+                    weather_state.pressure,
+                    weather_state.humidity,
+                    self.clock() + ttl_seconds,
+                ),
+            )
+            connection.commit()
+
+        # Entries of cities nobody asks for any more and leases left by
+        # crashed workers are only ever removed here
+        with self.lock:
+            self.saved += 1
+            due = self.saved % self.purge_every == 0
+        if due:
+            self.purge_expired()
+
+    def acquire_lease(self, city: str, owner: str,
+                      lease_seconds: float) -> bool:
+        now = self.clock()
+        with self.pool.write() as connection:
+            cursor = connection.execute(
+                """
+                    INSERT INTO weather_cache_leases(city, owner, expire_at)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (city) DO UPDATE
+                    SET owner = excluded.owner,
+                        expire_at = excluded.expire_at
+                    WHERE weather_cache_leases.expire_at <= ?
+                """,
+                (city, owner, now + lease_seconds, now),
+            )
+            connection.commit()
+            return cursor.rowcount == 1
+
+    def release_lease(self, city: str, owner: str):
+        with self.pool.write() as connection:
+            connection.execute(
+                """
+                    DELETE FROM weather_cache_leases
+                    WHERE city = ? AND owner = ?
+                """,
+                (city, owner),
+            )
+            connection.commit()
+
+    def purge_expired(self) -> int:
+        now = self.clock()
+        with self.pool.write() as connection:
+            deleted = connection.execute(
+                "DELETE FROM weather_cache WHERE expire_at <= ?", (now,)
+            ).rowcount
+            connection.execute(
+                "DELETE FROM weather_cache_leases WHERE expire_at <= ?",
+                (now,),
+            )
+            connection.commit()
+        return deleted
+
+    def stats(self) -> dict:
+        return self.pool.stats()
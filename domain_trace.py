@@ -0,0 +1,168 @@
+import json
+import os
+import random
+import re
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from datetime import datetime
+from threading import Lock
+from typing import Iterator, List, Optional, Tuple
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+_current = ContextVar("trace", default=None)
+_depth = ContextVar("trace_depth", default=0)
+
+
+class Trace:
+
+    def __init__(self, method: str, path: str, max_events: int = 1000):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.max_events = max_events
+
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.status: Optional[int] = None
+
+        self.spans = []
+        self.statements = []
+        self.dropped_events = 0
+
+    def offset(self) -> float:
+        return time.perf_counter() - self.started
+
+    def add_span(self, name: str, depth: int, start: float, duration: float,
+                 attributes: dict):
+        if len(self.spans) >= self.max_events:
+            self.dropped_events += 1
+            return
+        self.spans.append((name, depth, start, duration, attributes))
+
+    def add_statement(self, sql: str):
+        if len(self.statements) >= self.max_events:
+            self.dropped_events += 1
+            return
+        # Statements arrive with their parameters expanded, and those
+        # include user tokens, so string literals are masked
+        sql = STRING_LITERAL.sub("?", " ".join(sql.split()))
+        self.statements.append((self.offset(), sql))
+
+    def finish(self, status: int):
+        self.status = status
+        self.duration = self.offset()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(self.duration * 1000, 3),
+            "spans": [
+                {
+                    "name": name,
+                    "depth": depth,
+                    "start_ms": round(start * 1000, 3),
+                    "duration_ms": round(duration * 1000, 3),
+                    **attributes,
+                }
+                for name, depth, start, duration, attributes in
+                sorted(self.spans, key=lambda span: span[2])
+            ],
+            "statements": [
+                {"at_ms": round(at * 1000, 3), "sql": sql}
+                for at, sql in self.statements
+            ],
+            "dropped_events": self.dropped_events,
+        }
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str) -> Iterator[dict]:
+    attributes = {}
+    trace = _current.get()
+    if trace is None:
+        yield attributes
+        return
+
+    depth = _depth.get()
+    token = _depth.set(depth + 1)
+    start = trace.offset()
+    try:
+        yield attributes
+    finally:
+        _depth.reset(token)
+        trace.add_span(name, depth, start, trace.offset() - start, attributes)
+
+
+def record_statement(sql: str):
+    trace = _current.get()
+    if trace is not None:
+        trace.add_statement(sql)
+
+
+class Tracer:
+
+    def __init__(
+        self,
+        sample_rate: float = 0.01,
+        slow_seconds: float = 1,
+        max_traces: int = 100,
+        max_events: int = 1000,
+        dump_directory: Optional[str] = None,
+    ):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.max_events = max_events
+        self.dump_directory = dump_directory
+
+        self.lock = Lock()
+        self.traces = deque(maxlen=max_traces)
+
+        self.traced = 0
+        self.kept = 0
+
+    def begin(self, method: str, path: str) -> Tuple[Trace, Token]:
+        trace = Trace(method, path, self.max_events)
+        return trace, _current.set(trace)
+
+    def end(self, trace: Trace, token: Token, status: int):
+        _current.reset(token)
+        trace.finish(status)
+
+        slow = trace.duration >= self.slow_seconds
+        sampled = random.random() < self.sample_rate  # nosec B311
+        with self.lock:
+            self.traced += 1
+            if not slow and not sampled:
+                return
+            self.kept += 1
+            self.traces.append(trace)
+
+        if slow and self.dump_directory is not None:
+            self.__dump(trace)
+
+    def recent(self) -> List[dict]:
+        with self.lock:
+            traces = list(self.traces)
+        return [trace.to_dict() for trace in reversed(traces)]
+
+    def __dump(self, trace: Trace):
+        os.makedirs(self.dump_directory, exist_ok=True)
+        file_name = os.path.join(
+            self.dump_directory,
+            f"{trace.started_at:%Y%m%dT%H%M%S}-{trace.id}.json",
+        )
+        with open(file_name, "w") as file:
+            json.dump(trace.to_dict(), file, indent=2)
@@ -1,7 +1,37 @@
-from datetime import datetime
-from typing import Union
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, \
+    wait
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from typing import List, Optional, Tuple, Union
+from uuid import uuid4
 
-from domain import ApiError, WeatherApi, WeatherRepository, WeatherState, User
+from domain import ApiError, AsyncWeatherApi, BackgroundService, \
+    CircuitOpenError, GeocodeRepository, WeatherAggregate, WeatherApi, \
+    WeatherCache, WeatherHistory, WeatherRepository, WeatherState, User, \
+    UserRepository, normalize_city
+from domain_cache import MISSING, AsyncSingleFlight, CityPopularity, \
+    SingleFlight, TtlLruCache
+from domain_metrics import LayerTimer, MetricsRegistry, weather_result, \
+    weather_results
+from domain_rate_limit import PRIORITY_BACKGROUND, current_priority, \
+    upstream_priority
+from domain_resilience import CircuitBreaker, LatencyWindow, \
+    is_upstream_failure
+
+logger = logging.getLogger(__name__)
+
+
+def history_user(user: User) -> Optional[User]:
+    # Background refreshes are nobody's request, so their readings only go
+    # to the city history and not to the history of the last user who asked
+    if current_priority() == PRIORITY_BACKGROUND:
+        return None
+    return user
 
 
 class WeatherApiWithRepository(WeatherApi):
@@ -14,32 +44,825 @@ class WeatherApiWithRepository(WeatherApi):
             Union[WeatherState, ApiError]:
         weather = self.wrapped.get_weather(city, user)
         if isinstance(weather, WeatherState):
-            self.repository.save_weather(weather, user)
+            self.repository.save_weather(weather, history_user(user))
         return weather
 
 
 class CachedWeatherApi(WeatherApi):
 
-    def __init__(self, wrapped: WeatherApi, cache_seconds: int):
+    def __init__(self, wrapped: WeatherApi, cache_seconds: int,
+                 max_size: int = 10000, stale_seconds: int = 0,
+                 popularity: Optional[CityPopularity] = None,
+                 shared_cache: Optional[WeatherCache] = None,
+                 lease_seconds: float = 5, poll_seconds: float = 0.05):
         self.wrapped = wrapped
         self.cache_seconds = cache_seconds
-        self.cache = {}
+        self.stale_seconds = stale_seconds
+        self.popularity = popularity
+        self.cache = TtlLruCache(
+            max_size=max_size, ttl_seconds=cache_seconds + stale_seconds
+        )
+        self.shared_cache = shared_cache
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.owner = f"{os.getpid()}-{uuid4().hex}"
+        self.single_flight = SingleFlight()
+
+        self.refresh_executor = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="weather-refresh"
+        )
+        self.refresh_lock = Lock()
+        self.refreshing = set()
+        self.failed_refreshes = set()
+
+    @property
+    def coalesced_requests(self) -> int:
+        return self.single_flight.coalesced
+
+    def get_cached_weather(self, city: str) -> Optional[WeatherState]:
+        cached, ttl = self.cache.get_with_ttl(city)
+        if cached is not None and (ttl is None or ttl > self.stale_seconds):
+            return cached
+        return None
+
+    def get_cached_weather_ttl(self, city: str) -> Optional[float]:
+        ttl = self.cache.ttl(city)
+        if ttl is None:
+            return None
+        return max(0.0, ttl - self.stale_seconds)
 
     def get_weather(self, city: str, user: User) -> \
             Union[WeatherState, ApiError]:
-        current_time = round(datetime.now().timestamp())
+        if self.popularity is not None:
+            self.popularity.record(city, user)
+
+        cached, ttl = self.__lookup(city)
+        if cached is not None:
+            if ttl is None or ttl > self.stale_seconds:
+                return cached
+            if city not in self.failed_refreshes:
+                self.__refresh_in_background(city, user)
+                return cached
+            self.failed_refreshes.discard(city)
+
+        weather = self.single_flight.do(
+            city, lambda: self.__fetch_unless_fresh(city, user)
+        )
+        if cached is not None and isinstance(weather, CircuitOpenError):
+            return cached
+        return weather
+
+    def refresh(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        with upstream_priority(PRIORITY_BACKGROUND):
+            return self.single_flight.do(
+                city, lambda: self.__fetch(city, user)
+            )
+
+    def __fetch_unless_fresh(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        cached, ttl = self.__lookup(city)
+        if cached is not None and (ttl is None or ttl > self.stale_seconds):
+            return cached
+        return self.__fetch(city, user)
+
+    def __lookup(self, city: str) -> \
+            Tuple[Optional[WeatherState], Optional[float]]:
+        cached, ttl = self.cache.get_with_ttl(city)
+        if self.shared_cache is None or (
+            cached is not None and (ttl is None or ttl > self.stale_seconds)
+        ):
+            return cached, ttl
+
+        shared, shared_ttl = self.shared_cache.get_weather(city)
+        if shared is None or (cached is not None and shared_ttl <= ttl):
+            return cached, ttl
+        self.cache.set(city, shared, shared_ttl)
+        return shared, shared_ttl
+
+    def __fetch(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        if self.shared_cache is None:
+            return self.__fetch_upstream(city, user)
+
+        # Another worker's entry replaces the upstream call only when it is
+        # fresh and outlives ours, which a refresh ahead of expiry needs
+        baseline = max(self.stale_seconds, self.cache.ttl(city) or 0)
+        deadline = time.monotonic() + self.lease_seconds
+        while not self.shared_cache.acquire_lease(
+            city, self.owner, self.lease_seconds
+        ):
+            if time.monotonic() >= deadline:
+                return self.__fetch_upstream(city, user)
+            time.sleep(self.poll_seconds)
+            shared = self.__shared_newer_than(city, baseline)
+            if shared is not None:
+                return shared
+
+        try:
+            shared = self.__shared_newer_than(city, baseline)
+            if shared is not None:
+                return shared
+            return self.__fetch_upstream(city, user)
+        finally:
+            self.shared_cache.release_lease(city, self.owner)
+
+    def __shared_newer_than(self, city: str,
+                            baseline: float) -> Optional[WeatherState]:
+        shared, ttl = self.shared_cache.get_weather(city)
+        if shared is None or ttl <= baseline:
+            return None
+        self.cache.set(city, shared, ttl)
+        return shared
+
+    def __fetch_upstream(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        weather = self.wrapped.get_weather(city, user)
+        if isinstance(weather, WeatherState):
+            self.cache.set(city, weather)
+            if self.shared_cache is not None:
+                self.shared_cache.save_weather(
+                    city, weather, self.cache_seconds + self.stale_seconds
+                )
+        return weather
+
+    def __refresh_in_background(self, city: str, user: User):
+        with self.refresh_lock:
+            if city in self.refreshing:
+                return
+            self.refreshing.add(city)
+        self.refresh_executor.submit(self.__refresh, city, user)
+
+    def __refresh(self, city: str, user: User):
+        try:
+            with upstream_priority(PRIORITY_BACKGROUND):
+                weather = self.single_flight.do(
+                    city, lambda: self.__fetch_unless_fresh(city, user)
+                )
+        except Exception:
+            weather = None
+        finally:
+            with self.refresh_lock:
+                self.refreshing.discard(city)
+
+        if not isinstance(weather, WeatherState):
+            self.failed_refreshes.add(city)
+
+
+class AsyncWeatherApiWithRepository(AsyncWeatherApi):
+
+    def __init__(self, wrapped: AsyncWeatherApi,
+                 repository: WeatherRepository):
+        self.wrapped = wrapped
+        self.repository = repository
+
+    async def get_weather(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        weather = await self.wrapped.get_weather(city, user)
+        if isinstance(weather, WeatherState):
+            await asyncio.to_thread(
+                self.repository.save_weather, weather, history_user(user)
+            )
+        return weather
+
+    async def aclose(self):
+        await self.wrapped.aclose()
+
+
+class AsyncCachedWeatherApi(AsyncWeatherApi):
+
+    def __init__(self, wrapped: AsyncWeatherApi, cache_seconds: int,
+                 max_size: int = 10000, stale_seconds: int = 0,
+                 popularity: Optional[CityPopularity] = None,
+                 shared_cache: Optional[WeatherCache] = None,
+                 lease_seconds: float = 5, poll_seconds: float = 0.05):
+        self.wrapped = wrapped
+        self.cache_seconds = cache_seconds
+        self.stale_seconds = stale_seconds
+        self.popularity = popularity
+        self.cache = TtlLruCache(
+            max_size=max_size, ttl_seconds=cache_seconds + stale_seconds
+        )
+        self.shared_cache = shared_cache
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.owner = f"{os.getpid()}-{uuid4().hex}"
+        self.single_flight = AsyncSingleFlight()
+
+        self.refreshing = {}
+        self.failed_refreshes = set()
+
+    @property
+    def coalesced_requests(self) -> int:
+        return self.single_flight.coalesced
+
+    def get_cached_weather(self, city: str) -> Optional[WeatherState]:
+        cached, ttl = self.cache.get_with_ttl(city)
+        if cached is not None and (ttl is None or ttl > self.stale_seconds):
+            return cached
+        return None
+
+    def get_cached_weather_ttl(self, city: str) -> Optional[float]:
+        ttl = self.cache.ttl(city)
+        if ttl is None:
+            return None
+        return max(0.0, ttl - self.stale_seconds)
+
+    async def get_weather(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        if self.popularity is not None:
+            self.popularity.record(city, user)
 
-        cached = self.cache.get(city)
+        cached, ttl = await self.__lookup(city)
         if cached is not None:
-            expire_time = cached["expire_time"]
-            if current_time <= expire_time:
-                return cached["entity"]
+            if ttl is None or ttl > self.stale_seconds:
+                return cached
+            if city not in self.failed_refreshes:
+                self.__refresh_in_background(city, user)
+                return cached
+            self.failed_refreshes.discard(city)
+
+        weather = await self.single_flight.do(
+            city, lambda: self.__fetch(city, user)
+        )
+        if cached is not None and isinstance(weather, CircuitOpenError):
+            return cached
+        return weather
+
+    async def refresh(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        with upstream_priority(PRIORITY_BACKGROUND):
+            return await self.single_flight.do(
+                city, lambda: self.__fetch(city, user)
+            )
+
+    async def aclose(self):
+        for task in list(self.refreshing.values()):
+            task.cancel()
+        await self.wrapped.aclose()
+
+    async def __lookup(self, city: str) -> \
+            Tuple[Optional[WeatherState], Optional[float]]:
+        cached, ttl = self.cache.get_with_ttl(city)
+        if self.shared_cache is None or (
+            cached is not None and (ttl is None or ttl > self.stale_seconds)
+        ):
+            return cached, ttl
+
+        shared, shared_ttl = await asyncio.to_thread(
+            self.shared_cache.get_weather, city
+        )
+        if shared is None or (cached is not None and shared_ttl <= ttl):
+            return cached, ttl
+        self.cache.set(city, shared, shared_ttl)
+        return shared, shared_ttl
+
+    async def __fetch(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        if self.shared_cache is None:
+            return await self.__fetch_upstream(city, user)
+
+        # Another worker's entry replaces the upstream call only when it is
+        # fresh and outlives ours, which a refresh ahead of expiry needs
+        baseline = max(self.stale_seconds, self.cache.ttl(city) or 0)
+        deadline = time.monotonic() + self.lease_seconds
+        while not await asyncio.to_thread(
+            self.shared_cache.acquire_lease,
+            city, self.owner, self.lease_seconds,
+        ):
+            if time.monotonic() >= deadline:
+                return await self.__fetch_upstream(city, user)
+            await asyncio.sleep(self.poll_seconds)
+            shared = await self.__shared_newer_than(city, baseline)
+            if shared is not None:
+                return shared
+
+        try:
+            shared = await self.__shared_newer_than(city, baseline)
+            if shared is not None:
+                return shared
+            return await self.__fetch_upstream(city, user)
+        finally:
+            await asyncio.to_thread(
+                self.shared_cache.release_lease, city, self.owner
+            )
+
+    async def __shared_newer_than(self, city: str,
+                                  baseline: float) -> Optional[WeatherState]:
+        shared, ttl = await asyncio.to_thread(
+            self.shared_cache.get_weather, city
+        )
+        if shared is None or ttl <= baseline:
+            return None
+        self.cache.set(city, shared, ttl)
+        return shared
+
+    async def __fetch_upstream(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        weather = await self.wrapped.get_weather(city, user)
+        if isinstance(weather, WeatherState):
+            self.cache.set(city, weather)
+            if self.shared_cache is not None:
+                await asyncio.to_thread(
+                    self.shared_cache.save_weather,
+                    city, weather, self.cache_seconds + self.stale_seconds,
+                )
+        return weather
+
+    def __refresh_in_background(self, city: str, user: User):
+        if city in self.refreshing:
+            return
+        task = asyncio.ensure_future(self.__refresh(city, user))
+        self.refreshing[city] = task
+        task.add_done_callback(lambda _: self.refreshing.pop(city, None))
+
+    async def __refresh(self, city: str, user: User):
+        try:
+            with upstream_priority(PRIORITY_BACKGROUND):
+                weather = await self.single_flight.do(
+                    city, lambda: self.__fetch(city, user)
+                )
+        except Exception:
+            weather = None
+
+        if not isinstance(weather, WeatherState):
+            self.failed_refreshes.add(city)
+
+
+def circuit_open() -> CircuitOpenError:
+    return CircuitOpenError("Upstream circuit is open")
+
+
+class CircuitBreakerWeatherApi(WeatherApi):
+
+    def __init__(self, wrapped: WeatherApi,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.wrapped = wrapped
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+    def get_weather(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        if not self.breaker.allow():
+            return circuit_open()
+
+        started = self.breaker.clock()
+        try:
+            weather = self.wrapped.get_weather(city, user)
+        except Exception:
+            self.breaker.record(True, self.breaker.clock() - started)
+            raise
+
+        self.breaker.record(
+            is_upstream_failure(weather), self.breaker.clock() - started
+        )
+        return weather
+
+
+class AsyncCircuitBreakerWeatherApi(AsyncWeatherApi):
+
+    def __init__(self, wrapped: AsyncWeatherApi,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.wrapped = wrapped
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+    async def get_weather(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        if not self.breaker.allow():
+            return circuit_open()
+
+        started = self.breaker.clock()
+        try:
+            weather = await self.wrapped.get_weather(city, user)
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception:
+            self.breaker.record(True, self.breaker.clock() - started)
+            raise
+
+        self.breaker.record(
+            is_upstream_failure(weather), self.breaker.clock() - started
+        )
+        return weather
+
+    async def aclose(self):
+        await self.wrapped.aclose()
+
+
+class HedgedWeatherApi(WeatherApi):
+
+    def __init__(self, wrapped: WeatherApi, percentile: float = 0.95,
+                 min_delay_seconds: float = 0.05, min_samples: int = 20,
+                 window_size: int = 100, max_workers: int = 8):
+        self.wrapped = wrapped
+        self.percentile = percentile
+        self.min_delay_seconds = min_delay_seconds
+        self.min_samples = min_samples
+        self.latencies = LatencyWindow(window_size)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="weather-hedge"
+        )
 
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self) -> Optional[float]:
+        if len(self.latencies) < self.min_samples:
+            return None
+        return max(
+            self.min_delay_seconds, self.latencies.percentile(self.percentile)
+        )
+
+    def get_weather(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        delay = self.hedge_delay()
+        if delay is None:
+            return self.__timed(city, user)
+
+        primary = self.__submit(city, user)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        self.hedged += 1
+        hedge = self.__submit(city, user)
+        weather = None
+        for future in as_completed([primary, hedge]):
+            weather = future.result()
+            if isinstance(weather, WeatherState):
+                if future is hedge:
+                    self.hedge_wins += 1
+                return weather
+        return weather
+
+    def __submit(self, city: str, user: User) -> Future:
+        return self.executor.submit(
+            contextvars.copy_context().run, self.__timed, city, user
+        )
+
+    def __timed(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        started = time.monotonic()
         weather = self.wrapped.get_weather(city, user)
         if isinstance(weather, WeatherState):
-            self.cache[city] = {
-                "expire_time": current_time + self.cache_seconds,
-                "entity": weather,
-            }
+            self.latencies.record(time.monotonic() - started)
+        return weather
+
+
+class AsyncHedgedWeatherApi(AsyncWeatherApi):
+
+    def __init__(self, wrapped: AsyncWeatherApi, percentile: float = 0.95,
+                 min_delay_seconds: float = 0.05, min_samples: int = 20,
+                 window_size: int = 100):
+        self.wrapped = wrapped
+        self.percentile = percentile
+        self.min_delay_seconds = min_delay_seconds
+        self.min_samples = min_samples
+        self.latencies = LatencyWindow(window_size)
+
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self) -> Optional[float]:
+        if len(self.latencies) < self.min_samples:
+            return None
+        return max(
+            self.min_delay_seconds, self.latencies.percentile(self.percentile)
+        )
+
+    async def get_weather(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self.__timed(city, user)
+
+        primary = asyncio.ensure_future(self.__timed(city, user))
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        self.hedged += 1
+        hedge = asyncio.ensure_future(self.__timed(city, user))
+        pending = {primary, hedge}
+        weather = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    weather = task.result()
+                    if isinstance(weather, WeatherState):
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return weather
+            return weather
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def aclose(self):
+        await self.wrapped.aclose()
+
+    async def __timed(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        started = time.monotonic()
+        weather = await self.wrapped.get_weather(city, user)
+        if isinstance(weather, WeatherState):
+            self.latencies.record(time.monotonic() - started)
+        return weather
+
+
+class CachedGeocodeRepository(GeocodeRepository):
+
+    def __init__(self, wrapped: GeocodeRepository, max_size: int = 1024):
+        self.wrapped = wrapped
+        self.cache = TtlLruCache(max_size=max_size)
+
+    def get_lat_lon(self, city: str) -> \
+            Union[Tuple[float, float], ApiError, None]:
+        key = normalize_city(city)
+        lat_lon = self.cache.get(key)
+        if lat_lon is not None:
+            return lat_lon
+
+        lat_lon = self.wrapped.get_lat_lon(city)
+        if isinstance(lat_lon, tuple):
+            self.cache.set(key, lat_lon)
+        return lat_lon
+
+    def save_lat_lon(self, city: str,
+                     lat_lon: Optional[Tuple[float, float]]):
+        self.wrapped.save_lat_lon(city, lat_lon)
+
+        key = normalize_city(city)
+        if lat_lon is not None:
+            self.cache.set(key, lat_lon)
+        else:
+            self.cache.delete(key)
+
+
+class CachedUserRepository(UserRepository):
+
+    def __init__(self, wrapped: UserRepository, cache_seconds: float = 5,
+                 negative_cache_seconds: float = 5, max_size: int = 10000):
+        self.wrapped = wrapped
+        self.negative_cache_seconds = negative_cache_seconds
+        self.cache = TtlLruCache(max_size=max_size, ttl_seconds=cache_seconds)
+
+    def get_user(self, token: str) -> Optional[User]:
+        user = self.cache.get(token, MISSING)
+        if user is not MISSING:
+            return user
+
+        user = self.wrapped.get_user(token)
+        if user is None:
+            self.cache.set(token, None, self.negative_cache_seconds)
+        else:
+            self.cache.set(token, user)
+        return user
+
+    def save_user(self, telegram_id: int, token: str):
+        self.wrapped.save_user(telegram_id, token)
+
+        # INSERT OR REPLACE drops any previous token of this user as well
+        # as any other user holding this token. Only this process's cache
+        # is invalidated, other workers keep the old token until it expires
+        self.cache.delete_where(
+            lambda key, user: key == token or (
+                user is not None and user.telegram_id == telegram_id
+            )
+        )
+
+
+class WriteBehindWeatherRepository(WeatherRepository, BackgroundService):
+
+    def __init__(
+        self,
+        wrapped: WeatherRepository,
+        batch_size: int = 100,
+        flush_interval_ms: int = 200,
+        max_queue_size: int = 10000,
+        overflow: str = "block",
+    ):
+        if overflow not in ("block", "drop"):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+
+        self.wrapped = wrapped
+        self.batch_size = batch_size
+        self.flush_interval_ms = flush_interval_ms
+        self.overflow = overflow
+        self.queue = Queue(maxsize=max_queue_size)
+
+        self.flush_lock = Lock()
+        self.accept_lock = Lock()
+        self.wakeup = Event()
+        self.stopped = Event()
 
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+        self.thread = Thread(
+            target=self.__run, name="weather-write-behind", daemon=True
+        )
+        self.thread.start()
+
+    def get_weather_history(self, limit: int,
+                            city_or_user: Union[str, User],
+                            **filters) -> WeatherHistory:
+        return self.wrapped.get_weather_history(
+            limit, city_or_user, **filters
+        )
+
+    def get_weather_aggregates(self, city_or_user: Union[str, User],
+                               bucket_seconds: int, limit: int,
+                               **filters) -> List[WeatherAggregate]:
+        return self.wrapped.get_weather_aggregates(
+            city_or_user, bucket_seconds, limit, **filters
+        )
+
+    def save_weather(self, weather_state: WeatherState,
+                     user: Optional[User]):
+        # Checking stopped and queueing under one lock keeps close() from
+        # running its final flush in between and leaving the row unwritten
+        with self.accept_lock:
+            if not self.stopped.is_set():
+                self.__enqueue(weather_state, user)
+                return
+        self.wrapped.save_weather(weather_state, user)
+
+    def flush(self):
+        with self.flush_lock:
+            while True:
+                batch = self.__drain()
+                if not batch:
+                    return
+                self.__write(batch)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "flushes": self.flushes,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+        }
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        await asyncio.to_thread(self.close)
+
+    def close(self):
+        with self.accept_lock:
+            self.stopped.set()
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+
+    def __run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.flush_interval_ms / 1000)
+            self.wakeup.clear()
+            self.flush()
+
+    def __enqueue(self, weather_state: WeatherState, user: Optional[User]):
+        if self.overflow == "drop":
+            try:
+                self.queue.put_nowait((weather_state, user))
+            except Full:
+                self.dropped += 1
+                return
+        else:
+            self.queue.put((weather_state, user))
+
+        if self.queue.qsize() >= self.batch_size:
+            self.wakeup.set()
+
+    def __drain(self) -> List[Tuple[WeatherState, User]]:
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def __write(self, batch: List[Tuple[WeatherState, User]]):
+        start = time.perf_counter()
+        try:
+            self.wrapped.save_weathers(batch)
+            self.written += len(batch)
+        except Exception:
+            logger.exception("Failed to write %d weather rows", len(batch))
+            self.failed += len(batch)
+
+        elapsed = time.perf_counter() - start
+        self.flushes += 1
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+
+class InstrumentedWeatherApi(WeatherApi):
+
+    def __init__(self, wrapped: WeatherApi, metrics: MetricsRegistry,
+                 layer: Optional[str] = None):
+        self.wrapped = wrapped
+        self.timer = LayerTimer(metrics, layer or type(wrapped).__name__)
+        self.results = weather_results(metrics)
+
+    def get_cached_weather(self, city: str) -> Optional[WeatherState]:
+        return self.wrapped.get_cached_weather(city)
+
+    def get_cached_weather_ttl(self, city: str) -> Optional[float]:
+        return self.wrapped.get_cached_weather_ttl(city)
+
+    def get_weather(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        weather = self.timer.call(
+            "get_weather", self.wrapped.get_weather, city, user
+        )
+        self.results.inc(self.timer.layer, weather_result(weather))
         return weather
+
+
+class AsyncInstrumentedWeatherApi(AsyncWeatherApi):
+
+    def __init__(self, wrapped: AsyncWeatherApi, metrics: MetricsRegistry,
+                 layer: Optional[str] = None):
+        self.wrapped = wrapped
+        self.timer = LayerTimer(metrics, layer or type(wrapped).__name__)
+        self.results = weather_results(metrics)
+
+    def get_cached_weather(self, city: str) -> Optional[WeatherState]:
+        return self.wrapped.get_cached_weather(city)
+
+    def get_cached_weather_ttl(self, city: str) -> Optional[float]:
+        return self.wrapped.get_cached_weather_ttl(city)
+
+    async def get_weather(self, city: str, user: User) -> \
+            Union[WeatherState, ApiError]:
+        weather = await self.timer.call_async(
+            "get_weather", self.wrapped.get_weather, city, user
+        )
+        self.results.inc(self.timer.layer, weather_result(weather))
+        return weather
+
+    async def aclose(self):
+        await self.wrapped.aclose()
+
+
+class InstrumentedWeatherRepository(WeatherRepository):
+
+    def __init__(self, wrapped: WeatherRepository, metrics: MetricsRegistry,
+                 layer: Optional[str] = None):
+        self.wrapped = wrapped
+        self.timer = LayerTimer(metrics, layer or type(wrapped).__name__)
+
+    def get_weather_history(self, limit: int,
+                            city_or_user: Union[str, User],
+                            **filters) -> WeatherHistory:
+        return self.timer.call(
+            "get_weather_history", self.wrapped.get_weather_history,
+            limit, city_or_user, **filters
+        )
+
+    def get_weather_aggregates(self, city_or_user: Union[str, User],
+                               bucket_seconds: int, limit: int,
+                               **filters) -> List[WeatherAggregate]:
+        return self.timer.call(
+            "get_weather_aggregates", self.wrapped.get_weather_aggregates,
+            city_or_user, bucket_seconds, limit, **filters
+        )
+
+    def save_weather(self, weather_state: WeatherState,
+                     user: Optional[User]):
+        self.timer.call(
+            "save_weather", self.wrapped.save_weather, weather_state, user
+        )
+
+    def save_weathers(self, entries: List[Tuple[WeatherState, User]]):
+        self.timer.call("save_weathers", self.wrapped.save_weathers, entries)
+
+
+class InstrumentedUserRepository(UserRepository):
+
+    def __init__(self, wrapped: UserRepository, metrics: MetricsRegistry,
+                 layer: Optional[str] = None):
+        self.wrapped = wrapped
+        self.timer = LayerTimer(metrics, layer or type(wrapped).__name__)
+
+    def get_user(self, token: str) -> Optional[User]:
+        return self.timer.call("get_user", self.wrapped.get_user, token)
+
+    def save_user(self, telegram_id: int, token: str):
+        self.timer.call(
+            "save_user", self.wrapped.save_user, telegram_id, token
+        )
@@ -1,31 +1,149 @@
-from locust import HttpUser, task, between
+import itertools
+import os
 import random
+import time
 import uuid
 
+from locust import HttpUser, between, task
+from locust.exception import StopUser
 
-class FastApiUser(HttpUser):
-    wait_time = between(1, 2)
+AUTHORIZATION_TOKEN = os.getenv("TELEGRAM_SERVICE_AUTHORIZATION_TOKEN")
+CITY_COUNT = int(os.getenv("LOCUST_CITY_COUNT", "1000"))
+ZIPF_EXPONENT = float(os.getenv("LOCUST_ZIPF_EXPONENT", "1.1"))
+UNKNOWN_CITY_RATE = float(os.getenv("LOCUST_UNKNOWN_CITY_RATE", "0.01"))
 
-    demo_token = "6d060947-1ffe-4461-a868-b91367e909f9"
-    authorization_token = "YOUR_TELEGRAM_SERVICE_HEADER_TOKEN"
-    telegram_id = 958352999
-    city = "Kazan"
-    callback_url = "http://localhost:8501/login_success?token=5223d7f6-ea0d-4097-a7bf-7a660085cdbd&telegram_id=958352999&authorization_token=aab11f74-0d78-45d3-8c2c-c8bfa7864852"
+CITIES = [f"City {rank}" for rank in range(1, CITY_COUNT + 1)]
+CITY_WEIGHTS = list(itertools.accumulate(
+    1 / rank ** ZIPF_EXPONENT for rank in range(1, CITY_COUNT + 1)
+))
 
-    @task
-    def test_weather_endpoint(self):
+telegram_ids = itertools.count(random.randrange(10 ** 9))  # nosec B311
+
+
+def zipf_city() -> str:
+    if random.random() < UNKNOWN_CITY_RATE:  # nosec B311
+        return f"Nowhere {uuid.uuid4().hex[:8]}"
+    return random.choices(CITIES, cum_weights=CITY_WEIGHTS)[0]  # nosec B311
+
+
+class LoggedInUser(HttpUser):
+    abstract = True
+
+    def on_start(self):
+        login_token = str(uuid.uuid4())
+        self.client.post(
+            "/user/login",
+            params={
+                "token": login_token,
+                "callback_url": "http://localhost:8501/login_success",
+            },
+        )
+        with self.client.post(
+            "/user/successful_login",
+            params={
+                "token": login_token,
+                "telegram_id": next(telegram_ids),
+                "authorization_token": AUTHORIZATION_TOKEN,
+            },
+            catch_response=True,
+        ) as response:
+            if response.status_code != 200:
+                response.failure(f"Login failed: {response.text}")
+                raise StopUser()
+            self.user_token = response.json()["auth_token"]
+
+        self.home_city = zipf_city()
+
+
+class WeatherBoardUser(LoggedInUser):
+    weight = 4
+    wait_time = between(0.5, 2)
+
+    @task(10)
+    def weather(self):
+        self.client.get(
+            "/weather",
+            params={"city": zipf_city(), "user_token": self.user_token},
+            name="/weather",
+        )
+
+    @task(3)
+    def home_weather(self):
+        self.client.get(
+            "/weather",
+            params={"city": self.home_city, "user_token": self.user_token},
+            name="/weather",
+        )
+
+    @task(2)
+    def weather_batch(self):
+        cities = {zipf_city() for _ in range(8)}
+        self.client.get(
+            "/weather/batch",
+            params={"cities": list(cities), "user_token": self.user_token},
+            name="/weather/batch",
+        )
+
+    @task(1)
+    def telegram_id(self):
         self.client.get(
-            f"/weather?city={self.city}&user_token={self.demo_token}"
+            "/user/telegram_id", params={"user_token": self.user_token}
+        )
+
+
+class HistoryReaderUser(LoggedInUser):
+    weight = 1
+    wait_time = between(1, 3)
+
+    @task(5)
+    def city_history(self):
+        response = self.client.get(
+            "/weather/history",
+            params={
+                "city": self.home_city,
+                "limit": 50,
+                "user_token": self.user_token,
+            },
+            name="/weather/history",
         )
+        if response.status_code != 200:
+            return
+
+        next_cursor = response.json().get("next_cursor")
+        if next_cursor is not None:
+            self.client.get(
+                "/weather/history",
+                params={
+                    "city": self.home_city,
+                    "limit": 50,
+                    "cursor": next_cursor,
+                    "user_token": self.user_token,
+                },
+                name="/weather/history [next page]",
+            )
 
-    @task
-    def test_weather_history_endpoint(self):
+    @task(3)
+    def recent_history(self):
         self.client.get(
-            f"/weather/history?city={self.city}&limit=5&user_token={self.demo_token}"
+            "/weather/history",
+            params={
+                "city": zipf_city(),
+                "limit": 20,
+                "from": time.time() - 60 * 60,
+                "user_token": self.user_token,
+            },
+            name="/weather/history [last hour]",
         )
 
-    @task
-    def test_get_telegram_id(self):
+    @task(2)
+    def aggregates(self):
         self.client.get(
-            f"/user/telegram_id?user_token={self.demo_token}"
+            "/weather/aggregates",
+            params={
+                "city": self.home_city,
+                "bucket": "1h",
+                "limit": 24,
+                "user_token": self.user_token,
+            },
+            name="/weather/aggregates",
         )
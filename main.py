@@ -3,10 +3,21 @@ import os
 from dotenv import load_dotenv
 
 from app import create_app
-from domain_open_weather_map import OpenWeatherMapApi
-from domain_sqlite import SqliteWeatherRepository, SqliteUserRepository
-from domain_memory import InMemoryUserLoginRepository
-from domain_wrapper import CachedWeatherApi, WeatherApiWithRepository
+from domain_open_weather_map import BASE_URL, AsyncOpenWeatherMapApi
+from domain_sqlite import SqliteWeatherRepository, SqliteUserRepository, \
+    SqliteGeocodeRepository, SqliteUserLoginRepository, SqliteWeatherCache
+from domain_cache import CityPopularity
+from domain_metrics import MetricsRegistry, hit_ratio
+from domain_prefetch import PrefetchScheduler
+from domain_rate_limit import AsyncRateLimiter
+from domain_resilience import CLOSED, CircuitBreaker
+from domain_trace import Tracer
+from domain_wrapper import AsyncCachedWeatherApi, \
+    AsyncCircuitBreakerWeatherApi, AsyncHedgedWeatherApi, \
+    AsyncInstrumentedWeatherApi, AsyncWeatherApiWithRepository, \
+    CachedGeocodeRepository, CachedUserRepository, \
+    InstrumentedUserRepository, InstrumentedWeatherRepository, \
+    WriteBehindWeatherRepository
 
 load_dotenv()
 open_weather_map_token = os.getenv("OPEN_WEATHER_MAP_TOKEN")
@@ -14,18 +25,100 @@ telegram_service_authorization_token = os.getenv(
     "TELEGRAM_SERVICE_AUTHORIZATION_TOKEN"
 )
 
-weather_repository = SqliteWeatherRepository("weather.db")
+metrics = MetricsRegistry()
+
+tracer = None
+trace_slow_requests_ms = os.getenv("TRACE_SLOW_REQUESTS_MS")
+if trace_slow_requests_ms is not None:
+    tracer = Tracer(
+        sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "0")),
+        slow_seconds=float(trace_slow_requests_ms) / 1000,
+        dump_directory=os.getenv("TRACE_DUMP_DIRECTORY"),
+    )
+
+sqlite_weather_repository = SqliteWeatherRepository("weather.db")
+weather_repository = WriteBehindWeatherRepository(
+    InstrumentedWeatherRepository(sqlite_weather_repository, metrics)
+)
+
+rate_limiter = AsyncRateLimiter(
+    rate_per_second=float(os.getenv("OPEN_WEATHER_MAP_RATE_PER_SECOND", "1")),
+    burst=10,
+    max_wait_seconds=2,
+)
+circuit_breaker = CircuitBreaker()
+shared_weather_cache = SqliteWeatherCache("weather_cache.db")
+user_login_repository = SqliteUserLoginRepository("user_logins.db")
+
+weather_api = AsyncCachedWeatherApi(
+    AsyncWeatherApiWithRepository(
+        AsyncCircuitBreakerWeatherApi(
+            AsyncHedgedWeatherApi(
+                AsyncInstrumentedWeatherApi(
+                    AsyncOpenWeatherMapApi(
+                        open_weather_map_token,
+                        geocode_repository=CachedGeocodeRepository(
+                            SqliteGeocodeRepository("geocode.db")
+                        ),
+                        rate_limiter=rate_limiter,
+                        base_url=os.getenv(
+                            "OPEN_WEATHER_MAP_BASE_URL", BASE_URL
+                        ),
+                    ),
+                    metrics,
+                ),
+            ),
+            circuit_breaker,
+        ),
+        weather_repository,
+    ),
+    30 * 60,
+    stale_seconds=5 * 60,
+    popularity=CityPopularity(),
+    shared_cache=shared_weather_cache,
+)
+
+metrics.stats("weather_cache", "Weather cache", weather_api.cache.stats)
+metrics.gauge(
+    "weather_cache_hit_ratio",
+    "Share of weather cache lookups that were hits",
+    lambda: hit_ratio(weather_api.cache.stats()),
+)
+metrics.stats(
+    "sqlite_weather", "SQLite weather lock waits",
+    sqlite_weather_repository.stats,
+)
+metrics.stats(
+    "sqlite_weather_cache", "Shared weather cache lock waits",
+    shared_weather_cache.stats,
+)
+metrics.stats("user_logins", "Pending logins", user_login_repository.stats)
+metrics.stats("weather_write_behind", "Write-behind queue",
+              weather_repository.stats)
+metrics.stats("upstream_rate_limiter", "Upstream token bucket",
+              rate_limiter.stats)
+metrics.gauge(
+    "upstream_circuit_open",
+    "Whether the upstream circuit breaker is open or half-open",
+    lambda: float(circuit_breaker.state != CLOSED),
+)
 
 app = create_app(
-    CachedWeatherApi(
-        WeatherApiWithRepository(
-            OpenWeatherMapApi(open_weather_map_token),
-            weather_repository,
+    AsyncInstrumentedWeatherApi(weather_api, metrics),
+    InstrumentedWeatherRepository(weather_repository, metrics),
+    # Each worker caches tokens for a few seconds, so a rotated-out token
+    # is still accepted by the other workers for up to that long
+    InstrumentedUserRepository(
+        CachedUserRepository(
+            InstrumentedUserRepository(
+                SqliteUserRepository("users.db"), metrics
+            )
         ),
-        30 * 60,
+        metrics,
     ),
-    weather_repository,
-    SqliteUserRepository("users.db"),
-    InMemoryUserLoginRepository(),
-    telegram_service_authorization_token
+    user_login_repository,
+    telegram_service_authorization_token,
+    background_services=[weather_repository, PrefetchScheduler(weather_api)],
+    metrics=metrics,
+    tracer=tracer,
 )
@@ -1,12 +1,21 @@
+import asyncio
+import csv
+import io
+import json
 from datetime import datetime
 from unittest.mock import MagicMock
 
+import httpx
 import pytest
 from fastapi.testclient import TestClient
 
-from app import create_app
-from domain import ApiError, WeatherApi, WeatherRepository, WeatherState, \
-    UserRepository, User
+from app import MAX_BATCH_CITIES, MAX_HISTORY_LIMIT, FastJSONResponse, \
+    HistoryResponse, create_app, history_content
+from domain import AggregateValue, ApiError, AsyncWeatherApi, \
+    BackgroundService, RateLimitError, WeatherAggregate, WeatherApi, \
+    WeatherHistory, WeatherRepository, WeatherState, UserRepository, User
+from domain_metrics import MetricsRegistry
+from domain_trace import Tracer
 
 
 @pytest.fixture
@@ -74,6 +83,22 @@ def test_get_weather_error(mock_weather_api_error, mock_user_repository):
     assert "City not found" in data["error"]
 
 
+def test_get_weather_rate_limited(mock_user_repository):
+    weather_api = MagicMock(spec=WeatherApi)
+    weather_api.get_weather.return_value = RateLimitError(
+        "Upstream request budget exhausted"
+    )
+    app = create_app(weather_api, None, mock_user_repository, None, "")
+    client = TestClient(app)
+
+    response = client.get("/weather", params={
+        "user_token": "",
+        "city": "London"
+    })
+    assert response.status_code == 503
+    assert "budget exhausted" in response.json()["error"]
+
+
 @pytest.fixture
 def mock_weather_api_invalid():
     mock = MagicMock(spec=WeatherApi)
@@ -155,3 +180,524 @@ def test_get_weather_history_failure(mock_weather_repository,
     assert data["success"] is False
     assert "Bad response from WeatherRepository: Database error" \
            in data["error"]
+
+
+def test_get_weather_async(mock_user_repository):
+    weather_api = MagicMock(spec=AsyncWeatherApi)
+    weather_api.get_weather.return_value = WeatherState(
+        time=datetime.now(),
+        city="London",
+        temperature=20.5,
+        feels_like=19.0,
+        pressure=1015,
+        humidity=65
+    )
+    app = create_app(weather_api, None, mock_user_repository, None, "")
+
+    with TestClient(app) as client:
+        response = client.get("/weather", params={
+            "user_token": "",
+            "city": "London"
+        })
+    assert response.status_code == 200
+    assert response.json()["temperature"] == 20.5
+    weather_api.get_weather.assert_awaited_once()
+    weather_api.aclose.assert_awaited_once()
+
+
+def test_background_services_lifecycle(mock_weather_api_success,
+                                       mock_user_repository):
+    service = MagicMock(spec=BackgroundService)
+    app = create_app(
+        mock_weather_api_success, None, mock_user_repository, None, "",
+        background_services=[service]
+    )
+
+    with TestClient(app):
+        service.start.assert_awaited_once()
+        service.stop.assert_not_awaited()
+    service.stop.assert_awaited_once()
+
+
+def test_get_weather_history_pagination(mock_weather_repository,
+                                        mock_user_repository):
+    mock_weather_repository.get_weather_history.return_value = [
+        WeatherState(datetime(2024, 1, 1, 12 - i), "London", 10.0, 9.0,
+                     1020, 70)
+        for i in range(3)
+    ]
+    app = create_app(
+        None, mock_weather_repository, mock_user_repository, None, ""
+    )
+    client = TestClient(app)
+    response = client.get("/weather/history", params={
+        "user_token": "",
+        "city": "London",
+        "limit": 2,
+        "from": datetime(2024, 1, 1).timestamp(),
+        "before": datetime(2024, 1, 2).timestamp(),
+    })
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data["history"]) == 2
+    assert data["next_cursor"] is not None
+
+    args, kwargs = mock_weather_repository.get_weather_history.call_args
+    assert args == (3, "London")
+    assert kwargs["from_time"] == datetime(2024, 1, 1)
+    assert kwargs["before"] == datetime(2024, 1, 2)
+    assert kwargs["after"] is None
+    assert kwargs["cursor"] is None
+
+    mock_weather_repository.get_weather_history.return_value = []
+    response = client.get("/weather/history", params={
+        "user_token": "",
+        "city": "London",
+        "limit": 2,
+        "cursor": data["next_cursor"],
+    })
+    assert response.status_code == 200
+    assert response.json()["next_cursor"] is None
+
+    cursor = mock_weather_repository.get_weather_history.call_args[1][
+        "cursor"
+    ]
+    assert cursor.time == datetime(2024, 1, 1, 11)
+    assert cursor.city == "London"
+
+
+def test_get_weather_history_caps_limit(mock_weather_repository,
+                                        mock_user_repository):
+    mock_weather_repository.get_weather_history.return_value = []
+    app = create_app(
+        None, mock_weather_repository, mock_user_repository, None, ""
+    )
+    client = TestClient(app)
+    client.get("/weather/history", params={
+        "user_token": "",
+        "city": "London",
+        "limit": 10 ** 9,
+    })
+
+    args = mock_weather_repository.get_weather_history.call_args[0]
+    assert args[0] == MAX_HISTORY_LIMIT + 1
+
+
+def test_get_weather_history_bad_cursor(mock_weather_repository,
+                                        mock_user_repository):
+    app = create_app(
+        None, mock_weather_repository, mock_user_repository, None, ""
+    )
+    client = TestClient(app)
+    response = client.get("/weather/history", params={
+        "user_token": "",
+        "city": "London",
+        "limit": 1,
+        "cursor": "not a cursor",
+    })
+    assert response.status_code == 400
+    assert not mock_weather_repository.get_weather_history.called
+
+
+def export_history():
+    return [
+        WeatherState(datetime(2024, 1, 1, 12 - i), "London", 10.0 + i, 9.0,
+                     1020, 70)
+        for i in range(3)
+    ]
+
+
+def test_get_weather_export_ndjson(mock_weather_repository,
+                                   mock_user_repository):
+    mock_weather_repository.iter_weather_history.return_value = iter(
+        [export_history()[:2], export_history()[2:]]
+    )
+    app = create_app(
+        None, mock_weather_repository, mock_user_repository, None, ""
+    )
+    client = TestClient(app)
+    response = client.get("/weather/export", params={
+        "user_token": "",
+        "city": "London",
+        "to": datetime(2024, 1, 2).timestamp(),
+    })
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith(
+        "application/x-ndjson"
+    )
+
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["temperature"] for row in rows] == [10.0, 11.0, 12.0]
+    assert rows[0]["city"] == "London"
+    assert rows[0]["time"] == datetime(2024, 1, 1, 12).timestamp()
+
+    args, kwargs = mock_weather_repository.iter_weather_history.call_args
+    assert args == ("London",)
+    assert kwargs["to_time"] == datetime(2024, 1, 2)
+
+
+def test_get_weather_export_csv(mock_weather_repository,
+                                mock_user_repository):
+    mock_weather_repository.iter_weather_history.return_value = iter(
+        [export_history()]
+    )
+    app = create_app(
+        None, mock_weather_repository, mock_user_repository, None, ""
+    )
+    client = TestClient(app)
+    response = client.get("/weather/export", params={
+        "user_token": "",
+        "format": "csv",
+    })
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows[0] == [
+        "time", "city", "temperature", "feels_like", "pressure", "humidity"
+    ]
+    assert len(rows) == 4
+    assert rows[1][1] == "London"
+
+    args = mock_weather_repository.iter_weather_history.call_args[0]
+    assert isinstance(args[0], User)
+
+
+def test_get_weather_export_csv_without_rows(mock_weather_repository,
+                                             mock_user_repository):
+    mock_weather_repository.iter_weather_history.return_value = iter([])
+    app = create_app(
+        None, mock_weather_repository, mock_user_repository, None, ""
+    )
+    response = TestClient(app).get("/weather/export", params={
+        "user_token": "",
+        "format": "csv",
+    })
+    assert response.status_code == 200
+
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows == [
+        ["time", "city", "temperature", "feels_like", "pressure", "humidity"]
+    ]
+
+
+def test_get_weather_aggregates(mock_weather_repository,
+                                mock_user_repository):
+    value = AggregateValue(1.0, 3.0, 2.0, 3.0)
+    mock_weather_repository.get_weather_aggregates.return_value = [
+        WeatherAggregate(datetime(2024, 1, 1), 3, value, value, value, value)
+    ]
+    app = create_app(
+        None, mock_weather_repository, mock_user_repository, None, ""
+    )
+    client = TestClient(app)
+    response = client.get("/weather/aggregates", params={
+        "user_token": "",
+        "city": "London",
+        "bucket": "1d",
+    })
+    assert response.status_code == 200
+    data = response.json()
+    assert data["bucket_seconds"] == 24 * 60 * 60
+    assert data["aggregates"][0]["count"] == 3
+    assert data["aggregates"][0]["temperature"] == {
+        "min": 1.0, "max": 3.0, "mean": 2.0, "last": 3.0
+    }
+
+    args = mock_weather_repository.get_weather_aggregates.call_args[0]
+    assert args == ("London", 24 * 60 * 60, 500)
+
+
+def test_get_weather_aggregates_bad_bucket(mock_weather_repository,
+                                           mock_user_repository):
+    app = create_app(
+        None, mock_weather_repository, mock_user_repository, None, ""
+    )
+    client = TestClient(app)
+    response = client.get("/weather/aggregates", params={
+        "user_token": "",
+        "bucket": "7m",
+    })
+    assert response.status_code == 422
+
+
+def test_get_weather_batch(mock_user_repository):
+    weather_api = MagicMock(spec=WeatherApi)
+    weather_api.get_cached_weather.side_effect = lambda city: WeatherState(
+        datetime.now(), city, 1.0, 0.5, 1000, 50
+    ) if city == "London" else None
+
+    def mock_get_weather(city, user):
+        if city == "Nowhere":
+            return ApiError("City Nowhere Not Found")
+        if city == "Broken":
+            raise Exception("Timeout")
+        return WeatherState(datetime.now(), city, 2.0, 1.5, 1010, 60)
+
+    weather_api.get_weather.side_effect = mock_get_weather
+    app = create_app(weather_api, None, mock_user_repository, None, "")
+    client = TestClient(app)
+
+    response = client.get("/weather/batch", params={
+        "user_token": "",
+        "cities": ["London", "Moscow", "Nowhere", "Broken", "Moscow"],
+    })
+    assert response.status_code == 200
+    data = response.json()
+    assert data["success"] is True
+    assert [entry["city"] for entry in data["weather"]] == [
+        "London", "Moscow", "Nowhere", "Broken"
+    ]
+
+    london, moscow, nowhere, broken = data["weather"]
+    assert london["success"] is True and london["temperature"] == 1.0
+    assert moscow["success"] is True and moscow["temperature"] == 2.0
+    assert nowhere["success"] is False
+    assert "Not Found" in nowhere["error"]
+    assert broken["success"] is False
+    assert "Timeout" in broken["error"]
+
+    assert weather_api.get_weather.call_count == 3
+    mock_user_repository.get_user.assert_called_once()
+
+
+def test_get_weather_batch_async_concurrent(mock_user_repository):
+    running = []
+    peak = []
+    weather_api = MagicMock(spec=AsyncWeatherApi)
+    weather_api.get_cached_weather.return_value = None
+
+    async def mock_get_weather(city, user):
+        running.append(city)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(city)
+        return WeatherState(datetime.now(), city, 2.0, 1.5, 1010, 60)
+
+    weather_api.get_weather.side_effect = mock_get_weather
+    app = create_app(weather_api, None, mock_user_repository, None, "")
+    client = TestClient(app)
+
+    cities = [f"City {i}" for i in range(20)]
+    response = client.get("/weather/batch", params={
+        "user_token": "",
+        "cities": cities,
+    })
+    assert response.status_code == 200
+    assert all(entry["success"] for entry in response.json()["weather"])
+    assert max(peak) == 10
+
+
+def test_get_weather_batch_limits_concurrency_per_request(
+        mock_user_repository):
+    running = []
+    peak = []
+    weather_api = MagicMock(spec=AsyncWeatherApi)
+    weather_api.get_cached_weather.return_value = None
+
+    async def mock_get_weather(city, user):
+        running.append(city)
+        peak.append(len(running))
+        await asyncio.sleep(0.05)
+        running.remove(city)
+        return WeatherState(datetime.now(), city, 2.0, 1.5, 1010, 60)
+
+    weather_api.get_weather.side_effect = mock_get_weather
+    app = create_app(weather_api, None, mock_user_repository, None, "")
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url="http://test") as client:
+            return await asyncio.gather(*(
+                client.get("/weather/batch", params={
+                    "user_token": "",
+                    "cities": [f"City {board}-{i}" for i in range(10)],
+                })
+                for board in range(2)
+            ))
+
+    responses = asyncio.run(run())
+    assert [response.status_code for response in responses] == [200, 200]
+    assert max(peak) == 20
+
+
+def test_get_weather_batch_too_many_cities(mock_weather_api_success,
+                                           mock_user_repository):
+    app = create_app(
+        mock_weather_api_success, None, mock_user_repository, None, ""
+    )
+    client = TestClient(app)
+    response = client.get("/weather/batch", params={
+        "user_token": "",
+        "cities": [f"City {i}" for i in range(MAX_BATCH_CITIES + 1)],
+    })
+    assert response.status_code == 400
+
+
+def test_metrics_endpoint(mock_weather_api_success, mock_user_repository):
+    metrics = MetricsRegistry()
+    app = create_app(
+        mock_weather_api_success, None, mock_user_repository, None, "",
+        metrics=metrics,
+    )
+    client = TestClient(app)
+
+    client.get("/weather", params={"user_token": "", "city": "London"})
+    client.get("/missing")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'http_requests_total{method="GET",route="/weather",' \
+        'status="200"} 1.0' in response.text
+    assert 'route="unmatched",status="404"' in response.text
+    assert "http_request_duration_seconds_bucket" in response.text
+
+
+def test_metrics_endpoint_disabled_by_default(mock_weather_api_success,
+                                              mock_user_repository):
+    app = create_app(
+        mock_weather_api_success, None, mock_user_repository, None, ""
+    )
+    assert TestClient(app).get("/metrics").status_code == 404
+
+
+def test_debug_traces_endpoint(mock_weather_api_success, mock_user_repository):
+    tracer = Tracer(sample_rate=0, slow_seconds=0)
+    app = create_app(
+        mock_weather_api_success, None, mock_user_repository, None, "admin",
+        tracer=tracer,
+    )
+    client = TestClient(app)
+
+    client.get("/weather", params={"user_token": "", "city": "London"})
+
+    response = client.get(
+        "/debug/traces", params={"authorization_token": "wrong"}
+    )
+    assert response.status_code == 403
+
+    response = client.get(
+        "/debug/traces", params={"authorization_token": "admin"}
+    )
+    assert response.status_code == 200
+    traces = response.json()["traces"]
+    assert [(t["path"], t["status"]) for t in traces] == [
+        ("/debug/traces", 403), ("/weather", 200)
+    ]
+
+
+def test_get_weather_conditional_request(mock_weather_api_success,
+                                         mock_user_repository):
+    mock_weather_api_success.get_cached_weather_ttl.return_value = 90.5
+    app = create_app(
+        mock_weather_api_success, None, mock_user_repository, None, ""
+    )
+    client = TestClient(app)
+    params = {"user_token": "", "city": "London"}
+
+    response = client.get("/weather", params=params)
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "max-age=90"
+    etag = response.headers["ETag"]
+    last_modified = response.headers["Last-Modified"]
+
+    response = client.get("/weather", params=params,
+                          headers={"If-None-Match": f'"x", {etag}'})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+    response = client.get("/weather", params=params,
+                          headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+
+    response = client.get("/weather", params=params,
+                          headers={"If-None-Match": '"other"'})
+    assert response.status_code == 200
+
+
+def test_get_weather_error_has_no_validators(mock_weather_api_error,
+                                             mock_user_repository):
+    app = create_app(
+        mock_weather_api_error, None, mock_user_repository, None, ""
+    )
+    response = TestClient(app).get("/weather", params={
+        "user_token": "", "city": "London"
+    }, headers={"If-None-Match": "*"})
+    assert response.status_code == 500
+    assert "ETag" not in response.headers
+
+
+def test_get_weather_history_conditional_request(mock_weather_repository,
+                                                 mock_user_repository):
+    newest = WeatherState(datetime(2024, 1, 1), "London", 10.0, 9.0, 1020, 70)
+    mock_weather_repository.get_weather_history.return_value = [newest]
+    app = create_app(
+        None, mock_weather_repository, mock_user_repository, None, ""
+    )
+    client = TestClient(app)
+    params = {"user_token": "", "city": "London", "limit": 10}
+
+    response = client.get("/weather/history", params=params)
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "no-cache"
+    etag = response.headers["ETag"]
+    assert etag.startswith("W/")
+
+    assert "Last-Modified" not in response.headers
+    assert mock_weather_repository.get_weather_history.call_count == 1
+
+    response = client.get("/weather/history", params=params,
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert mock_weather_repository.get_weather_history.call_count == 2
+
+    # A late write-behind flush adds an older row under the same newest row
+    mock_weather_repository.get_weather_history.return_value = [
+        newest,
+        WeatherState(datetime(2023, 12, 31), "London", 11.0, 9.0, 1020, 70),
+    ]
+    response = client.get("/weather/history", params=params,
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.json()["history"]) == 2
+
+
+def test_history_content_keeps_response_schema():
+    history = WeatherHistory.from_rows([
+        (1704103200500, "London", 10.0, 9.0, 1020, 70),
+        (1704099600250, "London", 11.5, 10.0, 1019, 71),
+        (1704096000000, "London", 12.0, 11.0, 1018, 72),
+    ])
+
+    content = history_content(history, 2)
+    assert HistoryResponse.model_validate(content).model_dump() == content
+    assert [entity["time"] for entity in content["history"]] == [
+        1704103200.5, 1704099600.25
+    ]
+    assert json.loads(FastJSONResponse(content).body) == content
+    assert history_content(history, 3)["next_cursor"] is None
+
+
+@pytest.mark.parametrize("route", [
+    "/weather/history", "/weather/export", "/weather/aggregates"
+])
+@pytest.mark.parametrize("timestamp", ["nan", "inf", "1e20", "-1e20"])
+def test_history_routes_reject_bad_timestamps(
+        mock_weather_repository, mock_user_repository, route, timestamp):
+    app = create_app(
+        None, mock_weather_repository, mock_user_repository, None, ""
+    )
+    response = TestClient(app).get(route, params={
+        "user_token": "",
+        "city": "London",
+        "limit": 10,
+        "before": timestamp,
+    })
+
+    assert response.status_code == 400
+    assert response.json() == {"success": False, "error": "Bad timestamp"}
+    assert not mock_weather_repository.method_calls
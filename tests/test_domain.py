@@ -0,0 +1,59 @@
+from datetime import datetime
+
+import pytest
+
+from domain import WeatherHistory, WeatherState
+
+
+def weather_states():
+    return [
+        WeatherState(datetime(2024, 1, 1, 12), "London", 10.0, 9.0, 1020, 70),
+        WeatherState(datetime(2024, 1, 1, 11), "Kazan", 11.5, 10.0, 1019, 71),
+        WeatherState(datetime(2024, 1, 1, 10), "London", 12.0, 11.0, 1018, 72),
+    ]
+
+
+def test_weather_state_is_slotted():
+    weather = weather_states()[0]
+    assert not hasattr(weather, "__dict__")
+    with pytest.raises(AttributeError):
+        weather.wind = 3.0
+
+
+def test_weather_history_round_trips_states():
+    states = weather_states()
+    history = WeatherHistory.from_states(states)
+
+    assert len(history) == 3
+    assert history.times[0] == round(states[0].time.timestamp() * 1000)
+    assert history.cities[0] is history.cities[2]
+    assert [
+        (weather.time, weather.city, weather.temperature, weather.humidity)
+        for weather in history
+    ] == [
+        (weather.time, weather.city, weather.temperature, weather.humidity)
+        for weather in states
+    ]
+    assert history[-1].pressure == 1018
+
+
+def test_weather_history_slices_and_rows():
+    history = WeatherHistory.from_rows(
+        [(1000 * i, "London", float(i), 0.0, 1000, 50) for i in range(5000)],
+        chunk_size=1024,
+    )
+
+    assert len(history) == 5000
+    tail = history[4998:]
+    assert isinstance(tail, WeatherHistory)
+    assert list(tail.rows()) == [
+        (4998.0, "London", 4998.0, 0.0, 1000, 50),
+        (4999.0, "London", 4999.0, 0.0, 1000, 50),
+    ]
+    assert len(WeatherHistory.from_rows([])) == 0
+
+
+def test_weather_history_of_keeps_columnar_history():
+    history = WeatherHistory.from_states(weather_states())
+    assert WeatherHistory.of(history) is history
+    assert len(WeatherHistory.of(weather_states())) == 3
@@ -0,0 +1,208 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+import pytest
+
+from domain_cache import MISSING, AsyncSingleFlight, CityPopularity, \
+    SingleFlight, TtlLruCache
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    single_flight = SingleFlight()
+    started = Event()
+    release = Event()
+    calls = []
+
+    def function():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return "result"
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        leader = executor.submit(single_flight.do, "key", function)
+        started.wait()
+        followers = [
+            executor.submit(single_flight.do, "key", function)
+            for _ in range(3)
+        ]
+        while single_flight.coalesced < 3:
+            pass
+        release.set()
+
+        assert leader.result() == "result"
+        assert [f.result() for f in followers] == ["result"] * 3
+
+    assert len(calls) == 1
+    assert single_flight.calls == {}
+
+
+def test_single_flight_shares_error():
+    single_flight = SingleFlight()
+    started = Event()
+    release = Event()
+
+    def function():
+        started.set()
+        release.wait()
+        raise ValueError("upstream")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(single_flight.do, "key", function)
+        started.wait()
+        follower = executor.submit(single_flight.do, "key", function)
+        while single_flight.coalesced < 1:
+            pass
+        release.set()
+
+        with pytest.raises(ValueError):
+            leader.result()
+        with pytest.raises(ValueError):
+            follower.result()
+
+    assert single_flight.do("key", lambda: "again") == "again"
+
+
+def test_async_single_flight_coalesces_concurrent_calls():
+    single_flight = AsyncSingleFlight()
+    calls = []
+
+    async def function():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run():
+        return await asyncio.gather(
+            *(single_flight.do("key", function) for _ in range(5))
+        )
+
+    assert asyncio.run(run()) == ["result"] * 5
+    assert len(calls) == 1
+    assert single_flight.coalesced == 4
+    assert single_flight.calls == {}
+
+
+def test_async_single_flight_shares_error():
+    single_flight = AsyncSingleFlight()
+
+    async def function():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream")
+
+    async def run():
+        return await asyncio.gather(
+            *(single_flight.do("key", function) for _ in range(2)),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_lru_cache_expires_entries():
+    clock = FakeClock()
+    cache = TtlLruCache(max_size=10, ttl_seconds=5, clock=clock)
+
+    cache.set("London", 1)
+    assert cache.get("London") == 1
+
+    clock.now = 5
+    assert cache.get("London") is None
+    assert len(cache) == 0
+
+    cache.set("Moscow", 2, ttl_seconds=100)
+    clock.now = 50
+    assert cache.get("Moscow") == 2
+
+    assert cache.stats() == {
+        "size": 1,
+        "bytes": 0,
+        "hits": 2,
+        "misses": 1,
+        "evictions": 0,
+        "expirations": 1,
+    }
+
+
+def test_ttl_lru_cache_evicts_least_recently_used():
+    cache = TtlLruCache(max_size=2)
+
+    cache.set("London", 1)
+    cache.set("Moscow", 2)
+    cache.get("London")
+    cache.set("Kazan", 3)
+
+    assert cache.get("Moscow") is None
+    assert cache.get("London") == 1
+    assert cache.get("Kazan") == 3
+    assert cache.evictions == 1
+
+
+def test_ttl_lru_cache_respects_byte_budget():
+    cache = TtlLruCache(max_size=100, max_bytes=10, sizeof=len)
+
+    cache.set("a", "xxxx")
+    cache.set("b", "xxxx")
+    cache.set("c", "xxxx")
+
+    assert cache.get("a") is None
+    assert cache.bytes == 8
+
+    cache.set("b", "xxxxxxxxxx")
+    assert cache.get("c") is None
+    assert cache.bytes == 10
+
+
+def test_ttl_lru_cache_distinguishes_cached_none():
+    cache = TtlLruCache()
+
+    assert cache.get("token", MISSING) is MISSING
+    cache.set("token", None)
+    assert cache.get("token", MISSING) is None
+
+    assert cache.delete("token")
+    assert not cache.delete("token")
+
+
+def test_city_popularity_ranks_by_decayed_frequency():
+    clock = FakeClock()
+    popularity = CityPopularity(half_life_seconds=5, clock=clock)
+
+    for _ in range(4):
+        popularity.record("London", "user1")
+    clock.now = 20
+    for _ in range(2):
+        popularity.record("Moscow", "user2")
+    popularity.record("Kazan", "user3")
+
+    assert popularity.top(2) == [("Moscow", "user2"), ("Kazan", "user3")]
+
+
+def test_city_popularity_is_bounded():
+    popularity = CityPopularity(max_cities=2)
+
+    for city in ["London"] * 3 + ["Moscow"] * 2 + ["Kazan", "Paris", "Rome"]:
+        popularity.record(city, None)
+
+    assert len(popularity.scores) == 2
+    assert [city for city, _ in popularity.top(2)] == ["London", "Moscow"]
+
+
+def test_ttl_lru_cache_delete_where():
+    cache = TtlLruCache()
+    for key in range(5):
+        cache.set(key, key * 10)
+
+    assert cache.delete_where(lambda key, value: value >= 30) == 2
+    assert sorted(cache.entries) == [0, 1, 2]
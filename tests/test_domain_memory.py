@@ -1,4 +1,6 @@
-from domain_memory import InMemoryUserLoginRepository
+from domain import ApiError
+from domain_memory import InMemoryUserLoginRepository, \
+    InMemoryGeocodeRepository
 
 
 def test_in_memory_user_login_repository():
@@ -11,3 +13,66 @@ def test_in_memory_user_login_repository():
 
     callback_url = repository.delete_user_login("123")
     assert callback_url is None
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_in_memory_user_login_repository_expires_logins():
+    clock = FakeClock()
+    repository = InMemoryUserLoginRepository(ttl_seconds=60, clock=clock)
+
+    repository.add_user_login("old", "https://example.com/old")
+    clock.now += 30
+    repository.add_user_login("new", "https://example.com/new")
+    clock.now += 30
+    assert repository.delete_user_login("old") is None
+
+    repository.add_user_login("newer", "https://example.com/newer")
+    assert list(repository.storage) == ["new", "newer"]
+    assert repository.delete_user_login("new") == "https://example.com/new"
+
+
+def test_in_memory_user_login_repository_is_bounded():
+    repository = InMemoryUserLoginRepository(max_logins=2)
+    for token in ("a", "b", "c"):
+        repository.add_user_login(token, f"https://example.com/{token}")
+
+    assert repository.delete_user_login("a") is None
+    assert repository.delete_user_login("c") == "https://example.com/c"
+    assert repository.stats()["evicted"] == 1
+
+
+def test_in_memory_geocode_repository():
+    repository = InMemoryGeocodeRepository()
+    assert repository.get_lat_lon("London") is None
+
+    repository.save_lat_lon("London", (51.5, -0.12))
+    assert repository.get_lat_lon("  london ") == (51.5, -0.12)
+
+    repository.save_lat_lon("Nowhere", None)
+    assert isinstance(repository.get_lat_lon("Nowhere"), ApiError)
+
+
+def test_in_memory_geocode_repository_is_bounded():
+    clock = FakeClock()
+    repository = InMemoryGeocodeRepository(
+        max_size=2, negative_cache_seconds=60, clock=clock
+    )
+
+    repository.save_lat_lon("Nowhere", None)
+    clock.now = 61
+    assert repository.get_lat_lon("Nowhere") is None
+
+    repository.save_lat_lon("London", (51.5, -0.12))
+    repository.save_lat_lon("Paris", (48.9, 2.35))
+    repository.save_lat_lon("Berlin", (52.5, 13.4))
+    assert repository.get_lat_lon("London") is None
+    assert repository.get_lat_lon("Berlin") == (52.5, 13.4)
+    assert repository.stats()["size"] == 2
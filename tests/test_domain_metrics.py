@@ -0,0 +1,90 @@
+from datetime import datetime
+
+from domain import ApiError, WeatherState
+from domain_metrics import MetricsRegistry, format_labels, hit_ratio, \
+    weather_result
+
+
+def test_counter_renders_labels():
+    metrics = MetricsRegistry()
+    counter = metrics.counter("requests_total", "Requests", ("route",))
+    counter.inc("/weather")
+    counter.inc("/weather", amount=2)
+    counter.inc('/a"b')
+
+    text = metrics.render()
+    assert "# TYPE requests_total counter" in text
+    assert 'requests_total{route="/weather"} 3.0' in text
+    assert 'requests_total{route="/a\\"b"} 1.0' in text
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = MetricsRegistry()
+    histogram = metrics.histogram(
+        "latency_seconds", "Latency", ("layer",), buckets=(0.1, 1)
+    )
+    histogram.observe(0.05, "cache")
+    histogram.observe(0.1, "cache")
+    histogram.observe(0.5, "cache")
+    histogram.observe(3, "cache")
+
+    lines = metrics.render().splitlines()
+    assert 'latency_seconds_bucket{layer="cache",le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{layer="cache",le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{layer="cache",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{layer="cache"} 3.65' in lines
+    assert 'latency_seconds_count{layer="cache"} 4' in lines
+
+
+def test_registry_returns_existing_metric():
+    metrics = MetricsRegistry()
+    first = metrics.counter("requests_total", "Requests")
+    assert metrics.counter("requests_total", "Requests") is first
+
+
+def test_stats_exposes_numeric_values_as_gauges():
+    metrics = MetricsRegistry()
+    stats = {"hits": 3, "misses": 1, "state": "closed", "ready": True}
+    metrics.stats("cache", "Cache", lambda: stats)
+
+    stats["hits"] = 5
+    text = metrics.render()
+    assert "cache_hits 5.0" in text
+    assert "cache_misses 1.0" in text
+    assert "cache_state" not in text
+    assert "cache_ready" not in text
+
+
+def test_stats_calls_function_once_per_render():
+    metrics = MetricsRegistry()
+    calls = []
+
+    def stats():
+        calls.append(1)
+        return {"size": len(calls), "expired": len(calls)}
+
+    metrics.stats("logins", "Logins", stats)
+    calls.clear()
+
+    lines = metrics.render().splitlines()
+    assert len(calls) == 1
+    assert "logins_size 1.0" in lines
+    assert "logins_expired 1.0" in lines
+    assert "# TYPE logins_size gauge" in lines
+
+
+def test_hit_ratio():
+    assert hit_ratio({"hits": 3, "misses": 1}) == 0.75
+    assert hit_ratio({"hits": 0, "misses": 0}) == 0
+
+
+def test_weather_result():
+    weather = WeatherState(datetime.now(), "London", 20.5, 19.0, 1015, 65)
+    assert weather_result(weather) == "ok"
+    assert weather_result(ApiError("Error")) == "ApiError"
+    assert weather_result(None) == "invalid"
+
+
+def test_format_labels():
+    assert format_labels((), ()) == ""
+    assert format_labels(("a", "b"), ("1", "2")) == '{a="1",b="2"}'
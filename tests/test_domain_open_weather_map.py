@@ -1,9 +1,14 @@
+import asyncio
 import pytest
 from unittest.mock import patch, MagicMock
+import httpx
 import requests
 
-from domain import ApiError, WeatherState, User
-from domain_open_weather_map import OpenWeatherMapApi
+from benchmarks.mock_open_weather_map import UpstreamSimulator, \
+    create_mock_app
+from domain import ApiError, RateLimitError, WeatherState, User
+from domain_open_weather_map import AsyncOpenWeatherMapApi, OpenWeatherMapApi
+from domain_rate_limit import AsyncRateLimiter, RateLimiter
 
 
 @pytest.fixture
@@ -13,12 +18,14 @@ def api():
 
 def mock_geo_response(*args, **kwargs):
     mock_response = MagicMock()
+    mock_response.status_code = 200
     mock_response.json.return_value = [{"lat": 50.23, "lon": 29.14}]
     return mock_response
 
 
 def mock_weather_response(*args, **kwargs):
     mock_response = MagicMock()
+    mock_response.status_code = 200
     mock_response.json.return_value = {
         "main": {
             "temp": 20.5,
@@ -68,3 +75,184 @@ def test_get_weather_request_exception_2(mock_get, api):
     weather = api.get_weather("London", User(1, ""))
     assert isinstance(weather, ApiError)
     assert "Connection error" in weather.message
+
+
+def async_api(handler):
+    return AsyncOpenWeatherMapApi(
+        "", client=httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+
+
+def mock_handler(request):
+    if request.url.path.startswith("/geo"):
+        assert request.url.params["q"] == "London"
+        return httpx.Response(200, json=[{"lat": 50.23, "lon": 29.14}])
+    assert request.url.params["lat"] == "50.23"
+    assert request.url.params["lon"] == "29.14"
+    return httpx.Response(200, json={
+        "main": {
+            "temp": 20.5,
+            "feels_like": 19.0,
+            "pressure": 1015,
+            "humidity": 65
+        }
+    })
+
+
+def test_async_get_weather_success():
+    api = async_api(mock_handler)
+
+    async def run():
+        try:
+            return await api.get_weather("London", User(1, ""))
+        finally:
+            await api.aclose()
+
+    weather = asyncio.run(run())
+    assert isinstance(weather, WeatherState)
+    assert weather.city == "London"
+    assert weather.temperature == 20.5
+    assert weather.feels_like == 19.0
+    assert weather.pressure == 1015
+    assert weather.humidity == 65
+
+
+def test_async_get_weather_request_exception():
+    def handler(request):
+        raise httpx.ConnectError("Connection error")
+
+    api = async_api(handler)
+    weather = asyncio.run(api.get_weather("London", User(1, "")))
+    assert isinstance(weather, ApiError)
+    assert "Connection error" in weather.message
+
+
+def test_async_aclose_closes_client():
+    api = AsyncOpenWeatherMapApi("")
+    client = api.client
+    asyncio.run(api.aclose())
+    assert client.is_closed
+
+
+@patch("requests.get", side_effect=[
+    mock_geo_response(), mock_weather_response(), mock_weather_response()
+])
+def test_get_weather_caches_lat_lon(mock_get, api):
+    api.get_weather("London", User(1, ""))
+    api.get_weather("london", User(1, ""))
+    assert mock_get.call_count == 3
+
+
+def mock_empty_geo_response(*args, **kwargs):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = []
+    return mock_response
+
+
+@patch("requests.get", side_effect=[mock_empty_geo_response()])
+def test_get_weather_city_not_found(mock_get, api):
+    weather = api.get_weather("Nowhere", User(1, ""))
+    assert isinstance(weather, ApiError)
+    assert "Not Found" in weather.message
+
+    weather = api.get_weather("Nowhere", User(1, ""))
+    assert isinstance(weather, ApiError)
+    assert mock_get.call_count == 1
+
+
+def test_async_get_weather_upstream_rate_limited():
+    def handler(request):
+        return httpx.Response(429, json={"cod": 429, "message": "limit"})
+
+    api = async_api(handler)
+    weather = asyncio.run(api.get_weather("London", User(1, "")))
+    assert isinstance(weather, RateLimitError)
+    assert api.geocode_repository.get_lat_lon("London") is None
+
+
+def test_async_get_weather_malformed_response():
+    def handler(request):
+        if request.url.path.startswith("/geo"):
+            return httpx.Response(200, json=[{"lat": 50.23, "lon": 29.14}])
+        return httpx.Response(200, json={"cod": 401})
+
+    api = async_api(handler)
+    weather = asyncio.run(api.get_weather("London", User(1, "")))
+    assert isinstance(weather, ApiError)
+    assert "Malformed" in weather.message
+
+
+def test_async_get_weather_rejected_when_budget_exhausted():
+    requests_seen = []
+
+    def handler(request):
+        requests_seen.append(request)
+        return mock_handler(request)
+
+    api = AsyncOpenWeatherMapApi(
+        "",
+        client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+        rate_limiter=AsyncRateLimiter(0.001, 2, max_wait_seconds=0.01),
+    )
+
+    async def run():
+        first = await api.get_weather("London", User(1, ""))
+        second = await api.get_weather("London", User(1, ""))
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert isinstance(first, WeatherState)
+    assert isinstance(second, RateLimitError)
+    assert len(requests_seen) == 2
+    assert api.rate_limiter.rejected == 1
+
+
+@patch("requests.get", side_effect=[mock_geo_response()])
+def test_get_weather_rejected_when_budget_exhausted(mock_get):
+    api = OpenWeatherMapApi(
+        "", rate_limiter=RateLimiter(0.001, 1, max_wait_seconds=0.01)
+    )
+    weather = api.get_weather("London", User(1, ""))
+    assert isinstance(weather, RateLimitError)
+    assert mock_get.call_count == 1
+
+
+def test_async_get_weather_against_mock_server():
+    simulator = UpstreamSimulator(latency_ms=0, seed=1)
+    api = AsyncOpenWeatherMapApi(
+        "",
+        client=httpx.AsyncClient(
+            transport=httpx.ASGITransport(create_mock_app(simulator))
+        ),
+        base_url="http://mock",
+    )
+
+    async def run():
+        try:
+            return (
+                await api.get_weather("City 1", User(1, "")),
+                await api.get_weather("Nowhere 1", User(1, "")),
+            )
+        finally:
+            await api.aclose()
+
+    weather, not_found = asyncio.run(run())
+    assert isinstance(weather, WeatherState)
+    assert isinstance(not_found, ApiError)
+    assert simulator.requests == {"geo": 2, "weather": 1}
+
+
+def test_async_get_weather_against_failing_mock_server():
+    simulator = UpstreamSimulator(latency_ms=0, rate_limit_rate=1)
+    api = AsyncOpenWeatherMapApi(
+        "",
+        client=httpx.AsyncClient(
+            transport=httpx.ASGITransport(create_mock_app(simulator))
+        ),
+        base_url="http://mock",
+    )
+
+    weather = asyncio.run(api.get_weather("City 1", User(1, "")))
+    assert isinstance(weather, RateLimitError)
+    assert simulator.requests["rate_limited"] == 1
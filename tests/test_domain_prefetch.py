@@ -0,0 +1,148 @@
+import asyncio
+from datetime import datetime
+from unittest.mock import MagicMock
+
+import pytest
+
+from domain import ApiError, AsyncWeatherApi, WeatherApi, WeatherState, User
+from domain_cache import CityPopularity
+from domain_prefetch import PrefetchScheduler
+from domain_wrapper import AsyncCachedWeatherApi, CachedWeatherApi
+
+
+def weather(city):
+    return WeatherState(datetime.now(), city, 20.5, 19.0, 1015, 65)
+
+
+@pytest.fixture
+def mock_weather_api():
+    mock = MagicMock(spec=WeatherApi)
+    mock.get_weather.side_effect = lambda city, user: weather(city)
+    return mock
+
+
+@pytest.fixture
+def mock_async_weather_api():
+    mock = MagicMock(spec=AsyncWeatherApi)
+
+    async def mock_get_weather(city, user):
+        return weather(city)
+
+    mock.get_weather.side_effect = mock_get_weather
+    return mock
+
+
+def cache_expiring(cached_api, city):
+    cached_api.cache.set(city, weather(city), 30)
+
+
+def test_prefetch_requires_popularity(mock_weather_api):
+    with pytest.raises(ValueError):
+        PrefetchScheduler(CachedWeatherApi(mock_weather_api, 60))
+
+
+def test_prefetch_refreshes_entries_close_to_expiry(mock_weather_api):
+    now = [0.0]
+    cached_api = CachedWeatherApi(
+        mock_weather_api, 600, popularity=CityPopularity()
+    )
+    cached_api.cache.clock = lambda: now[0]
+    scheduler = PrefetchScheduler(
+        cached_api, refresh_ahead_seconds=60, jitter_seconds=0
+    )
+
+    user = User(1, "")
+    cached_api.get_weather("London", user)
+    asyncio.run(scheduler.tick())
+    assert mock_weather_api.get_weather.call_count == 1
+
+    now[0] = 550
+    asyncio.run(scheduler.tick())
+    assert mock_weather_api.get_weather.call_count == 2
+    assert scheduler.prefetched == 1
+    assert cached_api.cache.ttl("London") == 600
+
+
+def test_prefetch_respects_budget(mock_async_weather_api):
+    cached_api = AsyncCachedWeatherApi(
+        mock_async_weather_api, 600, popularity=CityPopularity()
+    )
+    scheduler = PrefetchScheduler(cached_api, budget_per_minute=2)
+
+    for city in ["London", "Moscow", "Kazan"]:
+        cached_api.popularity.record(city, User(1, ""))
+        cache_expiring(cached_api, city)
+
+    asyncio.run(scheduler.tick())
+    assert mock_async_weather_api.get_weather.call_count == 2
+    assert scheduler.skipped_over_budget == 1
+
+    asyncio.run(scheduler.tick())
+    assert mock_async_weather_api.get_weather.call_count == 2
+
+
+def test_prefetch_counts_failures(mock_async_weather_api):
+    async def mock_get_weather(city, user):
+        return ApiError("Error")
+
+    mock_async_weather_api.get_weather.side_effect = mock_get_weather
+    cached_api = AsyncCachedWeatherApi(
+        mock_async_weather_api, 600, popularity=CityPopularity()
+    )
+    scheduler = PrefetchScheduler(cached_api)
+    cached_api.popularity.record("London", User(1, ""))
+    cache_expiring(cached_api, "London")
+
+    asyncio.run(scheduler.tick())
+    assert scheduler.failed == 1
+
+
+def test_prefetch_skips_cities_without_entry(mock_async_weather_api):
+    async def mock_get_weather(city, user):
+        if city.startswith("bad"):
+            return ApiError("City not found")
+        return weather(city)
+
+    mock_async_weather_api.get_weather.side_effect = mock_get_weather
+    cached_api = AsyncCachedWeatherApi(
+        mock_async_weather_api, 600, popularity=CityPopularity()
+    )
+    scheduler = PrefetchScheduler(
+        cached_api, budget_per_minute=2, jitter_seconds=0
+    )
+
+    user = User(1, "")
+    for city in ["bad1", "bad2", "bad3"]:
+        for _ in range(5):
+            cached_api.popularity.record(city, user)
+    for city in ["London", "Moscow"]:
+        cached_api.popularity.record(city, user)
+        cache_expiring(cached_api, city)
+
+    for _ in range(12):
+        asyncio.run(scheduler.tick())
+
+    cities = [
+        call.args[0]
+        for call in mock_async_weather_api.get_weather.call_args_list
+    ]
+    assert sorted(cities) == ["London", "Moscow"]
+    assert scheduler.skipped_over_budget == 0
+
+
+def test_prefetch_start_stop(mock_async_weather_api):
+    cached_api = AsyncCachedWeatherApi(
+        mock_async_weather_api, 600, popularity=CityPopularity()
+    )
+    scheduler = PrefetchScheduler(cached_api, interval_seconds=0.01)
+    cached_api.popularity.record("London", User(1, ""))
+    cache_expiring(cached_api, "London")
+
+    async def run():
+        await scheduler.start()
+        await asyncio.sleep(0.05)
+        await scheduler.stop()
+
+    asyncio.run(run())
+    assert scheduler.task is None
+    assert mock_async_weather_api.get_weather.call_count == 1
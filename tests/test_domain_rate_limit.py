@@ -0,0 +1,108 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from domain_rate_limit import PRIORITY_BACKGROUND, AsyncRateLimiter, \
+    RateLimiter, current_priority, upstream_priority
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_rate_limiter_refills_up_to_burst():
+    clock = FakeClock()
+    limiter = RateLimiter(2, 3, max_wait_seconds=0, clock=clock)
+
+    assert [limiter.acquire() for _ in range(4)] == [True] * 3 + [False]
+    assert limiter.tokens == 0
+
+    clock.now = 0.5
+    assert limiter.tokens == 1
+    clock.now = 100
+    assert limiter.tokens == 3
+
+    stats = limiter.stats()
+    assert stats["acquired"] == 3
+    assert stats["rejected"] == 1
+    assert stats["queue_depth"] == 0
+
+
+def test_rate_limiter_stats_do_not_refill():
+    clock = FakeClock()
+    limiter = RateLimiter(2, 3, max_wait_seconds=0, clock=clock)
+    assert [limiter.acquire() for _ in range(3)] == [True] * 3
+
+    clock.now = 0.5
+    assert limiter.stats()["tokens"] == 1
+    assert limiter.available == 0
+    assert limiter.updated_at == 0
+
+    assert limiter.acquire()
+    assert limiter.tokens == 0
+
+
+def test_rate_limiter_waits_within_deadline():
+    limiter = RateLimiter(50, 1, max_wait_seconds=1)
+    assert limiter.acquire()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(lambda _: limiter.acquire(), range(2)))
+
+    assert results == [True, True]
+    assert limiter.stats()["max_wait_seconds"] > 0
+
+
+def test_rate_limiter_rejects_fast_when_queue_exceeds_deadline():
+    limiter = RateLimiter(1, 1, max_wait_seconds=0.5)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    assert limiter.stats()["wait_seconds"] < 0.5
+
+
+def test_upstream_priority_is_scoped():
+    assert current_priority() == 0
+    with upstream_priority(PRIORITY_BACKGROUND):
+        assert current_priority() == PRIORITY_BACKGROUND
+    assert current_priority() == 0
+
+
+def test_async_rate_limiter_serves_user_requests_before_background():
+    limiter = AsyncRateLimiter(20, 1, max_wait_seconds=1)
+    order = []
+
+    async def acquire(name, priority):
+        with upstream_priority(priority):
+            assert await limiter.acquire()
+        order.append(name)
+
+    async def run():
+        assert await limiter.acquire()
+        background = asyncio.create_task(
+            acquire("background", PRIORITY_BACKGROUND)
+        )
+        await asyncio.sleep(0)
+        user = asyncio.create_task(acquire("user", 0))
+        await asyncio.gather(background, user)
+
+    asyncio.run(run())
+    assert order == ["user", "background"]
+
+
+def test_async_rate_limiter_cancelled_waiter_leaves_queue():
+    limiter = AsyncRateLimiter(1, 1, max_wait_seconds=5)
+
+    async def run():
+        assert await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.01)
+        assert limiter.stats()["queue_depth"] == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+    asyncio.run(run())
+    assert limiter.stats()["queue_depth"] == 0
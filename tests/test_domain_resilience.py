@@ -0,0 +1,89 @@
+from domain import ApiError, NotFoundError, RateLimitError
+from domain_resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, \
+    LatencyWindow, is_upstream_failure
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_circuit_breaker_opens_on_failure_rate():
+    breaker = CircuitBreaker(window_size=4, min_calls=4, failure_rate=0.5)
+
+    for failed in (False, True, False):
+        assert breaker.allow()
+        breaker.record(failed, 0.1)
+    assert breaker.state == CLOSED
+
+    breaker.record(True, 0.1)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.stats() == {"state": OPEN, "opened": 1, "rejected": 1}
+
+
+def test_circuit_breaker_opens_on_slow_calls():
+    breaker = CircuitBreaker(
+        window_size=2, min_calls=2, slow_call_seconds=1, slow_call_rate=1
+    )
+    breaker.record(False, 1.5)
+    assert breaker.state == CLOSED
+    breaker.record(False, 3)
+    assert breaker.state == OPEN
+
+
+def test_circuit_breaker_half_open_probe():
+    clock = FakeClock()
+    breaker = CircuitBreaker(
+        window_size=1, min_calls=1, open_seconds=10, clock=clock
+    )
+    breaker.record(True, 0)
+    assert not breaker.allow()
+
+    clock.now = 10
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+
+    breaker.record(True, 0)
+    assert breaker.state == OPEN
+    assert breaker.opened == 2
+
+    clock.now = 20
+    assert breaker.allow()
+    breaker.record(False, 0)
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_circuit_breaker_release_frees_probe():
+    clock = FakeClock()
+    breaker = CircuitBreaker(window_size=1, min_calls=1, clock=clock)
+    breaker.record(True, 0)
+
+    clock.now = 100
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_is_upstream_failure():
+    assert is_upstream_failure(ApiError("Upstream returned 500"))
+    assert is_upstream_failure(None)
+    assert not is_upstream_failure(NotFoundError("City Nowhere Not Found"))
+    assert not is_upstream_failure(RateLimitError("budget exhausted"))
+
+
+def test_latency_window_percentile():
+    window = LatencyWindow(size=100)
+    assert window.percentile(0.95) is None
+
+    for i in range(200):
+        window.record(i / 100)
+    assert len(window) == 100
+    assert window.percentile(0.95) == 1.95
+    assert window.percentile(0) == 1.0
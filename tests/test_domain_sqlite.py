@@ -1,21 +1,30 @@
 import pytest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import os
 import contextlib
+import sqlite3
 
-from domain import WeatherState, User
-from domain_sqlite import SqliteWeatherRepository
+from domain import ApiError, HistoryCursor, WeatherHistory, WeatherState, \
+    User
+from domain_sqlite import SqliteWeatherRepository, SqliteGeocodeRepository, \
+    SqliteUserLoginRepository, SqliteUserRepository, SqliteWeatherCache, \
+    WEATHER_MIGRATIONS, history_query
+
+
+def remove_database(file_name):
+    for suffix in ("", "-wal", "-shm"):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file_name + suffix)
 
 
 @pytest.fixture
 def weather_repository():
-    with contextlib.suppress(FileNotFoundError):
-        os.remove("tests/test.db")
+    remove_database("tests/test.db")
 
     yield SqliteWeatherRepository("tests/test.db")
 
-    with contextlib.suppress(FileNotFoundError):
-        os.remove("tests/test.db")
+    remove_database("tests/test.db")
 
 
 @pytest.mark.skip
@@ -43,19 +52,19 @@ def test_weather_repository_save_weather(weather_repository):
         humidity=65
     )
 
-    count = weather_repository.cursor.execute(
+    count = weather_repository.pool.writer.execute(
         "SELECT COUNT(*) FROM weather"
     ).fetchone()[0]
     assert count == 0
 
     weather_repository.save_weather(weather, User(1, ""))
 
-    count = weather_repository.cursor.execute(
+    count = weather_repository.pool.writer.execute(
         "SELECT COUNT(*) FROM weather"
     ).fetchone()[0]
     assert count == 1
 
-    result = weather_repository.cursor.execute(
+    result = weather_repository.pool.writer.execute(
         """
         SELECT time, city, temperature, feels_like, pressure, humidity
         FROM weather
@@ -109,3 +118,436 @@ def test_weather_repository_get_weather_history(weather_repository):
     history = weather_repository.get_weather_history(1, user1)
     assert len(history) == 1
     assert_weather_eq(history[0], weather1)
+
+
+def test_weather_repository_saves_weather_without_user(weather_repository):
+    user = User(1, "")
+    weather = WeatherState(
+        time=datetime.now(),
+        city="London",
+        temperature=20.5,
+        feels_like=19.0,
+        pressure=1015,
+        humidity=65
+    )
+
+    weather_repository.save_weather(weather, None)
+
+    history = weather_repository.get_weather_history(5, "London")
+    assert len(history) == 1
+    assert_weather_eq(history[0], weather)
+    assert len(weather_repository.get_weather_history(5, user)) == 0
+
+
+@pytest.fixture
+def geocode_repository():
+    remove_database("tests/test_geocode.db")
+
+    yield SqliteGeocodeRepository("tests/test_geocode.db")
+
+    remove_database("tests/test_geocode.db")
+
+
+def test_geocode_repository(geocode_repository):
+    assert geocode_repository.get_lat_lon("London") is None
+
+    geocode_repository.save_lat_lon("London", (51.5, -0.12))
+    assert geocode_repository.get_lat_lon("LONDON ") == (51.5, -0.12)
+
+    other = SqliteGeocodeRepository("tests/test_geocode.db")
+    assert other.get_lat_lon("london") == (51.5, -0.12)
+
+
+def test_geocode_repository_negative(geocode_repository):
+    geocode_repository.save_lat_lon("Nowhere", None)
+    assert isinstance(geocode_repository.get_lat_lon("Nowhere"), ApiError)
+
+    geocode_repository.negative_cache_seconds = -1
+    assert geocode_repository.get_lat_lon("Nowhere") is None
+
+
+def test_weather_repository_save_weathers(weather_repository):
+    weather1 = WeatherState(
+        time=datetime.now() - timedelta(minutes=30),
+        city="London",
+        temperature=20.5,
+        feels_like=19.0,
+        pressure=1015,
+        humidity=65
+    )
+    weather2 = WeatherState(
+        time=datetime.now(),
+        city="London",
+        temperature=21.8,
+        feels_like=21.2,
+        pressure=1000,
+        humidity=60
+    )
+    user = User(1, "")
+
+    weather_repository.save_weathers(
+        [(weather1, user), (weather2, user), (weather2, user)]
+    )
+
+    history = weather_repository.get_weather_history(5, "London")
+    assert len(history) == 2
+    assert_weather_eq(history[0], weather2)
+    assert_weather_eq(history[1], weather1)
+
+
+def test_weather_repository_reads_while_writing(weather_repository):
+    weather_repository.save_weather(
+        WeatherState(datetime.now(), "London", 20.5, 19.0, 1015, 65),
+        User(1, "")
+    )
+
+    with weather_repository.pool.write():
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(
+                    weather_repository.get_weather_history, 5, "London"
+                )
+                for _ in range(2)
+            ]
+            assert [len(f.result(timeout=5)) for f in futures] == [1, 1]
+
+    stats = weather_repository.stats()
+    assert stats["read_waits"] == 2
+    assert stats["write_waits"] >= 2
+
+    mode = weather_repository.pool.writer.execute(
+        "PRAGMA journal_mode"
+    ).fetchone()[0]
+    assert mode == "wal"
+
+
+@pytest.fixture
+def user_repository():
+    remove_database("tests/test_users.db")
+
+    yield SqliteUserRepository("tests/test_users.db", readers=2)
+
+    remove_database("tests/test_users.db")
+
+
+def test_user_repository(user_repository):
+    assert user_repository.get_user("token1") is None
+
+    user_repository.save_user(1, "token1")
+    user = user_repository.get_user("token1")
+    assert user.telegram_id == 1
+    assert user.token == "token1"
+
+    user_repository.save_user(1, "token2")
+    assert user_repository.get_user("token1") is None
+    assert user_repository.get_user("token2").telegram_id == 1
+
+
+def test_user_repository_in_memory():
+    repository = SqliteUserRepository(":memory:")
+    repository.save_user(1, "token1")
+    assert repository.get_user("token1").telegram_id == 1
+
+
+def query_plan(repository, sql, args):
+    with repository.pool.read() as connection:
+        rows = connection.execute("EXPLAIN QUERY PLAN " + sql, args)
+        return [row[3] for row in rows]
+
+
+@pytest.mark.parametrize("city_or_user", ["London", User(1, "")])
+def test_weather_history_query_plan(weather_repository, city_or_user):
+    sql, args = history_query(5, city_or_user)
+    plan = query_plan(weather_repository, sql, args)
+
+    assert all(step.startswith("SEARCH") for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+
+
+def test_weather_repository_migrates_legacy_database():
+    remove_database("tests/test_legacy.db")
+
+    connection = sqlite3.connect("tests/test_legacy.db")
+    connection.execute(WEATHER_MIGRATIONS[0][0])
+    connection.execute(
+        "INSERT INTO weather VALUES (1000, 'London', 1.0, 2.0, 3, 4, 5)"
+    )
+    connection.commit()
+    connection.close()
+
+    repository = SqliteWeatherRepository("tests/test_legacy.db")
+    version = repository.pool.writer.execute(
+        "PRAGMA user_version"
+    ).fetchone()[0]
+    assert version == len(WEATHER_MIGRATIONS)
+
+    history = repository.get_weather_history(5, User(5, ""))
+    assert len(history) == 1
+    assert history[0].city == "London"
+
+    SqliteWeatherRepository("tests/test_legacy.db")
+    remove_database("tests/test_legacy.db")
+
+
+def test_weather_repository_history_filters(weather_repository):
+    start = datetime(2024, 1, 1)
+    user = User(1, "")
+    for hour in range(5):
+        weather_repository.save_weather(
+            WeatherState(start + timedelta(hours=hour), "London",
+                         float(hour), 0.0, 1000, 50),
+            user
+        )
+
+    def temperatures(**filters):
+        history = weather_repository.get_weather_history(
+            10, "London", **filters
+        )
+        return [weather.temperature for weather in history]
+
+    assert temperatures(from_time=start + timedelta(hours=1),
+                        to_time=start + timedelta(hours=3)) == [3, 2, 1]
+    assert temperatures(after=start + timedelta(hours=1),
+                        before=start + timedelta(hours=3)) == [2]
+
+
+def test_weather_repository_history_cursor(weather_repository):
+    time = datetime(2024, 1, 1)
+    user = User(1, "")
+    for city in ["Kazan", "London", "Moscow"]:
+        weather_repository.save_weather(
+            WeatherState(time, city, 1.0, 0.0, 1000, 50), user
+        )
+    weather_repository.save_weather(
+        WeatherState(time - timedelta(hours=1), "London", 2.0, 0.0, 1000, 50),
+        user
+    )
+
+    pages = []
+    cursor = None
+    while True:
+        page = weather_repository.get_weather_history(2, user, cursor=cursor)
+        if not page:
+            break
+        pages.append([(weather.city, weather.temperature) for weather in page])
+        cursor = HistoryCursor(page[-1].time, page[-1].city)
+
+    assert pages == [
+        [("Kazan", 1.0), ("London", 1.0)],
+        [("Moscow", 1.0), ("London", 2.0)],
+    ]
+
+
+def test_weather_repository_history_is_columnar(weather_repository):
+    time = datetime(2024, 1, 1, 12, 30, 15, 123000)
+    user = User(1, "")
+    for minutes, city in enumerate(["Kazan", "London", "London"]):
+        weather_repository.save_weather(
+            WeatherState(time + timedelta(minutes=minutes), city,
+                         1.5, 0.25, 1000, 50),
+            user
+        )
+
+    history = weather_repository.get_weather_history(5, user)
+    assert isinstance(history, WeatherHistory)
+    assert history.times.typecode == "q"
+    assert history.cities[0] is history.cities[1]
+    assert list(history.rows())[-1] == (
+        time.timestamp(), "Kazan", 1.5, 0.25, 1000, 50
+    )
+    assert [weather.city for weather in history[1:]] == ["London", "Kazan"]
+
+
+def test_weather_history_cursor_query_plan(weather_repository):
+    sql, args = history_query(
+        5, User(1, ""), from_time=datetime(2024, 1, 1),
+        cursor=HistoryCursor(datetime(2024, 1, 2), "London")
+    )
+    plan = query_plan(weather_repository, sql, args)
+
+    assert all(step.startswith("SEARCH") for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+
+
+def test_weather_repository_iter_weather_history(weather_repository):
+    start = datetime(2024, 1, 1)
+    user = User(1, "")
+    weather_repository.save_weathers([
+        (WeatherState(start + timedelta(minutes=minute), "London",
+                      float(minute), 0.0, 1000, 50), user)
+        for minute in range(10)
+    ])
+
+    chunks = list(weather_repository.iter_weather_history(
+        "London", chunk_size=4, from_time=start + timedelta(minutes=1)
+    ))
+    assert [len(chunk) for chunk in chunks] == [4, 4, 1]
+    temperatures = [weather.temperature for chunk in chunks
+                    for weather in chunk]
+    assert temperatures == [float(minute) for minute in range(9, 0, -1)]
+
+
+def test_weather_repository_get_weather_aggregates(weather_repository):
+    start = datetime.fromtimestamp(1704067200)
+    user = User(1, "")
+    weather_repository.save_weathers([
+        (WeatherState(start + timedelta(minutes=10 * i), "London",
+                      float(i), float(-i), 1000 + i, 50 + i), user)
+        for i in range(15)
+    ])
+
+    aggregates = weather_repository.get_weather_aggregates(
+        "London", 3600, 10, from_time=start + timedelta(minutes=10)
+    )
+    assert [aggregate.time for aggregate in aggregates] == [
+        start, start + timedelta(hours=1), start + timedelta(hours=2)
+    ]
+    assert [aggregate.count for aggregate in aggregates] == [5, 6, 3]
+
+    hour = aggregates[1]
+    assert vars(hour.temperature) == {
+        "min": 6.0, "max": 11.0, "mean": 8.5, "last": 11.0
+    }
+    assert vars(hour.feels_like) == {
+        "min": -11.0, "max": -6.0, "mean": -8.5, "last": -11.0
+    }
+    assert hour.pressure.last == 1011
+    assert hour.humidity.mean == 58.5
+
+    latest = weather_repository.get_weather_aggregates(user, 3600, 1)
+    assert len(latest) == 1
+    assert latest[0].time == start + timedelta(hours=2)
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_weather_cache_expires_entries():
+    clock = FakeClock()
+    cache = SqliteWeatherCache(":memory:", clock=clock)
+    weather = WeatherState(datetime.now(), "London", 20.5, 19.0, 1015, 65)
+
+    assert cache.get_weather("London") == (None, None)
+    cache.save_weather("London", weather, 60)
+    cached, ttl = cache.get_weather("London")
+    assert_weather_eq(cached, weather)
+    assert ttl == 60
+
+    clock.now += 60
+    assert cache.get_weather("London") == (None, None)
+    assert cache.purge_expired() == 1
+
+
+def test_weather_cache_purges_on_save():
+    clock = FakeClock()
+    cache = SqliteWeatherCache(":memory:", purge_every=2, clock=clock)
+    weather = WeatherState(datetime.now(), "London", 20.5, 19.0, 1015, 65)
+
+    cache.save_weather("London", weather, 60)
+    assert cache.acquire_lease("Paris", "crashed", 5)
+    clock.now += 60
+    cache.save_weather("Moscow", weather, 60)
+
+    with cache.pool.read() as connection:
+        assert connection.execute(
+            "SELECT city FROM weather_cache"
+        ).fetchall() == [("Moscow",)]
+        assert connection.execute(
+            "SELECT COUNT(*) FROM weather_cache_leases"
+        ).fetchone() == (0,)
+
+
+def test_weather_cache_leases_are_exclusive_until_expired():
+    clock = FakeClock()
+    cache = SqliteWeatherCache(":memory:", clock=clock)
+
+    assert cache.acquire_lease("London", "a", 5)
+    assert not cache.acquire_lease("London", "b", 5)
+    assert cache.acquire_lease("Paris", "b", 5)
+
+    cache.release_lease("London", "b")
+    assert not cache.acquire_lease("London", "b", 5)
+    cache.release_lease("London", "a")
+    assert cache.acquire_lease("London", "b", 5)
+
+    clock.now += 5
+    assert cache.acquire_lease("London", "a", 5)
+
+
+def test_weather_cache_is_shared_between_connections():
+    remove_database("tests/test_cache.db")
+    try:
+        first = SqliteWeatherCache("tests/test_cache.db")
+        second = SqliteWeatherCache("tests/test_cache.db")
+        weather = WeatherState(datetime.now(), "London", 20.5, 19.0, 1015, 65)
+
+        assert first.acquire_lease("London", "first", 5)
+        assert not second.acquire_lease("London", "second", 5)
+        first.save_weather("London", weather, 60)
+        assert_weather_eq(second.get_weather("London")[0], weather)
+    finally:
+        remove_database("tests/test_cache.db")
+
+
+def test_user_login_repository_expires_logins():
+    clock = FakeClock()
+    repository = SqliteUserLoginRepository(
+        ":memory:", ttl_seconds=60, clock=clock
+    )
+
+    repository.add_user_login("old", "https://example.com/old")
+    repository.add_user_login("new", "https://example.com/new")
+    assert repository.delete_user_login("new") == "https://example.com/new"
+    assert repository.delete_user_login("new") is None
+
+    clock.now += 60
+    assert repository.delete_user_login("old") is None
+
+
+def test_user_login_repository_purges_expired_and_overflow():
+    clock = FakeClock()
+    repository = SqliteUserLoginRepository(
+        ":memory:", ttl_seconds=60, max_logins=3, purge_every=1000,
+        clock=clock,
+    )
+    for token in ("a", "b"):
+        repository.add_user_login(token, f"https://example.com/{token}")
+    clock.now += 60
+    for token in ("c", "d", "e", "f"):
+        clock.now += 1
+        repository.add_user_login(token, f"https://example.com/{token}")
+
+    assert repository.purge() == 3
+    stats = repository.stats()
+    assert (stats["size"], stats["expired"], stats["evicted"]) == (3, 2, 1)
+    assert repository.delete_user_login("c") is None
+    assert repository.delete_user_login("d") == "https://example.com/d"
+
+
+def test_user_login_repository_is_shared_between_workers():
+    remove_database("tests/test_logins.db")
+    try:
+        first = SqliteUserLoginRepository("tests/test_logins.db")
+        second = SqliteUserLoginRepository("tests/test_logins.db")
+
+        first.add_user_login("token", "https://example.com")
+        assert second.delete_user_login("token") == "https://example.com"
+        assert first.delete_user_login("token") is None
+    finally:
+        remove_database("tests/test_logins.db")
+
+
+def test_user_login_purge_uses_expiry_index():
+    repository = SqliteUserLoginRepository(":memory:")
+    with repository.pool.read() as connection:
+        plan = connection.execute(
+            "EXPLAIN QUERY PLAN DELETE FROM user_logins WHERE expire_at <= ?",
+            (0,),
+        ).fetchall()
+    assert "user_logins_expire_at" in str(plan)
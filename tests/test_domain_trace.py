@@ -0,0 +1,83 @@
+import json
+import os
+
+from domain_sqlite import SqliteUserRepository
+from domain_trace import Tracer, current_trace, record_statement, span
+
+
+def test_spans_are_ignored_without_trace():
+    with span("layer.method") as attributes:
+        attributes["rows"] = 1
+    record_statement("SELECT 1")
+    assert current_trace() is None
+
+
+def test_tracer_keeps_slow_traces_with_nested_spans():
+    tracer = Tracer(sample_rate=0, slow_seconds=0)
+    trace, token = tracer.begin("GET", "/weather/history")
+    with span("outer"):
+        with span("inner") as attributes:
+            attributes["rows"] = 3
+    record_statement("SELECT *\n  FROM weather WHERE city = 'London'")
+    tracer.end(trace, token, 200)
+
+    assert current_trace() is None
+    [recorded] = tracer.recent()
+    assert recorded["status"] == 200
+    assert [(s["name"], s["depth"]) for s in recorded["spans"]] == [
+        ("outer", 0), ("inner", 1)
+    ]
+    assert recorded["spans"][1]["rows"] == 3
+    assert recorded["statements"][0]["sql"] == \
+        "SELECT * FROM weather WHERE city = ?"
+
+
+def test_tracer_drops_fast_unsampled_traces():
+    tracer = Tracer(sample_rate=0, slow_seconds=60)
+    trace, token = tracer.begin("GET", "/weather")
+    tracer.end(trace, token, 200)
+
+    assert tracer.recent() == []
+    assert tracer.traced == 1
+    assert tracer.kept == 0
+
+
+def test_tracer_ring_buffer_and_events_are_bounded():
+    tracer = Tracer(sample_rate=1, max_traces=2, max_events=2)
+    for path in ("/a", "/b", "/c"):
+        trace, token = tracer.begin("GET", path)
+        for _ in range(3):
+            with span("layer"):
+                pass
+        tracer.end(trace, token, 200)
+
+    recent = tracer.recent()
+    assert [trace["path"] for trace in recent] == ["/c", "/b"]
+    assert len(recent[0]["spans"]) == 2
+    assert recent[0]["dropped_events"] == 1
+
+
+def test_tracer_dumps_slow_traces(tmp_path):
+    tracer = Tracer(sample_rate=0, slow_seconds=0, dump_directory=tmp_path)
+    trace, token = tracer.begin("GET", "/weather/history")
+    tracer.end(trace, token, 200)
+
+    [file_name] = os.listdir(tmp_path)
+    with open(tmp_path / file_name) as file:
+        assert json.load(file)["id"] == trace.id
+
+
+def test_sqlite_statements_and_waits_are_traced():
+    users = SqliteUserRepository(":memory:")
+    tracer = Tracer(sample_rate=1)
+    trace, token = tracer.begin("GET", "/user/telegram_id")
+    users.get_user("secret-token")
+    tracer.end(trace, token, 200)
+
+    [recorded] = tracer.recent()
+    assert recorded["spans"][0]["name"] == "sqlite.write"
+    assert "wait_ms" in recorded["spans"][0]
+    assert recorded["statements"] == [{
+        "at_ms": recorded["statements"][0]["at_ms"],
+        "sql": "SELECT telegram_id FROM users WHERE token = ?",
+    }]
@@ -1,9 +1,26 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
 import pytest
 from unittest.mock import MagicMock
 from datetime import datetime
 
-from domain import WeatherApi, WeatherRepository, WeatherState, ApiError, User
-from domain_wrapper import WeatherApiWithRepository, CachedWeatherApi
+from domain import AsyncWeatherApi, CircuitOpenError, GeocodeRepository, \
+    WeatherApi, WeatherRepository, WeatherState, ApiError, User, \
+    UserRepository
+from domain_metrics import MetricsRegistry
+from domain_sqlite import SqliteWeatherCache
+from domain_resilience import CircuitBreaker
+from domain_wrapper import WeatherApiWithRepository, CachedWeatherApi, \
+    AsyncWeatherApiWithRepository, AsyncCachedWeatherApi, \
+    AsyncCircuitBreakerWeatherApi, AsyncHedgedWeatherApi, \
+    CachedGeocodeRepository, CachedUserRepository, \
+    CircuitBreakerWeatherApi, HedgedWeatherApi, InstrumentedUserRepository, \
+    InstrumentedWeatherApi, InstrumentedWeatherRepository, \
+    AsyncInstrumentedWeatherApi, WriteBehindWeatherRepository
+from domain_rate_limit import PRIORITY_BACKGROUND, PRIORITY_USER, \
+    current_priority, upstream_priority
 
 
 @pytest.fixture
@@ -53,6 +70,18 @@ def test_weather_api_with_repository(mock_weather_api,
     mock_weather_repository.save_weather.assert_called_once_with(weather, user)
 
 
+def test_weather_api_with_repository_background(mock_weather_api,
+                                                mock_weather_repository):
+    wrapped = WeatherApiWithRepository(
+        mock_weather_api,
+        mock_weather_repository
+    )
+
+    with upstream_priority(PRIORITY_BACKGROUND):
+        weather = wrapped.get_weather("London", User(1, ""))
+    mock_weather_repository.save_weather.assert_called_once_with(weather, None)
+
+
 def test_weather_api_with_repository_error(mock_weather_api_error,
                                            mock_weather_repository):
     wrapped = WeatherApiWithRepository(
@@ -76,7 +105,734 @@ def test_cached_weather_api(mock_weather_api):
     weather3 = wrapped.get_weather("Moscow", user)
     assert weather1.time != weather3.time
 
-    wrapped.cache["London"]["expire_time"] = 0
+    wrapped.cache.clock = lambda: time.monotonic() + 3
 
     weather4 = wrapped.get_weather("London", user)
     assert weather1.time != weather4.time
+
+
+@pytest.fixture
+def mock_async_weather_api():
+    mock = MagicMock(spec=AsyncWeatherApi)
+
+    async def mock_get_weather(city, user):
+        return WeatherState(
+            time=datetime.now(),
+            city=city,
+            temperature=20.5,
+            feels_like=19.0,
+            pressure=1015,
+            humidity=65
+        )
+
+    mock.get_weather.side_effect = mock_get_weather
+    return mock
+
+
+def test_async_weather_api_with_repository(mock_async_weather_api,
+                                           mock_weather_repository):
+    wrapped = AsyncWeatherApiWithRepository(
+        mock_async_weather_api,
+        mock_weather_repository
+    )
+
+    user = User(1, "")
+    weather = asyncio.run(wrapped.get_weather("London", user))
+    mock_weather_repository.save_weather.assert_called_once_with(weather, user)
+
+
+def test_async_weather_api_with_repository_background(
+        mock_async_weather_api, mock_weather_repository):
+    wrapped = AsyncWeatherApiWithRepository(
+        mock_async_weather_api,
+        mock_weather_repository
+    )
+
+    async def run():
+        with upstream_priority(PRIORITY_BACKGROUND):
+            return await wrapped.get_weather("London", User(1, ""))
+
+    weather = asyncio.run(run())
+    mock_weather_repository.save_weather.assert_called_once_with(weather, None)
+
+
+def test_async_cached_weather_api(mock_async_weather_api):
+    wrapped = AsyncCachedWeatherApi(mock_async_weather_api, 2)
+
+    async def run():
+        user = User(1, "")
+        weather1 = await wrapped.get_weather("London", user)
+        weather2 = await wrapped.get_weather("London", user)
+        assert weather1 is weather2
+
+        wrapped.cache.clock = lambda: time.monotonic() + 3
+
+        weather3 = await wrapped.get_weather("London", user)
+        assert weather1 is not weather3
+
+        await wrapped.aclose()
+
+    asyncio.run(run())
+    assert mock_async_weather_api.get_weather.call_count == 2
+    mock_async_weather_api.aclose.assert_awaited_once()
+
+
+def test_cached_geocode_repository():
+    repository = MagicMock(spec=GeocodeRepository)
+    repository.get_lat_lon.side_effect = lambda city: (1.0, 2.0)
+    wrapped = CachedGeocodeRepository(repository, max_size=2)
+
+    assert wrapped.get_lat_lon("London") == (1.0, 2.0)
+    assert wrapped.get_lat_lon(" london") == (1.0, 2.0)
+    assert repository.get_lat_lon.call_count == 1
+
+    wrapped.save_lat_lon("Moscow", (3.0, 4.0))
+    wrapped.save_lat_lon("Kazan", (5.0, 6.0))
+    assert list(wrapped.cache.entries) == ["moscow", "kazan"]
+
+    wrapped.save_lat_lon("Kazan", None)
+    assert list(wrapped.cache.entries) == ["moscow"]
+
+
+def test_cached_weather_api_coalesces_misses():
+    release = Event()
+    mock = MagicMock(spec=WeatherApi)
+
+    def mock_get_weather(city, user):
+        release.wait()
+        return WeatherState(datetime.now(), city, 20.5, 19.0, 1015, 65)
+
+    mock.get_weather.side_effect = mock_get_weather
+    wrapped = CachedWeatherApi(mock, 60)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(wrapped.get_weather, "London", User(1, ""))
+            for _ in range(4)
+        ]
+        while wrapped.coalesced_requests < 3:
+            pass
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert mock.get_weather.call_count == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_async_cached_weather_api_coalesces_misses(mock_async_weather_api):
+    wrapped = AsyncCachedWeatherApi(mock_async_weather_api, 60)
+
+    async def run():
+        return await asyncio.gather(
+            *(wrapped.get_weather("London", User(1, "")) for _ in range(4))
+        )
+
+    results = asyncio.run(run())
+    assert mock_async_weather_api.get_weather.call_count == 1
+    assert wrapped.coalesced_requests == 3
+    assert all(result is results[0] for result in results)
+
+
+def test_cached_weather_api_shares_cache_between_workers(mock_weather_api):
+    shared_cache = SqliteWeatherCache(":memory:")
+    first = CachedWeatherApi(mock_weather_api, 60, shared_cache=shared_cache)
+    second = CachedWeatherApi(mock_weather_api, 60, shared_cache=shared_cache)
+
+    first.get_weather("London", User(1, ""))
+    assert second.get_weather("London", User(2, "")).city == "London"
+    assert second.get_cached_weather("London") is not None
+    assert mock_weather_api.get_weather.call_count == 1
+
+
+def test_cached_weather_api_waits_for_leased_fetch(mock_weather_api):
+    shared_cache = SqliteWeatherCache(":memory:")
+    wrapped = CachedWeatherApi(
+        mock_weather_api, 60, shared_cache=shared_cache, poll_seconds=0.01
+    )
+    assert shared_cache.acquire_lease("London", "other-worker", 5)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(wrapped.get_weather, "London", User(1, ""))
+        time.sleep(0.05)
+        weather = WeatherState(datetime.now(), "London", 1.0, 0.0, 1000, 50)
+        shared_cache.save_weather("London", weather, 60)
+        assert future.result().temperature == 1.0
+
+    assert not mock_weather_api.get_weather.called
+
+
+def test_cached_weather_api_fetches_after_lease_timeout(mock_weather_api):
+    shared_cache = SqliteWeatherCache(":memory:")
+    wrapped = CachedWeatherApi(
+        mock_weather_api, 60, shared_cache=shared_cache,
+        lease_seconds=0.05, poll_seconds=0.01,
+    )
+    assert shared_cache.acquire_lease("London", "stuck-worker", 60)
+
+    assert isinstance(wrapped.get_weather("London", User(1, "")),
+                      WeatherState)
+    assert mock_weather_api.get_weather.call_count == 1
+
+
+def test_async_cached_weather_api_shares_cache_between_workers(
+        mock_async_weather_api):
+    shared_cache = SqliteWeatherCache(":memory:")
+    first = AsyncCachedWeatherApi(
+        mock_async_weather_api, 60, shared_cache=shared_cache
+    )
+    second = AsyncCachedWeatherApi(
+        mock_async_weather_api, 60, shared_cache=shared_cache
+    )
+
+    async def run():
+        await first.get_weather("London", User(1, ""))
+        return await second.get_weather("London", User(2, ""))
+
+    assert isinstance(asyncio.run(run()), WeatherState)
+    assert mock_async_weather_api.get_weather.call_count == 1
+    assert second.get_cached_weather("London") is not None
+
+
+def shared_workers(api, worker_class, count=2):
+    now = [0.0]
+    shared_cache = SqliteWeatherCache(":memory:", clock=lambda: now[0])
+    workers = [
+        worker_class(api, 10, stale_seconds=20, shared_cache=shared_cache)
+        for _ in range(count)
+    ]
+    for worker in workers:
+        worker.cache.clock = lambda: now[0]
+    return now, workers
+
+
+def test_cached_weather_api_shares_stale_refreshes(mock_weather_api):
+    now, (first, second) = shared_workers(mock_weather_api, CachedWeatherApi)
+    first.get_weather("London", User(1, ""))
+    second.get_weather("London", User(2, ""))
+
+    now[0] = 15
+    first.get_weather("London", User(1, ""))
+    wait_until(lambda: not first.refreshing)
+    assert mock_weather_api.get_weather.call_count == 2
+
+    assert second.get_weather("London", User(2, "")) is \
+        second.get_cached_weather("London")
+    assert not second.refreshing
+    assert mock_weather_api.get_weather.call_count == 2
+
+
+def test_cached_weather_api_shares_prefetch_refreshes(mock_weather_api):
+    now, (first, second) = shared_workers(mock_weather_api, CachedWeatherApi)
+    first.get_weather("London", User(1, ""))
+    second.get_weather("London", User(2, ""))
+
+    now[0] = 5
+    first.refresh("London", User(1, ""))
+    second.refresh("London", User(2, ""))
+    assert mock_weather_api.get_weather.call_count == 2
+    assert second.get_cached_weather_ttl("London") == 10
+
+
+def test_async_cached_weather_api_shares_refreshes(mock_async_weather_api):
+    now, (first, second) = shared_workers(
+        mock_async_weather_api, AsyncCachedWeatherApi
+    )
+
+    async def run():
+        await first.get_weather("London", User(1, ""))
+        await second.get_weather("London", User(2, ""))
+        now[0] = 5
+        await first.refresh("London", User(1, ""))
+        await second.refresh("London", User(2, ""))
+        now[0] = 20
+        await first.get_weather("London", User(1, ""))
+        await asyncio.gather(*first.refreshing.values())
+        await second.get_weather("London", User(2, ""))
+        assert not second.refreshing
+
+    asyncio.run(run())
+    assert mock_async_weather_api.get_weather.call_count == 3
+
+
+def test_cached_weather_api_get_cached_weather_is_local(mock_weather_api):
+    shared_cache = SqliteWeatherCache(":memory:")
+    first = CachedWeatherApi(mock_weather_api, 60, shared_cache=shared_cache)
+    second = CachedWeatherApi(mock_weather_api, 60, shared_cache=shared_cache)
+
+    first.get_weather("London", User(1, ""))
+    assert second.get_cached_weather("London") is None
+
+
+def test_cached_weather_api_is_bounded(mock_weather_api):
+    wrapped = CachedWeatherApi(mock_weather_api, 60, max_size=2)
+
+    user = User(1, "")
+    for city in ["London", "Moscow", "Kazan"]:
+        wrapped.get_weather(city, user)
+
+    assert len(wrapped.cache) == 2
+    assert wrapped.cache.stats()["evictions"] == 1
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_cached_weather_api_stale_while_revalidate(mock_weather_api):
+    now = [0.0]
+    wrapped = CachedWeatherApi(mock_weather_api, 10, stale_seconds=20)
+    wrapped.cache.clock = lambda: now[0]
+
+    user = User(1, "")
+    weather1 = wrapped.get_weather("London", user)
+
+    now[0] = 15
+    weather2 = wrapped.get_weather("London", user)
+    assert weather2 is weather1
+    wait_until(lambda: mock_weather_api.get_weather.call_count == 2)
+    wait_until(lambda: not wrapped.refreshing)
+
+    weather3 = wrapped.get_weather("London", user)
+    assert weather3 is not weather1
+
+    now[0] = 100
+    weather4 = wrapped.get_weather("London", user)
+    assert weather4 is not weather3
+    assert mock_weather_api.get_weather.call_count == 3
+
+
+def test_cached_weather_api_failed_refresh_falls_back(mock_weather_api):
+    now = [0.0]
+    wrapped = CachedWeatherApi(mock_weather_api, 10, stale_seconds=20)
+    wrapped.cache.clock = lambda: now[0]
+
+    user = User(1, "")
+    weather1 = wrapped.get_weather("London", user)
+
+    mock_weather_api.get_weather.side_effect = \
+        lambda city, user: ApiError("Error")
+    now[0] = 15
+    assert wrapped.get_weather("London", user) is weather1
+    wait_until(lambda: "London" in wrapped.failed_refreshes)
+
+    weather2 = wrapped.get_weather("London", user)
+    assert isinstance(weather2, ApiError)
+    assert mock_weather_api.get_weather.call_count == 3
+
+
+def test_cached_weather_api_refreshes_at_background_priority(
+        mock_weather_api):
+    now = [0.0]
+    priorities = []
+    get_weather = mock_weather_api.get_weather.side_effect
+
+    def record_priority(city, user):
+        priorities.append(current_priority())
+        return get_weather(city, user)
+
+    mock_weather_api.get_weather.side_effect = record_priority
+    wrapped = CachedWeatherApi(mock_weather_api, 10, stale_seconds=20)
+    wrapped.cache.clock = lambda: now[0]
+
+    user = User(1, "")
+    wrapped.get_weather("London", user)
+    now[0] = 15
+    wrapped.get_weather("London", user)
+    wait_until(lambda: len(priorities) == 2)
+    wrapped.refresh("Paris", user)
+
+    assert priorities == [
+        PRIORITY_USER, PRIORITY_BACKGROUND, PRIORITY_BACKGROUND
+    ]
+
+
+def test_circuit_breaker_weather_api_fails_fast(mock_weather_api):
+    mock_weather_api.get_weather.side_effect = \
+        lambda city, user: ApiError("Upstream returned 500")
+    wrapped = CircuitBreakerWeatherApi(
+        mock_weather_api, CircuitBreaker(window_size=2, min_calls=2)
+    )
+
+    user = User(1, "")
+    wrapped.get_weather("London", user)
+    wrapped.get_weather("London", user)
+    weather = wrapped.get_weather("London", user)
+
+    assert isinstance(weather, CircuitOpenError)
+    assert mock_weather_api.get_weather.call_count == 2
+
+
+def test_cached_weather_api_serves_stale_while_circuit_open(
+        mock_weather_api):
+    now = [0.0]
+    breaker = CircuitBreaker(window_size=1, min_calls=1)
+    wrapped = CachedWeatherApi(
+        CircuitBreakerWeatherApi(mock_weather_api, breaker),
+        10,
+        stale_seconds=20,
+    )
+    wrapped.cache.clock = lambda: now[0]
+
+    user = User(1, "")
+    weather1 = wrapped.get_weather("London", user)
+    breaker.record(True, 0)
+
+    now[0] = 15
+    assert wrapped.get_weather("London", user) is weather1
+    wait_until(lambda: "London" in wrapped.failed_refreshes)
+    assert wrapped.get_weather("London", user) is weather1
+    assert isinstance(wrapped.get_weather("Paris", user), CircuitOpenError)
+    assert mock_weather_api.get_weather.call_count == 1
+
+
+def test_async_circuit_breaker_weather_api_probes_when_half_open(
+        mock_async_weather_api):
+    now = [0.0]
+    breaker = CircuitBreaker(
+        window_size=1, min_calls=1, open_seconds=10, clock=lambda: now[0]
+    )
+    wrapped = AsyncCircuitBreakerWeatherApi(mock_async_weather_api, breaker)
+    breaker.record(True, 0)
+
+    user = User(1, "")
+    weather = asyncio.run(wrapped.get_weather("London", user))
+    assert isinstance(weather, CircuitOpenError)
+
+    now[0] = 10
+    weather = asyncio.run(wrapped.get_weather("London", user))
+    assert isinstance(weather, WeatherState)
+    assert breaker.state == "closed"
+
+
+def test_hedged_weather_api_returns_faster_attempt(mock_weather_api):
+    get_weather = mock_weather_api.get_weather.side_effect
+    calls = []
+
+    def slow_first_call(city, user):
+        calls.append(city)
+        if len(calls) == 1:
+            time.sleep(0.5)
+        return get_weather(city, user)
+
+    mock_weather_api.get_weather.side_effect = slow_first_call
+    wrapped = HedgedWeatherApi(mock_weather_api, min_samples=1)
+    wrapped.latencies.record(0.01)
+
+    started = time.monotonic()
+    weather = wrapped.get_weather("London", User(1, ""))
+    assert isinstance(weather, WeatherState)
+    assert time.monotonic() - started < 0.4
+    assert wrapped.hedged == 1
+    assert wrapped.hedge_wins == 1
+
+
+def test_hedged_weather_api_waits_for_samples(mock_weather_api):
+    wrapped = HedgedWeatherApi(mock_weather_api, min_samples=2)
+    assert wrapped.hedge_delay() is None
+
+    wrapped.get_weather("London", User(1, ""))
+    wrapped.get_weather("London", User(1, ""))
+    assert wrapped.hedge_delay() == wrapped.min_delay_seconds
+    assert wrapped.hedged == 0
+
+
+def test_async_hedged_weather_api_cancels_slower_attempt():
+    cancelled = []
+
+    class SlowFirstApi(AsyncWeatherApi):
+
+        def __init__(self):
+            self.calls = 0
+
+        async def get_weather(self, city, user):
+            self.calls += 1
+            if self.calls == 1:
+                try:
+                    await asyncio.sleep(5)
+                except asyncio.CancelledError:
+                    cancelled.append(city)
+                    raise
+            return WeatherState(datetime.now(), city, 20.5, 19.0, 1015, 65)
+
+    wrapped = AsyncHedgedWeatherApi(SlowFirstApi(), min_samples=1)
+    wrapped.latencies.record(0.01)
+
+    async def run():
+        weather = await wrapped.get_weather("London", User(1, ""))
+        await asyncio.sleep(0)
+        return weather
+
+    weather = asyncio.run(run())
+    assert isinstance(weather, WeatherState)
+    assert wrapped.hedge_wins == 1
+    assert cancelled == ["London"]
+
+
+def test_async_cached_weather_api_stale_while_revalidate(
+        mock_async_weather_api):
+    now = [0.0]
+    wrapped = AsyncCachedWeatherApi(
+        mock_async_weather_api, 10, stale_seconds=20
+    )
+    wrapped.cache.clock = lambda: now[0]
+
+    async def run():
+        user = User(1, "")
+        weather1 = await wrapped.get_weather("London", user)
+
+        now[0] = 15
+        weather2 = await wrapped.get_weather("London", user)
+        assert weather2 is weather1
+        await asyncio.gather(*wrapped.refreshing.values())
+
+        weather3 = await wrapped.get_weather("London", user)
+        assert weather3 is not weather1
+
+    asyncio.run(run())
+    assert mock_async_weather_api.get_weather.call_count == 2
+
+
+def test_write_behind_weather_repository_batches(mock_weather_repository):
+    repository = WriteBehindWeatherRepository(
+        mock_weather_repository, batch_size=2, flush_interval_ms=60000
+    )
+
+    user = User(1, "")
+    weather1 = WeatherState(datetime.now(), "London", 20.5, 19.0, 1015, 65)
+    weather2 = WeatherState(datetime.now(), "Moscow", 10.5, 9.0, 1010, 70)
+    repository.save_weather(weather1, user)
+    repository.save_weather(weather2, user)
+
+    wait_until(lambda: repository.written == 2)
+    mock_weather_repository.save_weathers.assert_called_once_with(
+        [(weather1, user), (weather2, user)]
+    )
+
+    repository.save_weather(weather1, user)
+    assert repository.stats()["queue_depth"] == 1
+
+    asyncio.run(repository.stop())
+    assert repository.written == 3
+    assert repository.stats()["flushes"] == 2
+
+    repository.save_weather(weather2, user)
+    mock_weather_repository.save_weather.assert_called_once_with(
+        weather2, user
+    )
+
+
+def test_write_behind_weather_repository_drops_on_overflow(
+        mock_weather_repository):
+    repository = WriteBehindWeatherRepository(
+        mock_weather_repository, flush_interval_ms=60000, max_queue_size=1,
+        overflow="drop"
+    )
+
+    user = User(1, "")
+    weather = WeatherState(datetime.now(), "London", 20.5, 19.0, 1015, 65)
+    repository.save_weather(weather, user)
+    repository.save_weather(weather, user)
+
+    assert repository.dropped == 1
+    repository.close()
+    assert repository.written == 1
+
+
+def test_write_behind_weather_repository_counts_failures(
+        mock_weather_repository):
+    mock_weather_repository.save_weathers.side_effect = Exception("locked")
+    repository = WriteBehindWeatherRepository(
+        mock_weather_repository, flush_interval_ms=60000
+    )
+
+    repository.save_weather(
+        WeatherState(datetime.now(), "London", 20.5, 19.0, 1015, 65),
+        User(1, "")
+    )
+    repository.close()
+    assert repository.failed == 1
+    assert repository.written == 0
+
+
+def test_write_behind_weather_repository_close_keeps_queued_saves(
+        mock_weather_repository):
+    writing = Event()
+    mock_weather_repository.save_weathers.side_effect = \
+        lambda batch: writing.wait(5)
+    repository = WriteBehindWeatherRepository(
+        mock_weather_repository, batch_size=1, flush_interval_ms=60000,
+        max_queue_size=1
+    )
+
+    user = User(1, "")
+    weather = WeatherState(datetime.now(), "London", 20.5, 19.0, 1015, 65)
+    repository.save_weather(weather, user)
+    wait_until(lambda: repository.queue.empty())
+    repository.save_weather(weather, user)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        blocked_save = executor.submit(repository.save_weather, weather, user)
+        time.sleep(0.05)
+        closing = executor.submit(repository.close)
+        time.sleep(0.05)
+        writing.set()
+        blocked_save.result()
+        closing.result()
+
+    assert repository.written == 3
+    assert not mock_weather_repository.save_weather.called
+
+
+@pytest.fixture
+def mock_user_repository():
+    mock = MagicMock(spec=UserRepository)
+    users = {"token1": User(1, "token1")}
+    mock.get_user.side_effect = lambda token: users.get(token)
+
+    def mock_save_user(telegram_id, token):
+        for key, user in list(users.items()):
+            if user.telegram_id == telegram_id:
+                del users[key]
+        users[token] = User(telegram_id, token)
+
+    mock.save_user.side_effect = mock_save_user
+    return mock
+
+
+def test_cached_user_repository(mock_user_repository):
+    repository = CachedUserRepository(mock_user_repository)
+
+    assert repository.get_user("token1").telegram_id == 1
+    assert repository.get_user("token1").telegram_id == 1
+    assert repository.get_user("bad") is None
+    assert repository.get_user("bad") is None
+    assert mock_user_repository.get_user.call_count == 2
+
+
+def test_cached_user_repository_invalidates_rotated_token(
+        mock_user_repository):
+    repository = CachedUserRepository(mock_user_repository)
+
+    assert repository.get_user("token1").telegram_id == 1
+    assert repository.get_user("token2") is None
+
+    repository.save_user(1, "token2")
+    assert repository.get_user("token1") is None
+    assert repository.get_user("token2").telegram_id == 1
+
+
+def test_cached_user_repository_rotated_token_expires_in_other_workers(
+        mock_user_repository):
+    worker1 = CachedUserRepository(mock_user_repository)
+    worker2 = CachedUserRepository(mock_user_repository)
+    now = [0.0]
+    worker1.cache.clock = lambda: now[0]
+
+    assert worker1.get_user("token1").telegram_id == 1
+    worker2.save_user(1, "token2")
+    assert worker1.get_user("token1").telegram_id == 1
+
+    now[0] = 6
+    assert worker1.get_user("token1") is None
+
+
+def test_cached_user_repository_negative_ttl(mock_user_repository):
+    repository = CachedUserRepository(
+        mock_user_repository, cache_seconds=60, negative_cache_seconds=1
+    )
+    now = [0.0]
+    repository.cache.clock = lambda: now[0]
+
+    repository.get_user("token1")
+    repository.get_user("bad")
+    now[0] = 2
+    repository.get_user("token1")
+    repository.get_user("bad")
+    assert mock_user_repository.get_user.call_count == 3
+
+
+def test_cached_weather_api_get_cached_weather(mock_weather_api):
+    now = [0.0]
+    wrapped = CachedWeatherApi(mock_weather_api, 10, stale_seconds=20)
+    wrapped.cache.clock = lambda: now[0]
+
+    assert wrapped.get_cached_weather("London") is None
+    weather = wrapped.get_weather("London", User(1, ""))
+    assert wrapped.get_cached_weather("London") is weather
+
+    now[0] = 15
+    assert wrapped.get_cached_weather("London") is None
+
+
+def test_cached_weather_api_get_cached_weather_ttl(mock_weather_api):
+    now = [0.0]
+    wrapped = InstrumentedWeatherApi(
+        CachedWeatherApi(mock_weather_api, 10, stale_seconds=20),
+        MetricsRegistry(),
+    )
+    wrapped.wrapped.cache.clock = lambda: now[0]
+
+    assert wrapped.get_cached_weather_ttl("London") is None
+    wrapped.get_weather("London", User(1, ""))
+    now[0] = 4
+    assert wrapped.get_cached_weather_ttl("London") == 6
+    now[0] = 15
+    assert wrapped.get_cached_weather_ttl("London") == 0
+
+
+def test_instrumented_weather_api_records_layer_and_result(
+        mock_weather_api):
+    metrics = MetricsRegistry()
+    wrapped = InstrumentedWeatherApi(mock_weather_api, metrics, "upstream")
+
+    weather = wrapped.get_weather("London", User(1, ""))
+    assert isinstance(weather, WeatherState)
+    mock_weather_api.get_weather.side_effect = \
+        lambda city, user: ApiError("Error")
+    wrapped.get_weather("London", User(1, ""))
+
+    text = metrics.render()
+    assert 'layer_duration_seconds_count{layer="upstream",' \
+        'method="get_weather"} 2' in text
+    assert 'weather_api_results_total{layer="upstream",result="ok"} 1.0' \
+        in text
+    assert 'weather_api_results_total{layer="upstream",' \
+        'result="ApiError"} 1.0' in text
+
+
+def test_async_instrumented_weather_api(mock_async_weather_api):
+    metrics = MetricsRegistry()
+    wrapped = AsyncInstrumentedWeatherApi(mock_async_weather_api, metrics)
+
+    weather = asyncio.run(wrapped.get_weather("London", User(1, "")))
+    assert isinstance(weather, WeatherState)
+    assert wrapped.timer.layer == "MagicMock"
+    assert 'result="ok"} 1.0' in metrics.render()
+
+
+def test_instrumented_repositories_count_exceptions(mock_weather_repository,
+                                                    mock_user_repository):
+    metrics = MetricsRegistry()
+    weather_repository = InstrumentedWeatherRepository(
+        mock_weather_repository, metrics, "sqlite"
+    )
+    user_repository = InstrumentedUserRepository(
+        mock_user_repository, metrics, "users"
+    )
+
+    weather_repository.get_weather_history(10, "London", after=None)
+    mock_weather_repository.get_weather_history.assert_called_once_with(
+        10, "London", after=None
+    )
+    mock_user_repository.get_user.side_effect = RuntimeError("locked")
+    with pytest.raises(RuntimeError):
+        user_repository.get_user("token")
+
+    text = metrics.render()
+    assert 'layer_duration_seconds_count{layer="sqlite",' \
+        'method="get_weather_history"} 1' in text
+    assert 'layer_exceptions_total{layer="users",method="get_user"} 1.0' \
+        in text